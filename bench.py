@@ -0,0 +1,294 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import textwrap
+from itertools import islice
+
+import download
+from download import Debug
+
+
+parser = argparse.ArgumentParser(
+    prog="bench.py",
+    formatter_class=argparse.RawDescriptionHelpFormatter,
+    description="Benchmark parsing, converting and downloading with download.py on generated catalogues, without network access.",
+    epilog=textwrap.dedent('''\
+        Every benchmark is timed on catalogues of each size in --sizes, the memory_* benchmarks measure the peak memory instead.
+        The downloads use the fake backend and a stub yt-dlp executable (a python script that only writes placeholder files),
+        so only the overhead of download.py is measured.
+
+        Results are compared to the baseline file, and the exit code is 1 if any benchmark is more than --tolerance worse.
+    ''')
+)
+parser.add_argument('--sizes', action='store', default='1000,10000,100000,1000000', help="Comma-separated list of catalogue sizes (number of songs). \
+Use e.g. `--sizes 1000,10000' for a quick run, the 1M catalogue takes several minutes. (default: 1000,10000,100000,1000000)")
+parser.add_argument('--playlists', action='store', type=int, default=400, help="Number of playlists in each catalogue. (default: 400)")
+parser.add_argument('--only', action='store', default=None, help="Comma-separated list of benchmarks to run. (default: all)")
+parser.add_argument('--repeat', action='store', type=int, default=3, help="Number of times each benchmark is run. The fastest run is used. (default: 3)")
+parser.add_argument('--jobs', action='store', type=int, default=4, help="--jobs used for the download benchmarks. (default: 4)")
+parser.add_argument('--dispatch-songs', action='store', type=int, default=10000, help="Maximum number of songs downloaded with the fake backend. (default: 10000)")
+parser.add_argument('--stub-songs', action='store', type=int, default=200, help="Maximum number of songs downloaded with the stub yt-dlp executable. (default: 200)")
+parser.add_argument('--sync-songs', action='store', type=int, default=20000, help="Maximum number of songs in the catalogue of the sync benchmark. (default: 20000)")
+parser.add_argument('--workdir', action='store', default=None, help="Directory for the generated files. (default: a temporary directory that is removed afterwards)")
+parser.add_argument('--baseline', action='store', default='./bench_baseline.json', help="Baseline file to compare against. (default: ./bench_baseline.json)")
+parser.add_argument('--save-baseline', action='store_true', help="Store the results as the new baseline instead of comparing.")
+parser.add_argument('--tolerance', action='store', type=float, default=0.25, help="Allowed slowdown or extra memory relative to the baseline, as a fraction. (default: 0.25)")
+parser.add_argument('--seed', action='store', type=int, default=1, help="Seed for the generated catalogues. (default: 1)")
+
+
+# stub for --ytdlp-cmd. Understands the arguments the subprocess backend passes, writes a placeholder file and prints its path.
+STUB_YTDLP = '''\
+import os
+import sys
+
+args = sys.argv[1:]
+link = args[args.index('--') + 1]
+outdir = args[args.index('-P') + 1]
+outputformat = args[args.index('-o') + 1].replace('%%', '%')
+if link.startswith('fail'):
+    sys.exit(1)
+os.makedirs(outdir, exist_ok=True)
+path = os.path.join(outdir, outputformat + '.mp3')
+with open(path, 'w', encoding='utf-8') as writer:
+    writer.write(link)
+if '--print' in args:
+    template = args[args.index('--print') + 1]
+    print(template.split(':', 1)[1].replace('%(filepath)s', path), flush=True)
+'''
+
+
+def generate_catalogue(txtfile, size, playlist_count, seed):
+    # txt catalogue with unlisted songs, SKIP blocks, duplicates and songs without a link
+    rng = random.Random(seed)
+    playlists = [f'Playlist {i}' for i in range(playlist_count)]
+    unlisted = size // 100
+    per_playlist = max(1, (size - unlisted) // playlist_count)
+    with open(txtfile, 'w', encoding='utf-8') as writer:
+        writer.write('# generated by bench.py\nINDEX PLAYLISTS\n')
+        writer.writelines(f'- {playlist}\n' for playlist in playlists)
+        writer.write('END INDEX\n\nEND HEADER\n\n')
+
+        song = 0
+        def write_song(index):
+            if index % 20 == 19:
+                # duplicate of an earlier song in the same playlist
+                index -= rng.randrange(1, 10)
+            link = '' if index % 25 == 0 else f'   https://example.com/watch?v={index:011d}'
+            writer.write(f'Song {index}   Artist {index % 997}, Other {index % 13}   Album {index % 311}{link}\n')
+
+        for _ in range(unlisted):
+            write_song(song)
+            song += 1
+        for i, playlist in enumerate(playlists):
+            if song >= size:
+                break
+            writer.write(f'\nPLAYLIST {playlist}\n')
+            count = per_playlist if i < playlist_count - 1 else size - song
+            for j in range(count):
+                if j % 50 == 10:
+                    writer.write('SKIP\n')
+                elif j % 50 == 13:
+                    writer.write('END SKIP\n')
+                elif j % 50 == 30:
+                    writer.write('# comment\n')
+                write_song(song)
+                song += 1
+
+
+def consume(songs):
+    for _ in songs:
+        pass
+
+
+def bench_header(files, args):
+    with open(files['txt'], 'r', encoding='utf-8') as reader:
+        download.parse_txtheader(reader)
+
+def bench_parse_txt(files, args):
+    songs, stats = download.read_txtfile(files['txt'], None, False, False, True)
+    consume(songs)
+
+def bench_parse_csv(files, args):
+    songs, stats = download.read_csvfile(files['csv'], None, False, True)
+    consume(songs)
+
+def bench_convert(files, args):
+    songs, stats = download.read_txtfile(files['txt'], None, False, False, True)
+    download.write_csvfile(files['out_csv'], songs)
+
+def bench_convert_parallel(files, args):
+    download.convert_txtfile(files['txt'], files['out_csv'], os.cpu_count() or 1, None, False, False, True)
+
+def bench_convert_to_txt(files, args):
+    songs, stats = download.read_csvfile(files['csv'])
+    download.write_txtfile(files['out_txt'], songs)
+
+def bench_dispatch_fake(files, args):
+    songs, stats = download.read_csvfile(files['csv'])
+    outdir = os.path.join(files['dir'], 'out_fake')
+    shutil.rmtree(outdir, ignore_errors=True)
+    backend = download.FakeBackend()
+    download.download_songs(islice(songs, args.dispatch_songs), outdir, None, True, backend, args.jobs)
+
+def bench_dispatch_stub(files, args):
+    songs, stats = download.read_csvfile(files['csv'])
+    outdir = os.path.join(files['dir'], 'out_stub')
+    shutil.rmtree(outdir, ignore_errors=True)
+    backend = download.SubprocessBackend(files['stub'], 'ffmpeg', files['config'])
+    download.download_songs(islice(songs, args.stub_songs), outdir, None, True, backend, args.jobs)
+
+def sync_args(files):
+    return ['-d', '--csv', files['sync_csv'], '--dir', os.path.join(files['dir'], 'out_sync'), '--sync', '--backend', 'fake',
+            '--config-location', files['config'], '--quiet']
+
+def setup_sync(files, args):
+    # the first --sync downloads the whole catalogue, which is not timed
+    songs, stats = download.read_csvfile(files['csv'])
+    download.write_csvfile(files['sync_csv'], islice(songs, args.sync_songs))
+    shutil.rmtree(os.path.join(files['dir'], 'out_sync'), ignore_errors=True)
+    download.main(sync_args(files))
+
+def bench_sync(files, args):
+    # a --sync of a catalogue that did not change since the last one, which should not depend on the size of the manifest per song
+    download.main(sync_args(files))
+
+def bench_memory_load(files, args):
+    # all songs of the catalogue in memory at once, as the modes that need the whole catalogue keep them
+    songs, stats = download.read_csvfile(files['csv'])
+    songs = list(songs)
+
+BENCHMARKS = {
+    'header': bench_header,
+    'parse_txt': bench_parse_txt,
+    'parse_csv': bench_parse_csv,
+    'convert': bench_convert,
+    'convert_parallel': bench_convert_parallel,
+    'convert_to_txt': bench_convert_to_txt,
+    'dispatch_fake': bench_dispatch_fake,
+    'dispatch_stub': bench_dispatch_stub,
+    'sync': bench_sync,
+    'memory_load': bench_memory_load,
+    'memory_convert': bench_convert,
+    'memory_dispatch': bench_dispatch_fake
+}
+# preparation of a benchmark that is not part of its time
+SETUP = {
+    'sync': setup_sync
+}
+
+
+def write_stub(workdir):
+    stub = os.path.join(workdir, 'fake-yt-dlp')
+    with open(stub, 'w', encoding='utf-8') as writer:
+        writer.write(f'#!{sys.executable}\n{STUB_YTDLP}')
+    os.chmod(stub, 0o755)
+    config = os.path.join(workdir, 'ytdlp.conf')
+    with open(config, 'w', encoding='utf-8') as writer:
+        writer.write('# empty config for the stub\n')
+    return (stub, config)
+
+def is_memory_benchmark(key):
+    return key.startswith('memory_')
+
+def run_benchmark(name, files, args):
+    # memory benchmarks return the peak of the traced memory in MiB, others the fastest time in seconds
+    if name in SETUP:
+        SETUP[name](files, args)
+    if is_memory_benchmark(name):
+        tracemalloc.start()
+        BENCHMARKS[name](files, args)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak / (1024 * 1024)
+    best = None
+    for _ in range(max(1, args.repeat)):
+        start = time.perf_counter()
+        BENCHMARKS[name](files, args)
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return best
+
+def format_result(key, value):
+    if is_memory_benchmark(key):
+        return f'{value:9.2f}MiB'
+    return f'{value:10.4f}s'
+
+def compare_baseline(results, baseline, tolerance):
+    failed = []
+    for key in results:
+        if key not in baseline:
+            print(f'{key:<28} {format_result(key, results[key])}  (no baseline)')
+            continue
+        ratio = results[key] / baseline[key] if baseline[key] > 0 else 1.0
+        status = 'ok'
+        if ratio > 1 + tolerance:
+            status = 'WORSE'
+            failed.append(key)
+        print(f'{key:<28} {format_result(key, results[key])}  baseline {format_result(key, baseline[key])}  {ratio:6.2f}x  {status}')
+    return failed
+
+
+def main():
+    args = parser.parse_args()
+    Debug.quiet = True
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    names = list(BENCHMARKS) if args.only == None else [name.strip() for name in args.only.split(',')]
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark `{name}'. Choose from: {', '.join(BENCHMARKS)}")
+            exit(1)
+
+    workdir = args.workdir if args.workdir != None else tempfile.mkdtemp(prefix='song_downloader_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    results = {}
+    try:
+        stub, config = write_stub(workdir)
+        for size in sizes:
+            files = {
+                'dir': workdir,
+                'txt': os.path.join(workdir, f'catalogue_{size}.txt'),
+                'csv': os.path.join(workdir, f'catalogue_{size}.csv'),
+                'out_csv': os.path.join(workdir, f'converted_{size}.csv'),
+                'out_txt': os.path.join(workdir, f'converted_{size}.txt'),
+                'sync_csv': os.path.join(workdir, f'sync_{size}.csv'),
+                'stub': stub,
+                'config': config
+            }
+            generate_catalogue(files['txt'], size, args.playlists, args.seed)
+            songs, stats = download.read_txtfile(files['txt'])
+            download.write_csvfile(files['csv'], songs)
+            for name in names:
+                results[f'{name}@{size}'] = run_benchmark(name, files, args)
+    finally:
+        if args.workdir == None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as writer:
+            json.dump(results, writer, indent=4, sort_keys=True)
+        for key in results:
+            print(f'{key:<28} {format_result(key, results[key])}')
+        print(f'\nBaseline stored at: {args.baseline}')
+        return
+
+    baseline = {}
+    try:
+        with open(args.baseline, 'r', encoding='utf-8') as reader:
+            baseline = json.load(reader)
+    except IOError:
+        print(f'No baseline found at {args.baseline}. Use --save-baseline to create one.\n')
+    failed = compare_baseline(results, baseline, args.tolerance)
+    if len(failed) > 0:
+        print(f'\n{len(failed)} benchmarks are more than {args.tolerance:.0%} slower or use more memory than the baseline.')
+        exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import os
+import sys
+import json
+import socket
+import getpass
+import tempfile
+
+
+USAGE = '''\
+usage: dlclient.py [--socket SOCKET] [--client NAME] [--] <download.py arguments>
+
+Sends a job to a server started with `download.py --serve', and shows its output.
+The arguments are the same as for download.py, relative paths are from the current directory.
+Use -- before them when they start with an option of the client itself, such as -h.
+
+  --socket SOCKET  Unix socket of the server. (default: song_downloader.sock in $XDG_RUNTIME_DIR or the temporary directory)
+  --client NAME    Name of this client. Jobs of different clients take turns on the server. (default: the user name)
+'''
+
+
+def default_socketpath():
+    # the same path as download.py --serve
+    return os.path.join(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(), 'song_downloader.sock')
+
+def main():
+    # only the options of the client itself are read here, everything else is passed on to the server as is
+    args = sys.argv[1:]
+    socketpath = default_socketpath()
+    client = getpass.getuser()
+    while len(args) > 0 and args[0] in ('--socket', '--client', '-h', '--help'):
+        if args[0] in ('-h', '--help'):
+            print(USAGE)
+            exit(0)
+        if len(args) < 2:
+            print(f'{args[0]} needs a value.\n\n{USAGE}')
+            exit(1)
+        if args[0] == '--socket':
+            socketpath = args[1]
+        else:
+            client = args[1]
+        args = args[2:]
+    # separates the options of the client from those of download.py, and is not passed on
+    if len(args) > 0 and args[0] == '--':
+        args = args[1:]
+    if len(args) == 0:
+        print(USAGE)
+        exit(1)
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socketpath)
+    except OSError as err:
+        print(f"Could not connect to the server on {socketpath}. Start it with `download.py --serve'.\n{err}")
+        exit(1)
+
+    with conn:
+        conn.sendall((json.dumps({'client': client, 'cwd': os.getcwd(), 'args': args}) + '\n').encode('utf-8'))
+        with conn.makefile('r', encoding='utf-8') as reader:
+            for line in reader:
+                message = json.loads(line)
+                if message['type'] == 'output':
+                    print(message['line'], flush=True)
+                elif message['type'] == 'queued' and message['waiting'] > 0:
+                    print(f"Queued with {message['waiting']} other waiting jobs on the server, clients take turns...", file=sys.stderr, flush=True)
+                elif message['type'] == 'exit':
+                    if 'error' in message:
+                        print(message['error'], file=sys.stderr)
+                    exit(message['code'])
+    print('The server closed the connection before the job finished.', file=sys.stderr)
+    exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -6,11 +6,26 @@ import subprocess
 import shlex
 import random
 import textwrap
+import tempfile
 import re
+import json
+import shutil
+import time
+import hashlib
+import sqlite3
+import threading
+import heapq
+import urllib.parse
+import socket
+import traceback
+import signal
+import errno
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 
 def print_format():
-    print("Txt file format.\n\
+    Debug.write("Txt file format.\n\
     File starts with a header, which contains the playlist index.\n\
     Below that are all the playlists. Each entry in a playlist needs at least 3 spaces between fields.\n\
     All empty lines and lines starting with a `#' are ignored.\n\
@@ -50,7 +65,17 @@ Csv file format. (excel format)\n\
     ")
 
 
-parser = argparse.ArgumentParser(
+# Writes help and usage errors to the output of Debug, so they reach the client of a --serve job
+class ArgumentParser(argparse.ArgumentParser):
+
+    def _print_message(self, message, file=None):
+        if message and Debug.stream != None:
+            Debug.stream.write(message)
+        else:
+            super()._print_message(message, file)
+
+
+parser = ArgumentParser(
     prog="download.py",
     formatter_class=argparse.RawDescriptionHelpFormatter,
     description="Download songs specified in a txt/csv file, or convert txt to csv file.",
@@ -63,53 +88,185 @@ parser = argparse.ArgumentParser(
     ''')
 )
 parse_group = parser.add_mutually_exclusive_group(required=True)
-parse_group.add_argument('-c', '--convert', action='store_true', help='Converts a txt file to a csv file. Fields should be in the same order as the csv. Use -f flag for info on format.')
+parse_group.add_argument('-c', '--convert', action='store_true', help='Converts a txt file to a csv file, or a csv file to a txt file with --to-txt. Fields should be in the same order as the csv. Use -f flag for info on format.')
+parser.add_argument('--to-txt', action='store_true', help="Only has effect if -c is set. Convert the csv file to a txt file instead.")
+parser.add_argument('--workers', action='store', type=int, default=0, help="Only has effect if -c is set. Number of processes that parse the txt file, in chunks of whole playlists. \
+0 uses one process per CPU core. (default: 0)")
 parse_group.add_argument('-d', '--dl', '--download', action='store_true', help="Download all songs specified in a txt/csv file. Use -f flag for info on format. \
 For each playlist it will create a new folder in the output directory with the playlist name. Uncategorised songs are placed in the root folder. Songs where download link is not specified are skipped.")
+parse_group.add_argument('--rebuild-playlists', action='store_true', help="Rewrite the playlist files (.m3u8) in --dir from the download manifest, without reading a txt/csv file or downloading anything. \
+Only songs downloaded with the same --config-location and --backend are listed.")
+parse_group.add_argument('--retry-failed', action='store_true', help="Download only the songs in the failed songs file of --dir (see --failed-file) again, \
+without reading a txt/csv file. The playlist files are rewritten from the download manifest afterwards if -p is set.")
+parse_group.add_argument('--serve', action='store_true', help="Run as a server that takes jobs on a Unix socket (see --socket), sent with dlclient.py. \
+A job has the same arguments as download.py. Jobs run one at a time, taking turns between clients, and the output is sent back to the client. \
+Parsed txt/csv files, yt-dlp and the download workers are kept between jobs, so they are only loaded once.")
+parse_group.add_argument('--merge-shards', action='store', nargs='+', metavar='SHARD_DIR', default=None, help="Move the songs downloaded with --shard \
+in the given output directories into --dir, combine their download manifests and failed songs files, and write the playlist files (.m3u8) of the whole catalogue. \
+Use the same --config-location and --backend as for the downloads.")
 parse_group.add_argument('-f', '--format', action='store_true', help="Display format of the txt/csv files and exit.")
 
 parser.add_argument('--csv', action='store', help='Csv file. When -c is set, this is the output file. Otherwise treated as input file.')
 parser.add_argument('--txt', action='store', help='Txt input file. This is prioritised when downloading if --csv is also specified.')
-parser.add_argument('--dir', '--directory', action='store', help='Output directory. Ignored if -d is not set.')
-
-parser.add_argument('-s', '--sd', '--skip-duplicates', action='store_true', help="Skip songs that were already specified in a playlist. Song is only filtered if the titel+artists combination is already parsed.")
-parser.add_argument('--filter-playlists', action='store', default=None, help="Only download specified playlists, as a comma-separated list of playlist names. E.g. `FOO,BAR'. Set -i to use a list of playlist indices instead.")
+parser.add_argument('--dir', '--directory', action='store', help='Output directory. Required with -d, --rebuild-playlists, --retry-failed and --merge-shards, ignored otherwise.')
+
+parser.add_argument('-s', '--sd', '--skip-duplicates', action='store_true', help="Skip songs that were already specified in a playlist. Song is filtered if the title+artists combination or the link is already parsed. \
+Title and artists are compared ignoring case, whitespace, the order of the artists and featured artists written in the title (e.g. `(feat. X)').")
+parser.add_argument('--duplicate-scope', action='store', choices=['playlist', 'global'], default='playlist', help="Only has effect if -s is set. \
+'playlist' only skips duplicates within the same playlist, 'global' also skips songs that were already specified in another playlist. (default: playlist)")
+parser.add_argument('--filter-playlists', action='store', default=None, help="Only download specified playlists, as a comma-separated list of playlist names. E.g. `FOO,BAR'. Set -i to use a list of playlist indices instead. \
+For txt files an index of the playlists is stored next to the file (<file>.idx), so only the selected playlists have to be read.")
 parser.add_argument('-i', '--indices', action='store_true', help="Only has effect if --filter-playlists is set. Playlists are parsed instead as indices (starting from 0) in the playlist overview. \
 This option only works with the txt file input. It is ignored on csv input.")
+parser.add_argument('--resolve-links', action='store_true', help="Search for a link for songs without one, by their artists and title. \
+Works when downloading and converting, so the links are stored in the output file of -c.")
+parser.add_argument('--resolver', action='store', choices=['ytsearch', 'fake'], default='ytsearch', help="Only has effect if --resolve-links is set. \
+'ytsearch' takes the first YouTube search result with yt-dlp. 'fake' does not access the network and makes up links, for testing. (default: ytsearch)")
+parser.add_argument('--resolve-jobs', action='store', type=int, default=4, help="Only has effect if --resolve-links is set. \
+Number of searches that run at the same time, each for a batch of songs. (default: 4)")
+parser.add_argument('--resolve-cache', action='store', default=os.path.join('~', '.cache', 'song_downloader', 'resolve.sqlite3'), help="Only has effect if --resolve-links is set. \
+File where the found links are stored, so the same song is not searched again. Songs for which nothing was found are stored too. \
+(default: ~/.cache/song_downloader/resolve.sqlite3)")
+parser.add_argument('--resolve-ttl', action='store', type=float, default=30, help="Only has effect if --resolve-links is set. \
+Number of days after which a song in the link cache is searched again. (default: 30)")
 parser.add_argument('--ignore-noplaylist', action='store_true', help="Ignore all songs that are not in a playlist. If not set, these songs will be downloaded even if filtering by playlists with -p.")
 parser.add_argument('--ffmpeg-location', action='store', default="C:/Program Files/ffmpeg/ffmpeg.exe", 
                     help="Location of the ffmpeg installation used to convert between file types. (default: C:/Program Files/ffmpeg/ffmpeg.exe)")
 parser.add_argument('--config-location', action='store', default='./ytdlp.conf', help="yt-dlp config path. (default: ./ytdlp.conf)")
 parser.add_argument('--ytdlp-cmd', action='store', default='C:/Program Files/ytdlp/yt-dlp.exe', help="Command to run ytdlp. (default: 'C:\\Program Files\\ytdlp\\yt-dlp.exe')")
+parser.add_argument('--backend', action='store', choices=['subprocess', 'library', 'fake'], default='subprocess', help="How yt-dlp is run. \
+'subprocess' starts --ytdlp-cmd for every song. 'library' runs yt-dlp in this process with the yt-dlp python package, and reuses it for all songs. \
+'fake' does not download anything and only writes placeholder files, for testing. (default: subprocess)")
+parser.add_argument('--fake-delay', action='store', type=float, default=0.0, help="Seconds an average song takes with --backend fake. \
+Every link gets a fixed fake duration, and takes longer or shorter in proportion. (default: 0)")
 parser.add_argument('-o', '--output', action='store', default="%%(artists) -- %%(title)", help="Music file output format. '%%(field)' will be replaced with value, where field can be title/artists/album/playlist/link. \
 Because this is python, you should enter it with a double '%%': '%%%%(field)'. \
 Special characters not allowed in file names are stripped, where '\\', '|', and '/' become ' - '. (default: '%%(artists) --  %%(title)')")
 parser.add_argument('-p', '--playlist', action='store_true', help="Create a playlist file (.m3u8) for each playlist. All unlisted songs are linked in 'unlisted.m3u8'")
+parser.add_argument('--store-mode', action='store', choices=['none', 'hardlink', 'symlink', 'm3u'], default='none', help="Download songs that are in several playlists only once. \
+Songs are downloaded into a `.store' folder in the output directory, and playlist folders get a hardlink or symlink to the stored file, \
+or with 'm3u' the playlist files refer to the stored file directly. 'none' downloads the song into every playlist folder. (default: none)")
+parser.add_argument('--sync', action='store_true', help="Only has effect if -d is set. Compare the txt/csv file with the previous --sync of --dir, \
+and only download the songs that were added since. Songs that moved to another playlist are moved to its folder instead of downloaded again. \
+Only the playlist files of playlists that changed are rewritten (with -p). Needs the download manifest.")
+parser.add_argument('--prune', action='store_true', help="Only has effect if --sync is set. Delete the files of songs that were removed from the txt/csv file. \
+Without it they are kept on disk, but left out of the playlist files.")
+parser.add_argument('--scratch-dir', action='store', default=None, help="Only has effect if -d is set. Download and convert every song in this local folder first \
+(e.g. on tmpfs or a local SSD), and move it into --dir only when it is complete, so --dir never has partial files. Useful if --dir is a network share. \
+A run uses its own folder in it, which is removed afterwards. (default: download directly into --dir)")
+parser.add_argument('--scratch-limit', action='store', type=float, default=0, help="Only has effect if --scratch-dir is set. Maximum size in MiB of the songs \
+in the scratch folder at the same time. Fewer songs are downloaded at the same time when it is reached. The size of a song is estimated with --prefetch, \
+or from the songs downloaded before. 0 means no limit. (default: 0)")
+parser.add_argument('--no-manifest', action='store_true', help="Do not use the download manifest in the output directory. \
+By default every downloaded song is recorded there, and songs that were already downloaded with the same output format and yt-dlp config are skipped on the next run.")
+parser.add_argument('--metrics-file', action='store', default=None, help="Write the timings of every song to this file, as one JSON object per line. \
+Contains the time spent in the startup, extract, download and postprocess phases, the return code and the size of the file. \
+A summary of the timings is printed at the end.")
+parser.add_argument('--split-transcode', action='store_true', help="Download only the audio with yt-dlp, and convert it to the --audio-format of the yt-dlp config \
+and add the metadata with ffmpeg in a separate pool (see --transcode-jobs), so downloading and converting run at the same time. \
+The extraction options (--extract-audio, --audio-format, --audio-quality, --embed-metadata) in the yt-dlp config are used by this pool instead of yt-dlp.")
+parser.add_argument('--codec-aware', action='store_true', help="Implies --split-transcode. Check the codec of each downloaded stream, and copy or remux it \
+instead of encoding it again if it already has the codec of the --audio-format. The decision for each song is shown with -v, and in a summary at the end.")
+parser.add_argument('--transcode-jobs', action='store', type=int, default=0, help="Only has effect if --split-transcode is set. Number of songs converted at the same time. \
+0 uses one per CPU core. (default: 0)")
+parser.add_argument('-j', '--jobs', action='store', type=int, default=1, help="Number of songs that are downloaded at the same time, across all playlists. (default: 1)")
+parser.add_argument('--prefetch', action='store_true', help="Before downloading, fetch the duration and size of all songs with one yt-dlp process per batch of links, \
+and download the longest songs first so the workers finish at about the same time. An estimate of the download time is shown before the downloads start. \
+The metadata is cached in the download manifest (not with --no-manifest), so it is only fetched once for every link. \
+All songs are read in memory first with this option.")
+parser.add_argument('--batch-playlists', action='store_true', help="Only has effect if -d is set. Download the songs of each playlist with one yt-dlp process \
+(up to 200 songs per process) instead of one process per song, so yt-dlp only starts once per playlist. The title, artists and album are written into the files afterwards, \
+with mutagen if it is installed, otherwise with ffmpeg. The downloads only start after the whole txt/csv file is read. Cannot be used with --prefetch.")
+parser.add_argument('--playlist-jobs', action='store', type=int, default=0, help="Maximum number of songs of the same playlist that are downloaded at the same time. 0 means no limit other than --jobs. (default: 0)")
+
+parser.add_argument('--retries', action='store', type=int, default=3, help="Number of times a song is tried again after a transient error, \
+like throttling, a timeout or a connection error. Songs that are unavailable, private or not supported are not tried again. (default: 3)")
+parser.add_argument('--retry-delay', action='store', type=float, default=5.0, help="Seconds to wait before the first retry of a song. \
+The wait doubles with every retry, up to 5 minutes. Other songs from the same host also wait. (default: 5)")
+parser.add_argument('--host-interval', action='store', type=float, default=0.0, help="Minimum seconds between starting two downloads from the same host. (default: 0)")
+parser.add_argument('--failed-file', action='store', default=None, help="File where the songs that could not be downloaded are stored, \
+as one JSON object per line with the error. (default: failed.jsonl in --dir)")
+
+parser.add_argument('--shard', action='store', default=None, help="Only has effect if -d is set. Download only part K of N of the catalogue, as `K/N', \
+to split the downloads over several machines. Songs are assigned to a part by their link, so each part is the same on every run. \
+Every part should use the same txt/csv file and filters, and its own --dir. No playlist files are written, use --merge-shards afterwards. (default: the whole catalogue)")
+parser.add_argument('--progress', action='store_true', help="Only has effect if -d is set. Show a live view of the downloads: the song and speed of every worker, \
+the number of songs done, failed and remaining, the total speed and an estimate of the time left. Also shown with --quiet. \
+If the output is not a terminal, a status line is printed every 10 seconds instead.")
+parser.add_argument('--socket', action='store', default=None, help="Only has effect if --serve is set. Path of the Unix socket of the server. \
+(default: song_downloader.sock in $XDG_RUNTIME_DIR or the temporary directory)")
 
 parser.add_argument('-v', '--verbose', action='count', default=0, help="Output more detailed log output.")
 parser.add_argument('--quiet', action='store_true', help="Output nothing to console. This option overwrites -v")
 
 
+def intern_str(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+# Songs have no __dict__, and the playlist, artists and album strings are interned, because they repeat a lot.
+# This keeps large catalogues small in memory.
 class Song:
+    __slots__ = ('title', 'artists', 'album', 'playlist', 'link')
+
     def __init__(self, title, artists, album, playlist, link):
         self.title = title
-        self.artists = artists
-        self.album = album
-        self.playlist = playlist
+        self.artists = intern_str(artists)
+        self.album = intern_str(album)
+        self.playlist = intern_str(playlist)
         self.link = link
 
 class Debug:
     quiet = False
     verbosity = 0
+    # where all output goes, sys.stdout if None. With --serve this is the connection to the client of the job
+    stream = None
+
+    @classmethod
+    def out(cls):
+        return cls.stream if cls.stream != None else sys.stdout
 
     @classmethod
     def print(cls, msg='', verbosity=0):
         if not cls.quiet and cls.verbosity >= verbosity:
-            print(msg)
-
-def main():
+            print(msg, file=cls.out())
 
-    args = parser.parse_args()
+    @classmethod
+    def write(cls, msg=''):
+        # output that is also shown with --quiet, such as errors and the output of yt-dlp
+        print(msg, file=cls.out())
+
+# options with a path, which are relative to the working directory of the client with --serve
+PATH_OPTIONS = ['txt', 'csv', 'dir', 'config_location', 'metrics_file', 'failed_file', 'resolve_cache', 'scratch_dir']
+# options with a program, which is only a path if it contains a directory. Otherwise it is looked up in PATH
+PROGRAM_OPTIONS = ['ffmpeg_location', 'ytdlp_cmd']
+
+def resolve_paths(args, cwd):
+    for option in PATH_OPTIONS:
+        value = getattr(args, option)
+        if value != None:
+            setattr(args, option, os.path.join(cwd, os.path.expanduser(value)))
+    for option in PROGRAM_OPTIONS:
+        value = os.path.expanduser(getattr(args, option))
+        if os.path.dirname(value) != '':
+            setattr(args, option, os.path.join(cwd, value))
+    if args.merge_shards != None:
+        args.merge_shards = [os.path.join(cwd, os.path.expanduser(shard_dir)) for shard_dir in args.merge_shards]
+
+def main(argv=None, warm=None, cwd=None, out=None):
+    # argv: the arguments instead of sys.argv. warm: a WarmState with the catalogues, backends and workers of earlier jobs of --serve
+    # cwd: the directory relative paths are resolved against instead of the working directory. out: where all output goes instead of stdout
+
+    Debug.stream = out
+    args = parser.parse_args(argv)
+    if cwd != None:
+        resolve_paths(args, cwd)
+
+    if args.serve:
+        if warm != None:
+            Debug.write('--serve cannot be used in a job that is sent to the server.')
+            exit(1)
+        serve(args.socket)
+        exit(0)
 
     if args.format:
         print_format()
@@ -121,44 +278,196 @@ def main():
     Debug.verbosity = verbosity
     
     opt_skip_dupes = args.sd
-    opt_playlists = args.filter_playlists
+    opt_duplicatescope = args.duplicate_scope
+    opt_playlists = parse_playlistfilter(args.filter_playlists)
     opt_indices = args.indices
     opt_ignore_noplaylist = args.ignore_noplaylist
     opt_ffmpeg_location = args.ffmpeg_location
     opt_conf_location = args.config_location
     opt_ytdlpcmd = args.ytdlp_cmd
+    opt_backend = args.backend
+    opt_fakedelay = args.fake_delay
     opt_outputformat = args.output
     opt_createplaylistfile = args.playlist
+    opt_usemanifest = not args.no_manifest
+    opt_storemode = args.store_mode
+    opt_metricsfile = args.metrics_file
+    opt_codecaware = args.codec_aware
+    opt_splittranscode = args.split_transcode or opt_codecaware
+    opt_transcodejobs = args.transcode_jobs if args.transcode_jobs > 0 else (os.cpu_count() or 1)
+    opt_jobs = max(1, args.jobs)
+    opt_playlistjobs = max(0, args.playlist_jobs)
+    opt_prefetch = args.prefetch
+    opt_batch = args.batch_playlists
+    opt_scratchdir = args.scratch_dir
+    opt_scratchlimit = max(0, int(args.scratch_limit * 1024 * 1024))
+    opt_retries = max(0, args.retries)
+    opt_retrydelay = max(0.0, args.retry_delay)
+    opt_hostinterval = max(0.0, args.host_interval)
+    opt_sync = args.sync and args.dl
+    opt_resolve = args.resolve_links
+    opt_progress = args.progress
+    opt_shard = parse_shard(args.shard)
+    opt_prune = args.prune
+
+    opt_totxt = args.to_txt
+    opt_workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
 
     opt_txtfile = args.txt
     opt_csvfile = args.csv
     opt_outdir = args.dir
+    opt_failedfile = args.failed_file
+    if opt_failedfile == None and opt_outdir != None:
+        opt_failedfile = os.path.join(opt_outdir, FailedQueue.FILENAME)
 
     if args.convert and (opt_txtfile == None or opt_csvfile == None):
-        print('txt or csv file is missing for converting. Use --csv <file> or --txt <file>. --help for more information.')
+        Debug.write('txt or csv file is missing for converting. Use --csv <file> or --txt <file>. --help for more information.')
         exit(1)
     if args.dl and opt_txtfile == None and opt_csvfile == None:
-        print('No txt/csv file provided to download from. Use --csv <file> and --txt <file>. --help for more information.')
+        Debug.write('No txt/csv file provided to download from. Use --csv <file> and --txt <file>. --help for more information.')
         exit(1)
-    if args.dl and opt_outdir == None:
-        print('No output directory specified to download to. Use --dir <path>. --help for more information.')
+    if (args.dl or args.rebuild_playlists or args.retry_failed or args.merge_shards != None) and opt_outdir == None:
+        Debug.write('No output directory specified to download to. Use --dir <path>. --help for more information.')
+        exit(1)
+    if opt_batch and opt_prefetch:
+        Debug.write('--batch-playlists downloads the songs in playlist order, and cannot be used with --prefetch.')
+        exit(1)
+    if opt_sync and not opt_usemanifest:
+        Debug.write('--sync needs the download manifest to compare with the previous run, and cannot be used with --no-manifest.')
+        exit(1)
+    if opt_sync and opt_playlists != None:
+        Debug.write('--sync compares the whole catalogue with the previous run, and cannot be used with --filter-playlists.')
         exit(1)
     
-    if args.convert:
-        songs, stats = read_txtfile(opt_txtfile, opt_playlists, opt_indices, opt_ignore_noplaylist, opt_skip_dupes)
+    resolver = None
+    linkcache = None
+    if opt_resolve:
+        resolver = create_resolver(args.resolver, opt_ytdlpcmd)
+        linkcache = LinkCache(os.path.expanduser(args.resolve_cache), args.resolve_ttl * 24 * 60 * 60)
+    resolve_jobs = max(1, args.resolve_jobs)
+
+    if args.convert and opt_totxt:
+        songs, stats = read_csvfile(opt_csvfile, opt_playlists, opt_ignore_noplaylist, opt_skip_dupes, opt_duplicatescope)
+        if resolver != None:
+            songs = resolve_links(songs, stats, resolver, linkcache, resolve_jobs)
+        write_txtfile(opt_txtfile, songs)
         print_parsestats(stats, False)
+    elif args.convert and opt_workers > 1 and resolver == None:
+        stats = convert_txtfile(opt_txtfile, opt_csvfile, opt_workers, opt_playlists, opt_indices, opt_ignore_noplaylist, opt_skip_dupes, opt_duplicatescope)
+        print_parsestats(stats, False)
+    elif args.convert:
+        songs, stats = read_txtfile(opt_txtfile, opt_playlists, opt_indices, opt_ignore_noplaylist, opt_skip_dupes, opt_duplicatescope)
+        if resolver != None:
+            songs = resolve_links(songs, stats, resolver, linkcache, resolve_jobs)
         write_csvfile(opt_csvfile, songs)
+        print_parsestats(stats, False)
         
-    elif args.dl and opt_txtfile != None:
-        songs, stats = read_txtfile(opt_txtfile, opt_playlists, opt_indices, opt_ignore_noplaylist, opt_skip_dupes)
-        print_parsestats(stats, True)
-        download_songs(songs, opt_outdir, opt_outputformat, opt_createplaylistfile, opt_ytdlpcmd, opt_ffmpeg_location, opt_conf_location)
-    elif args.dl and opt_csvfile != None:
-        songs, stats = read_csvfile(opt_csvfile, opt_playlists, opt_ignore_noplaylist, opt_skip_dupes)
-        print_parsestats(stats, True)
-        download_songs(songs, opt_outdir, opt_outputformat, opt_createplaylistfile, opt_ytdlpcmd, opt_ffmpeg_location, opt_conf_location)
-
-# total, skipped_total, skipped_noplaylist, ignore_noplaylist, skipped_notallowed, allowed_playlists, nolink, skipped_dupes, skip_dupes
+    elif args.dl or args.retry_failed:
+        failed = FailedQueue(opt_failedfile)
+        positions = None
+        stats = None
+        if args.retry_failed:
+            songs, positions = failed.songs()
+            if len(songs) == 0:
+                Debug.write(f'No failed songs to try again in {opt_failedfile}.')
+                exit(0)
+            if opt_createplaylistfile and not opt_usemanifest:
+                Debug.write('Warning: the playlist files can only be rewritten from the download manifest, which is disabled with --no-manifest.')
+        elif warm != None:
+            songs, stats = warm.read_catalogue(opt_txtfile, opt_csvfile, opt_playlists, opt_indices, opt_ignore_noplaylist, opt_skip_dupes, opt_duplicatescope)
+        else:
+            songs, stats = read_catalogue(opt_txtfile, opt_csvfile, opt_playlists, opt_indices, opt_ignore_noplaylist, opt_skip_dupes, opt_duplicatescope)
+        if resolver != None and stats != None:
+            songs = resolve_links(songs, stats, resolver, linkcache, resolve_jobs)
+        transcoder = None
+        source_configpath = None
+        if opt_splittranscode:
+            source_configpath, audio_format, audio_quality = write_source_config(opt_conf_location)
+            transcoder = Transcoder(opt_ffmpeg_location, audio_format, audio_quality, opt_codecaware)
+            backend = create_backend(opt_backend, opt_ytdlpcmd, opt_ffmpeg_location, source_configpath, opt_fakedelay, True)
+        elif warm != None:
+            backend = warm.backend(opt_backend, opt_ytdlpcmd, opt_ffmpeg_location, opt_conf_location, opt_fakedelay)
+        else:
+            backend = create_backend(opt_backend, opt_ytdlpcmd, opt_ffmpeg_location, opt_conf_location, opt_fakedelay)
+        config_key = manifest_config_key(opt_conf_location, opt_backend)
+        manifest = None
+        if opt_usemanifest:
+            manifest = DownloadManifest(opt_outdir, config_key)
+        store = None
+        if opt_storemode != 'none':
+            store = ContentStore(opt_outdir, opt_storemode, config_key)
+        metrics = None
+        if opt_metricsfile != None:
+            metrics = MetricsWriter(opt_metricsfile)
+            backend.measure_startup()
+        scratch = None
+        if opt_scratchdir != None:
+            scratch = ScratchSpace(opt_scratchdir, opt_scratchlimit)
+        progress = None
+        if opt_progress:
+            progress = ProgressDashboard(opt_jobs)
+            backend.progress = progress
+        try:
+            retry = RetryPolicy(opt_retries, opt_retrydelay, opt_hostinterval)
+            snapshot = None
+            # playlists whose playlist file is rebuilt from the manifest, None for all
+            selected = None
+            if opt_sync:
+                songs, positions, snapshot, selected = sync_catalogue(songs, manifest, opt_outdir, opt_outputformat, opt_prune)
+            # only some songs of each playlist are downloaded, so their playlist files are rebuilt from the manifest instead
+            partial = args.retry_failed or opt_sync or opt_shard != None
+            # every song of the catalogue is in the run, so the songs that are not were removed from it
+            complete = not partial and opt_playlists == None and not opt_ignore_noplaylist
+            if progress != None:
+                progress.start()
+            try:
+                download_songs(songs, opt_outdir, opt_outputformat, opt_createplaylistfile and not partial, backend, opt_jobs, opt_playlistjobs,
+                               manifest, store, metrics, transcoder, opt_transcodejobs, opt_prefetch, retry, failed, positions,
+                               warm.executor(opt_jobs) if warm != None else None, progress, opt_shard, opt_batch, scratch)
+            finally:
+                if progress != None:
+                    progress.stop()
+            if complete and manifest != None:
+                manifest.mark_removed()
+            if snapshot != None:
+                # songs that failed are left out, so the next --sync tries them again
+                manifest.save_snapshot({key: position for key, position in snapshot.items() if key not in failed.entries})
+            if opt_shard != None and opt_createplaylistfile:
+                Debug.print(f'Only part {opt_shard[0] + 1}/{opt_shard[1]} of the catalogue was downloaded. Use --merge-shards to write the playlist files.', 0)
+            elif partial and opt_createplaylistfile and manifest != None:
+                rebuild_playlistfiles(manifest, opt_outdir, selected)
+        finally:
+            failed.save()
+            backend.progress = None
+            # the backends of --serve are kept for the next job
+            if warm == None or opt_splittranscode:
+                backend.close()
+            if source_configpath != None:
+                os.remove(source_configpath)
+            if manifest != None:
+                manifest.close()
+            if metrics != None:
+                metrics.close()
+            if scratch != None:
+                scratch.close()
+        # songs are parsed while downloading, so the stats are only complete now
+        if stats != None:
+            print_parsestats(stats, True)
+        if transcoder != None:
+            transcoder.print_summary()
+        if metrics != None:
+            metrics.print_summary()
+    elif args.rebuild_playlists:
+        manifest = DownloadManifest(opt_outdir, manifest_config_key(opt_conf_location, opt_backend))
+        with manifest:
+            rebuild_playlistfiles(manifest, opt_outdir)
+    elif args.merge_shards != None:
+        merge_shards(args.merge_shards, opt_outdir, manifest_config_key(opt_conf_location, opt_backend))
+
+    if linkcache != None:
+        linkcache.close()
+
+# total, skipped_total, skipped_noplaylist, ignore_noplaylist, skipped_notallowed, allowed_playlists, nolink, skipped_dupes, skip_dupes, resolve_links, resolved
 def print_parsestats(stats, isdownload=False):
     verbosity = 0
     Debug.print('\nSTATS:\n-----------------', verbosity)
@@ -170,26 +479,98 @@ def print_parsestats(stats, isdownload=False):
         Debug.print(f"--skip-duplicates is set: {stats['skipped_dupes']}/{stats['total']} duplicates were skipped.", verbosity)
     if stats['skipped_skip'] > 0:
         Debug.print(f"One or more `SKIP' keywords were found. {stats['skipped_skip']}/{stats['total']} were skipped.", verbosity)
+    if stats['resolve_links']:
+        Debug.print(f"--resolve-links is set: {stats['resolved']}/{stats['nolink']} songs without a link were resolved.", verbosity)
     if isdownload:
-        if stats['nolink'] > 0:
-            Debug.print(f"{stats['nolink']}/{stats['total']} do not have a link specified and were skipped.", verbosity)
+        if stats['nolink'] - stats['resolved'] > 0:
+            Debug.print(f"{stats['nolink'] - stats['resolved']}/{stats['total']} do not have a link specified and were skipped.", verbosity)
         Debug.print(f"{stats['skipped_total_dl']}/{stats['total']} songs were skipped overall, leaving {stats['total'] - stats['skipped_total_dl']} remaining.", verbosity)
     else:
-        if stats['nolink'] > 0:
-            Debug.print(f"Warning: {stats['nolink']} songs did not have a link specified, and will be skipped if trying to download.", verbosity)
+        if stats['nolink'] - stats['resolved'] > 0:
+            Debug.print(f"Warning: {stats['nolink'] - stats['resolved']} songs did not have a link specified, and will be skipped if trying to download.", verbosity)
         Debug.print(f"{stats['skipped_total']}/{stats['total']} songs were skipped overall, leaving {stats['total'] - stats['skipped_total']} remaining.", verbosity)
     Debug.print('-----------------\n', verbosity)
 
+def new_parsestats(allowed_playlists=None, ignore_noplaylist=False, skip_dupes=False):
+    # filled in by the parsers while the songs are read, so it is only complete once all songs are consumed
+    return {
+        'total': 0,
+        'skipped_total': 0,
+        'skipped_total_dl': 0,
+        'skipped_noplaylist': 0,
+        'ignore_noplaylist': ignore_noplaylist,
+        'skipped_notallowed': 0,
+        'allowed_playlists': allowed_playlists,
+        'nolink': 0,
+        'skipped_dupes': 0,
+        'skip_dupes': skip_dupes,
+        'skipped_skip': 0,
+        'resolve_links': False,
+        'resolved': 0
+    }
+
+FEATURING_RE = re.compile('\\s*[\\(\\[]\\s*(?:feat\\.?|ft\\.?|featuring)\\s+([^\\)\\]]*)[\\)\\]]|\\s+(?:feat\\.?|ft\\.?|featuring)\\s+(.*)$', re.IGNORECASE)
+# only explicit list separators, `/', `+' and `and' are part of names such as `AC/DC' or `Florence and the Machine'
+ARTIST_SEPARATOR_RE = re.compile('\\s*(?:,|;|&|\\bfeat\\b\\.?|\\bft\\b\\.?|\\bfeaturing\\b)\\s*', re.IGNORECASE)
+# the artists after `feat.' in a title are a list, which can also be written as `feat. A and B'
+FEATURING_SEPARATOR_RE = re.compile('\\s*(?:,|;|&|\\band\\b)\\s*', re.IGNORECASE)
+
+def normalise_str(str):
+    return ' '.join(str.casefold().split())
+
+def song_key(title, artists):
+    # `Song (feat. B)' by `A' is the same song as `Song' by `A & B' or `a, b'.
+    # The artists are compared as a set, so their order and the list separator (`,', `;', `&' or feat.) do not matter.
+    featuring = []
+    def remove_featuring(match):
+        featuring.append(match.group(1) if match.group(1) != None else match.group(2))
+        return ''
+    title = FEATURING_RE.sub(remove_featuring, title)
+    artists = ARTIST_SEPARATOR_RE.split(artists)
+    for part in featuring:
+        artists += FEATURING_SEPARATOR_RE.split(part)
+    return (normalise_str(title), frozenset(normalise_str(artist) for artist in artists if artist.strip() != ''))
+
+# Hash index of the songs that were parsed, to find duplicates in constant time per song.
+# A song is a duplicate if a song with the same title+artists (see song_key) or the same link was already found,
+# in the same playlist (scope 'playlist') or in any playlist (scope 'global').
+class DuplicateIndex:
+    def __init__(self, scope='playlist'):
+        self.scope = scope
+        self.songs = set()
+        self.links = set()
+
+    def check(self, playlist, title, artists, link):
+        # returns whether the song is a duplicate, and adds it to the index if it is not
+        return self.check_key(playlist, song_key(title, artists), link)
+
+    def check_key(self, playlist, key, link):
+        # same as check, with the key from song_key already computed
+        if self.scope != 'global':
+            key = (playlist, key)
+            link = (playlist, link) if link != None and link != "" else None
+        elif link == "":
+            link = None
+        if key in self.songs:
+            Debug.print(f'Song with same title and artists already found. Skipping duplicate song.', 2)
+            return True
+        if link != None and link in self.links:
+            Debug.print(f'Song with same link already found. Skipping duplicate song.', 2)
+            return True
+        self.songs.add(key)
+        if link != None:
+            self.links.add(link)
+        return False
+
+
 def parse_txtheader(lines):
-    parsing_header = True
+    # reads lines from the iterator up to and including `END HEADER', so the songs can be read from the same iterator
     playlists = []
     reading_index = False
 
     # parse header of the file
-    i = 0
-    while parsing_header and i < len(lines):
-        line = lines[i].strip()
-        i += 1
+    for line in lines:
+        line = line.strip()
 
         # parse the header of the file
         if len(line) == 0 or line[0] == '#':
@@ -203,15 +584,32 @@ def parse_txtheader(lines):
         elif line == 'END HEADER':
             if reading_index:
                 Debug.print('End of header encountered before end of index. Stopping reading playlist index.', 2)
-            parsing_header = False
+            break
     Debug.print('Playlists found in header:', 1)
     for playlist in playlists:
         Debug.print(f'- {playlist}', 1)
     Debug.print('\n', 1)
-    return (playlists, i)
-
-def parse_txtsongs(lines, i, allowed_playlists=None, ignore_noplaylist=False, skip_dupes=False):
-    songs = {"UNLISTED": []}
+    return playlists
+
+def split_songfields(trimmed_line):
+    # split fields. Double quotes don't have to be escaped, the csv writer already quotes them.
+    metadata = list(filter(lambda x: len(x) != 0, trimmed_line.split("   ")))
+    # parse metadata
+    title = metadata[0].strip()
+    artists = ""
+    if len(metadata) > 1:
+        artists = metadata[1].strip()
+    album = ""
+    if len(metadata) > 2:
+        album = metadata[2].strip()
+    link = ""
+    if len(metadata) > 3:
+        # dl link is specified in txt file
+        link = metadata[3].strip()
+    return (title, artists, album, link)
+
+def parse_txtsongs(lines, stats, allowed_playlists=None, ignore_noplaylist=False, duplicates=None):
+    # generator that yields the songs as they are read. The counts are added to stats when all lines are read.
     curr_playlist = ""
     total = 0
     nolink = 0
@@ -224,124 +622,231 @@ def parse_txtsongs(lines, i, allowed_playlists=None, ignore_noplaylist=False, sk
 
     skipping_songs = False
 
-    playlist_songs = []
-
-    while i < len(lines):
-        trimmed_line = lines[i].strip()
-        i += 1
+    try:
+        for line in lines:
+            trimmed_line = line.strip()
+
+            if trimmed_line[:8] == "PLAYLIST":
+                Debug.print("\nplaylist %s" % trimmed_line[9:], 2)
+                curr_playlist = trimmed_line[9:]
+                skipping_songs = False
+            elif trimmed_line == "SKIP":
+                skipping_songs = True
+            elif trimmed_line == "END SKIP":
+                skipping_songs = False
+            elif len(trimmed_line) != 0 and trimmed_line[0] != '#':
+                # line is not empty or comment
+
+                total += 1
+
+
+                title, artists, album, link = split_songfields(trimmed_line)
+                
+                if link == None or link == "":
+                    nolink += 1
+                
+                shouldSkip = False
+                if skipping_songs:
+                    Debug.print(f'Skipping song because SKIP keyword was encountered.', 2)
+                    skipped_skip += 1
+                    shouldSkip = True
+                
+                if curr_playlist == "" and ignore_noplaylist:
+                    Debug.print(f'Skipping song with no playlist.', 2)
+                    skipped_noplaylist += 1
+                    shouldSkip = True
 
-        if trimmed_line[:8] == "PLAYLIST":
-            Debug.print("\nplaylist %s" % trimmed_line[9:], 2)
-            curr_playlist = trimmed_line[9:].replace("\"", "\"\"")
-            playlist_songs = []
-            skipping_songs = False
-            songs[curr_playlist] = []
-        elif trimmed_line == "SKIP":
-            skipping_songs = True
-        elif trimmed_line == "END SKIP":
-            skipping_songs = False
-        elif len(trimmed_line) != 0 and trimmed_line[0] != '#':
-            # line is not empty or comment
-
-            total += 1
-
-
-            # escape double quotes to not break csv file and split fields
-            metadata = list(filter(lambda x: len(x) != 0, trimmed_line.replace("\"", "\"\"").split("   ")))
-            # parse metadata
-            title = metadata[0].strip()
-            artists = ""
-            if len(metadata) > 1:
-                artists = metadata[1].strip()
-            album = ""
-            if len(metadata) > 2:
-                album = metadata[2].strip()
-            link = ""
-            if len(metadata) > 3:
-                # dl link is specified in txt file
-                link = metadata[3].strip()
-            
-            if link == None or link == "":
-                nolink += 1
-            
-            shouldSkip = False
-            if skipping_songs:
-                Debug.print(f'Skipping song because SKIP keyword was encountered.', 2)
-                skipped_skip += 1
-                shouldSkip = True
-            
-            if curr_playlist == "" and ignore_noplaylist:
-                Debug.print(f'Skipping song with no playlist.', 2)
-                skipped_noplaylist += 1
-                shouldSkip = True
-
-            if curr_playlist != "" and allowed_playlists != None and curr_playlist not in allowed_playlists:
-                Debug.print(f'Skipping song that is not in allowed playlists.', 2)
-                skipped_notallowed += 1
-                shouldSkip = True
-            
-            if skip_dupes:
-                if (title + artists) in playlist_songs:
-                    Debug.print(f'Song with same title and artists already found. Skipping duplicate song in playlist.', 2)
+                if curr_playlist != "" and allowed_playlists != None and curr_playlist not in allowed_playlists:
+                    Debug.print(f'Skipping song that is not in allowed playlists.', 2)
+                    skipped_notallowed += 1
+                    shouldSkip = True
+                
+                # only songs that are not skipped otherwise are checked for and counted as duplicates
+                if not shouldSkip and duplicates != None and duplicates.check(curr_playlist, title, artists, link):
                     skipped_dupes += 1
                     shouldSkip = True
-                else:
-                    playlist_songs.append(title + artists)
-
-            
-
-            if shouldSkip:
-                Debug.print(f'Skipping song: {curr_playlist} | {title} | {artists} | {album} | {link}', 2)
-                skipped_total_dl += 1
-                skipped_total += 1
-                continue
-            elif link == None or link == "":
-                skipped_total_dl += 1
 
-
-            song = Song(title, artists, album, curr_playlist, link)
-            Debug.print(f"playlist: {song.playlist} | song: {song.title} | artists: {song.artists} | album: {song.album} | link: {song.link}", 2)
-            if curr_playlist == "":
-                songs["UNLISTED"].append(song)
-            else:
-                songs[song.playlist].append(song)
-    
-    stats = {
-        'total': total,
-        'skipped_total': skipped_total,
-        'skipped_total_dl': skipped_total_dl,
-        'skipped_noplaylist': skipped_noplaylist,
-        'ignore_noplaylist': ignore_noplaylist,
-        'skipped_notallowed': skipped_notallowed,
-        'allowed_playlists': allowed_playlists,
-        'nolink': nolink,
-        'skipped_dupes': skipped_dupes,
-        'skip_dupes': skip_dupes,
-        'skipped_skip': skipped_skip
+                if shouldSkip:
+                    Debug.print(f'Skipping song: {curr_playlist} | {title} | {artists} | {album} | {link}', 2)
+                    skipped_total_dl += 1
+                    skipped_total += 1
+                    continue
+                elif link == None or link == "":
+                    skipped_total_dl += 1
+
+
+                song = Song(title, artists, album, curr_playlist, link)
+                Debug.print(f"playlist: {song.playlist} | song: {song.title} | artists: {song.artists} | album: {song.album} | link: {song.link}", 2)
+                yield song
+    finally:
+        stats['total'] += total
+        stats['skipped_total'] += skipped_total
+        stats['skipped_total_dl'] += skipped_total_dl
+        stats['skipped_noplaylist'] += skipped_noplaylist
+        stats['skipped_notallowed'] += skipped_notallowed
+        stats['nolink'] += nolink
+        stats['skipped_dupes'] += skipped_dupes
+        stats['skipped_skip'] += skipped_skip
+
+
+def parse_playlistfilter(playlistfilter):
+    # comma-separated list of playlist names or indices
+    if playlistfilter == None:
+        return None
+    return [playlist.strip() for playlist in playlistfilter.split(',') if playlist.strip() != '']
+
+def parse_shard(shard):
+    # `K/N' -> (K - 1, N)
+    if shard == None:
+        return None
+    match = re.fullmatch('\\s*(\\d+)\\s*/\\s*(\\d+)\\s*', shard)
+    if match == None or not 1 <= int(match[1]) <= int(match[2]):
+        Debug.write(f"Invalid --shard `{shard}'. Use K/N with 1 <= K <= N, e.g. `2/4'.")
+        exit(1)
+    return (int(match[1]) - 1, int(match[2]))
+
+def in_shard(link, shard):
+    # a hash of the link instead of the position, so a song stays in the same part when songs are added or removed.
+    # Every copy of a link is in the same part, which keeps --store-mode working.
+    index, count = shard
+    return int(hashlib.sha1(link.encode('utf-8')).hexdigest(), 16) % count == index
+
+
+# Sidecar file next to a txt file with the byte offset, length and counts of every playlist, so --filter-playlists
+# can read only the selected playlists. It is rebuilt when the size or modification time of the txt file changes.
+TXTINDEX_VERSION = 1
+
+def txtindex_path(txtfile):
+    return f'{txtfile}.idx'
+
+def build_txtindex(txtfile, count_songs=True):
+    # count_songs: also count the songs of every playlist, which are only needed for the stats of the playlists that are not parsed
+    stat = os.stat(txtfile)
+    index = {
+        'version': TXTINDEX_VERSION,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'header_end': None,
+        'sections': []
     }
-    return (songs, stats)
-
-
+    section = None
+    skipping_songs = False
+    offset = 0
+    with open(txtfile, 'rb') as reader:
+        for raw_line in reader:
+            line_offset = offset
+            offset += len(raw_line)
+            if not count_songs and index['header_end'] != None and b'PLAYLIST' not in raw_line:
+                continue
+            trimmed_line = raw_line.decode('utf-8').strip()
+            if index['header_end'] == None:
+                if trimmed_line == 'END HEADER':
+                    index['header_end'] = offset
+                    # songs before the first playlist are unlisted
+                    section = {'name': None, 'offset': offset, 'length': 0, 'songs': 0, 'nolink': 0, 'skip': 0}
+                    index['sections'].append(section)
+                continue
 
-def read_txtfile(txtfile, allowed_playlists=None, use_indices=False, ignore_noplaylist=False, skip_dupes=False):
+            # the same rules as parse_txtsongs
+            if trimmed_line[:8] == "PLAYLIST":
+                section['length'] = line_offset - section['offset']
+                section = {'name': trimmed_line[9:], 'offset': line_offset, 'length': 0, 'songs': 0, 'nolink': 0, 'skip': 0}
+                index['sections'].append(section)
+                skipping_songs = False
+            elif trimmed_line == "SKIP":
+                skipping_songs = True
+            elif trimmed_line == "END SKIP":
+                skipping_songs = False
+            elif len(trimmed_line) != 0 and trimmed_line[0] != '#':
+                section['songs'] += 1
+                if split_songfields(trimmed_line)[3] == "":
+                    section['nolink'] += 1
+                if skipping_songs:
+                    section['skip'] += 1
+    if section != None:
+        section['length'] = offset - section['offset']
+    return index
+
+def load_txtindex(txtfile):
+    stat = os.stat(txtfile)
+    path = txtindex_path(txtfile)
+    try:
+        with open(path, 'r', encoding='utf-8') as reader:
+            index = json.load(reader)
+        if index.get('version') == TXTINDEX_VERSION and index['size'] == stat.st_size and index['mtime_ns'] == stat.st_mtime_ns:
+            return index
+    except (IOError, ValueError, KeyError) as err:
+        pass
+    Debug.print(f'Building playlist index of the txt file at {path}...', 1)
+    index = build_txtindex(txtfile)
+    try:
+        with open(path, 'w', encoding='utf-8') as writer:
+            json.dump(index, writer)
+    except IOError as err:
+        Debug.print(f"Playlist index could not be written, it will be rebuilt next time.\n{err}", 1)
+    return index
+
+def read_txtsection(txtfile, section):
+    with open(txtfile, 'rb') as reader:
+        reader.seek(section['offset'])
+        return reader.read(section['length']).decode('utf-8').splitlines()
+
+
+def read_catalogue(txtfile, csvfile, allowed_playlists=None, use_indices=False, ignore_noplaylist=False, skip_dupes=False, duplicate_scope='playlist'):
+    # the txt file is used if both are given
+    if txtfile != None:
+        return read_txtfile(txtfile, allowed_playlists, use_indices, ignore_noplaylist, skip_dupes, duplicate_scope)
+    return read_csvfile(csvfile, allowed_playlists, ignore_noplaylist, skip_dupes, duplicate_scope)
+
+def select_playlists(playlists, allowed_playlists, use_indices):
+    # the names of the playlists of --filter-playlists, looked up in the playlist overview of the header with -i. None if not filtered
+    if allowed_playlists == None:
+        return None
+    if use_indices:
+        try:
+            allowed_playlists = [playlists[int(x)] for x in allowed_playlists if int(x) < len(playlists)]
+        except ValueError as err:
+            Debug.write(f"--filter-playlists should be a comma-separated list of numbers when -i is set.\n{err}")
+            exit(1)
+    return set(allowed_playlists)
+
+def read_txtfile(txtfile, allowed_playlists=None, use_indices=False, ignore_noplaylist=False, skip_dupes=False, duplicate_scope='playlist', use_index=True):
+    # returns a generator of the songs, which reads the file while it is consumed, and the stats that are filled in meanwhile
     Debug.print('Reading from TXT...\n\n', 0)
-    lines = []
     try:
         reader = open(txtfile, 'r', encoding='utf-8')
     except IOError as err:
         Debug.print("Txt file could not be opened to read from.", 0)
         exit(3)
-    else:
-        with reader:
-            lines = reader.readlines()
-    
-
-    playlists, i = parse_txtheader(lines)
-    
-    if allowed_playlists != None and use_indices:
-        allowed_playlists = list(map(lambda x: playlists[int(x)] if int(x) < len(playlists) else None, allowed_playlists))
 
-    return parse_txtsongs(lines, i, allowed_playlists, ignore_noplaylist, skip_dupes)
+    playlists = parse_txtheader(reader)
+    allowed_playlists = select_playlists(playlists, allowed_playlists, use_indices)
+
+    stats = new_parsestats(allowed_playlists, ignore_noplaylist, skip_dupes)
+    duplicates = DuplicateIndex(duplicate_scope) if skip_dupes else None
+    if allowed_playlists != None and use_index:
+        reader.close()
+        return (read_txtsongs_indexed(txtfile, stats, allowed_playlists, ignore_noplaylist, duplicates), stats)
+    return (read_txtsongs(reader, stats, allowed_playlists, ignore_noplaylist, duplicates), stats)
+
+def read_txtsongs(reader, stats, allowed_playlists, ignore_noplaylist, duplicates):
+    with reader:
+        yield from parse_txtsongs(reader, stats, allowed_playlists, ignore_noplaylist, duplicates)
+
+def read_txtsongs_indexed(txtfile, stats, allowed_playlists, ignore_noplaylist, duplicates):
+    # only the unlisted songs and the allowed playlists are parsed. The other playlists are only counted, from the index.
+    index = load_txtindex(txtfile)
+    for section in index['sections']:
+        if section['name'] == None or section['name'] == "" or section['name'] in allowed_playlists:
+            yield from parse_txtsongs(read_txtsection(txtfile, section), stats, allowed_playlists, ignore_noplaylist, duplicates)
+        else:
+            Debug.print(f"Skipping {section['songs']} songs in playlist {section['name']} that is not in allowed playlists.", 2)
+            stats['total'] += section['songs']
+            stats['nolink'] += section['nolink']
+            stats['skipped_skip'] += section['skip']
+            stats['skipped_notallowed'] += section['songs']
+            stats['skipped_total'] += section['songs']
+            stats['skipped_total_dl'] += section['songs']
 
 
 def write_csvfile(csvfile, songs):
@@ -349,7 +854,7 @@ def write_csvfile(csvfile, songs):
     try:
         writer = open(csvfile, 'w', encoding='utf-8', newline='')
     except IOError as err:
-        print("csv file could not be opened to write to.")
+        Debug.write("csv file could not be opened to write to.")
         exit(4)
     else:
         with writer:
@@ -357,110 +862,232 @@ def write_csvfile(csvfile, songs):
             dictwriter.writeheader()
             csvwriter = csv.writer(writer)
             try:
-                for playlist in songs:
-                    for song in songs[playlist]:
-                        csvwriter.writerow([song.playlist, song.title, song.artists, song.album, song.link])
-                        Debug.print(f"playlist: {song.playlist} | song: {song.title} | artists: {song.artists} | album: {song.album} | link: {song.link}", 2)
+                for song in songs:
+                    csvwriter.writerow([song.playlist, song.title, song.artists, song.album, song.link])
+                    Debug.print(f"playlist: {song.playlist} | song: {song.title} | artists: {song.artists} | album: {song.album} | link: {song.link}", 2)
             except csv.Error as e:
                 sys.exit('file {}, line {}: {}'.format(csvfile, csvwriter.line_num, e))
 
 
-def read_csvfile(csvfile, allowed_playlists=None, ignore_noplaylist=False, skip_dupes=False):
-    Debug.print('Reading from CSV...\n\n', 0)
+# Txt sections are grouped in chunks of about this many bytes, to spread the work over the processes
+CONVERT_CHUNK_SIZE = 4 * 1024 * 1024
+
+def parse_txtchunk(txtfile, sections, allowed_playlists, ignore_noplaylist, skip_dupes, verbosity, quiet):
+    # runs in a worker process. Duplicates can only be found in order, so they are left to the main process,
+    # but the key of each song is already computed here.
+    Debug.verbosity = verbosity
+    Debug.quiet = quiet
+    stats = new_parsestats(allowed_playlists, ignore_noplaylist, skip_dupes)
+    rows = []
+    for section in sections:
+        if allowed_playlists == None or section['name'] == None or section['name'] == "" or section['name'] in allowed_playlists:
+            for song in parse_txtsongs(read_txtsection(txtfile, section), stats, allowed_playlists, ignore_noplaylist):
+                key = song_key(song.title, song.artists) if skip_dupes else None
+                rows.append((song.playlist, song.title, song.artists, song.album, song.link, key))
+        else:
+            stats['total'] += section['songs']
+            stats['nolink'] += section['nolink']
+            stats['skipped_skip'] += section['skip']
+            stats['skipped_notallowed'] += section['songs']
+            stats['skipped_total'] += section['songs']
+            stats['skipped_total_dl'] += section['songs']
+    return (rows, stats)
+
+def convert_txtfile(txtfile, csvfile, workers, allowed_playlists=None, use_indices=False, ignore_noplaylist=False, skip_dupes=False, duplicate_scope='playlist'):
+    # parses the txt file in chunks of whole playlists in a process pool, and writes the rows to the csv in the original order
+    Debug.print('Converting TXT to CSV...\n\n', 0)
     try:
-        reader = open(csvfile, 'r', encoding='utf-8', newline='')
+        reader = open(txtfile, 'r', encoding='utf-8')
     except IOError as err:
-        print("csv file could not be opened to read from.")
+        Debug.print("Txt file could not be opened to read from.", 0)
+        exit(3)
+    with reader:
+        playlists = parse_txtheader(reader)
+    allowed_playlists = select_playlists(playlists, allowed_playlists, use_indices)
+
+    # the index is only kept next to the txt file for --filter-playlists, the same as read_txtfile.
+    # Without a filter every playlist is parsed by the workers, so only the offsets of the playlists are needed.
+    index = load_txtindex(txtfile) if allowed_playlists != None else build_txtindex(txtfile, False)
+    chunks = []
+    chunk = []
+    chunk_size = 0
+    for section in index['sections']:
+        chunk.append(section)
+        chunk_size += section['length']
+        if chunk_size >= CONVERT_CHUNK_SIZE:
+            chunks.append(chunk)
+            chunk = []
+            chunk_size = 0
+    if len(chunk) > 0:
+        chunks.append(chunk)
+
+    stats = new_parsestats(allowed_playlists, ignore_noplaylist, skip_dupes)
+    duplicates = DuplicateIndex(duplicate_scope) if skip_dupes else None
+    try:
+        writer = open(csvfile, 'w', encoding='utf-8', newline='')
+    except IOError as err:
+        Debug.write("csv file could not be opened to write to.")
         exit(4)
-    else:
-        songs = {"UNLISTED": []}
-        total = 0
-        skipped_total = 0
-        skipped_total_dl = 0
-        nolink = 0
-        skipped_noplaylist = 0
-        skipped_notallowed = 0
-        skipped_dupes = 0
-
-        song_dict = {}
-
-        with reader:
-            csvreader = csv.DictReader(reader, ['playlist', 'title', 'artists', 'album', 'link'])
-            try:
-                # skip header
-                next(csvreader, None)
-                for row in csvreader:
-                    total += 1
-                    playlist = row['playlist']
-                    title = row['title']
-                    artists = row['artists']
-                    album = row['album']
-                    link = row['link']
-
-                    if link == None or link == "":
-                        nolink += 1
-                    
-
-                    shouldskip = False
-
-                    
-                    if playlist == None and ignore_noplaylist:
-                        Debug.print(f'Skipping song with no playlist.', 2)
-                        skipped_noplaylist += 1
-                        shouldskip = True
-                    if playlist != None and allowed_playlists != None and playlist not in allowed_playlists:
-                        Debug.print(f'Skipping song that is not in allowed playlists.', 2)
-                        skipped_notallowed += 1
-                        shouldskip = True
-                    
-                    # store songs into dictionary to catch duplicates (but only add them if not skipping)
-                    if playlist not in song_dict:
-                        if not shouldskip:
-                            song_dict[playlist] = [title + artists]
-                    elif (title + artists) in song_dict[playlist] and skip_dupes:
-                        Debug.print(f'Song with same title and artists already found. Skipping duplicate song in playlist.', 2)
-                        skipped_dupes += 1
-                        shouldskip = True
-                    elif not shouldskip:
-                        song_dict[playlist].append(title + artists)
-                    
-                    if shouldskip:
-                        Debug.print(f'Skipping song: {playlist} | {title} | {artists} | {album} | {link}', 2)
-                        skipped_total_dl += 1
-                        skipped_total += 1
-                        continue
-                    elif link == None or link == "":
-                        skipped_total_dl += 1
-                    
-
-                    song = Song(title, artists, album, playlist, link)
-                    if playlist == None or playlist == "":
-                        songs["UNLISTED"].append(song)
+    with writer, ProcessPoolExecutor(max_workers=workers) as executor:
+        csvwriter = csv.writer(writer)
+        csvwriter.writerow(['playlist', 'title', 'artists', 'album', 'link'])
+        pending = deque()
+        chunks = iter(chunks)
+        while True:
+            # keep a few chunks per process in flight, and write them in order
+            for chunk in chunks:
+                pending.append(executor.submit(parse_txtchunk, txtfile, chunk, allowed_playlists, ignore_noplaylist, skip_dupes, Debug.verbosity, Debug.quiet))
+                if len(pending) >= workers * 2:
+                    break
+            if len(pending) == 0:
+                break
+            rows, chunk_stats = pending.popleft().result()
+            for key in chunk_stats:
+                if type(chunk_stats[key]) == int:
+                    stats[key] += chunk_stats[key]
+            if duplicates != None:
+                unique_rows = []
+                for row in rows:
+                    if duplicates.check_key(row[0], row[5], row[4]):
+                        # the worker counted it as a song to keep, or as skipped for downloading if it has no link
+                        stats['skipped_dupes'] += 1
+                        stats['skipped_total'] += 1
+                        if row[4] != "":
+                            stats['skipped_total_dl'] += 1
                     else:
-                        if playlist not in songs:
-                            songs[playlist] = []
-                        songs[playlist].append(song)
+                        unique_rows.append(row)
+                rows = unique_rows
+            try:
+                csvwriter.writerows(row[:5] for row in rows)
             except csv.Error as e:
-                sys.exit('file {}, line {}: {}'.format(csvfile, csvreader.line_num, e))
-        
-        stats = {
-            'total': total,
-            'skipped_total': skipped_total,
-            'skipped_total_dl': skipped_total_dl,
-            'skipped_noplaylist': skipped_noplaylist,
-            'ignore_noplaylist': ignore_noplaylist,
-            'skipped_notallowed': skipped_notallowed,
-            'allowed_playlists': allowed_playlists,
-            'nolink': nolink,
-            'skipped_dupes': skipped_dupes,
-            'skip_dupes': skip_dupes,
-            'skipped_skip': 0 # CSV file cannot contain SKIP keyword, so this is always 0
-        }
-        return (songs, stats)
+                sys.exit('file {}, line {}: {}'.format(csvfile, csvwriter.line_num, e))
+    return stats
+
+
+def write_txtfile(txtfile, songs):
+    # the txt format has every playlist in one section, so all songs are grouped by playlist before writing
+    Debug.print('Writing to TXT...\n\n', 0)
+    playlists = {"": []}
+    for song in songs:
+        playlist = song.playlist if song.playlist != None else ""
+        if playlist not in playlists:
+            playlists[playlist] = []
+        playlists[playlist].append(song)
+
+    inexact = 0
+    def format_song(song):
+        nonlocal inexact
+        fields = [song.title, song.artists, song.album, song.link]
+        while len(fields) > 1 and fields[-1] == "":
+            fields.pop()
+        # empty fields in between, fields with 3 spaces, or titles that look like a keyword or comment are read back differently
+        if "" in fields or any("   " in field for field in fields) or song.title[:1] == '#' or song.title[:8] == "PLAYLIST" or song.title in ("SKIP", "END SKIP"):
+            inexact += 1
+            Debug.print(f"Song cannot be written exactly in the txt format: {song.playlist} | {song.title} | {song.artists} | {song.album} | {song.link}", 1)
+        return '   '.join(fields) + '\n'
+
+    try:
+        writer = open(txtfile, 'w', encoding='utf-8')
+    except IOError as err:
+        Debug.write("Txt file could not be opened to write to.")
+        exit(3)
+    with writer:
+        writer.write('INDEX PLAYLISTS\n')
+        writer.writelines(f'- {playlist}\n' for playlist in playlists if playlist != "")
+        writer.write('END INDEX\n\nEND HEADER\n\n')
+        for playlist in playlists:
+            if playlist != "":
+                writer.write(f'\nPLAYLIST {playlist}\n')
+            writer.writelines(format_song(song) for song in playlists[playlist])
+    if inexact > 0:
+        Debug.print(f"Warning: {inexact} songs have empty fields or text that cannot be written exactly in the txt format. Use -v to list them.", 0)
+
+
+def read_csvfile(csvfile, allowed_playlists=None, ignore_noplaylist=False, skip_dupes=False, duplicate_scope='playlist'):
+    # returns a generator of the songs, which reads the file while it is consumed, and the stats that are filled in meanwhile
+    Debug.print('Reading from CSV...\n\n', 0)
+    try:
+        reader = open(csvfile, 'r', encoding='utf-8', newline='')
+    except IOError as err:
+        Debug.write("csv file could not be opened to read from.")
+        exit(4)
+    if allowed_playlists != None:
+        allowed_playlists = set(allowed_playlists)
+    # CSV file cannot contain SKIP keyword, so skipped_skip is always 0
+    stats = new_parsestats(allowed_playlists, ignore_noplaylist, skip_dupes)
+    duplicates = DuplicateIndex(duplicate_scope) if skip_dupes else None
+    return (parse_csvsongs(reader, csvfile, stats, allowed_playlists, ignore_noplaylist, duplicates), stats)
+
+def parse_csvsongs(reader, csvfile, stats, allowed_playlists=None, ignore_noplaylist=False, duplicates=None):
+    total = 0
+    skipped_total = 0
+    skipped_total_dl = 0
+    nolink = 0
+    skipped_noplaylist = 0
+    skipped_notallowed = 0
+    skipped_dupes = 0
 
+    with reader:
+        csvreader = csv.DictReader(reader, ['playlist', 'title', 'artists', 'album', 'link'])
+        try:
+            # skip header
+            next(csvreader, None)
+            for row in csvreader:
+                total += 1
+                playlist = row['playlist']
+                title = row['title']
+                artists = row['artists']
+                album = row['album']
+                link = row['link']
+
+                if link == None or link == "":
+                    nolink += 1
+                
+
+                shouldskip = False
+
+                
+                if playlist == None and ignore_noplaylist:
+                    Debug.print(f'Skipping song with no playlist.', 2)
+                    skipped_noplaylist += 1
+                    shouldskip = True
+                if playlist != None and allowed_playlists != None and playlist not in allowed_playlists:
+                    Debug.print(f'Skipping song that is not in allowed playlists.', 2)
+                    skipped_notallowed += 1
+                    shouldskip = True
+                
+                # only songs that are not skipped otherwise are checked for and counted as duplicates
+                if not shouldskip and duplicates != None and duplicates.check(playlist, title, artists, link):
+                    skipped_dupes += 1
+                    shouldskip = True
+                
+                if shouldskip:
+                    Debug.print(f'Skipping song: {playlist} | {title} | {artists} | {album} | {link}', 2)
+                    skipped_total_dl += 1
+                    skipped_total += 1
+                    continue
+                elif link == None or link == "":
+                    skipped_total_dl += 1
+                
+
+                yield Song(title, artists, album, playlist, link)
+        except csv.Error as e:
+            sys.exit('file {}, line {}: {}'.format(csvfile, csvreader.line_num, e))
+        finally:
+            stats['total'] += total
+            stats['skipped_total'] += skipped_total
+            stats['skipped_total_dl'] += skipped_total_dl
+            stats['skipped_noplaylist'] += skipped_noplaylist
+            stats['skipped_notallowed'] += skipped_notallowed
+            stats['nolink'] += nolink
+            stats['skipped_dupes'] += skipped_dupes
+
+
+FILE_STRIP_RE = re.compile('["\\?\\*<>]')
+FILE_SEPARATOR_RE = re.compile("[\\\\\\|\\/]")
 
 def filter_file_str(str):
-    return re.sub("[\\\\\\|\\/]", " - ", re.sub('["\\?\\*<>]', "", str)).strip()
+    return FILE_SEPARATOR_RE.sub(" - ", FILE_STRIP_RE.sub("", str)).strip()
 
 def generate_playlistdir(playlist):
     if playlist != "" and playlist != "UNLISTED":
@@ -471,7 +1098,17 @@ def generate_playlistdir(playlist):
         return playlist_dir
     return ""
 
+def song_playlist(song):
+    return song.playlist if song.playlist != None and song.playlist != "" else "UNLISTED"
 
+def find_playlistdir(manifest, playlist):
+    # reuse the folder of an earlier run, which matters for generated (random) playlist folder names
+    playlistdir = None
+    if manifest != None:
+        playlistdir = manifest.playlistdir(playlist)
+    if playlistdir == None:
+        playlistdir = generate_playlistdir(playlist)
+    return playlistdir
 
 
 def create_playlistfile(playlist, songpaths, playlistdir, m3ufilename):
@@ -479,7 +1116,7 @@ def create_playlistfile(playlist, songpaths, playlistdir, m3ufilename):
         return
     Debug.print("\nCreating playlist file...")
     if m3ufilename == "unlisted":
-        print('WARNING: This playlist is called "unlisted". All unlisted songs will be put into this playlist file too, and thus might overwrite anything that might be in here, or vice versa.')
+        Debug.write('WARNING: This playlist is called "unlisted". All unlisted songs will be put into this playlist file too, and thus might overwrite anything that might be in here, or vice versa.')
     try:
         if m3ufilename == "" or m3ufilename == None:
             m3ufilename = 'unlisted'
@@ -487,7 +1124,7 @@ def create_playlistfile(playlist, songpaths, playlistdir, m3ufilename):
         Debug.print(f"Playlist file stored at: {m3u_path}\n", 0)
         writer = open(m3u_path, 'w', encoding='utf-8')
     except IOError as err:
-        print(f"m3u8 file could not be opened to write to.\n{err}")
+        Debug.write(f"m3u8 file could not be opened to write to.\n{err}")
     else:
         with writer:
             writer.write(f"#EXTM3U\n#EXTENC:UTF-8\n#PLAYLIST:{playlist}\n")
@@ -496,88 +1133,2476 @@ def create_playlistfile(playlist, songpaths, playlistdir, m3ufilename):
 
 
 
-def download_songs(songs, outdir, outputformat, createplaylistfile, ytdlpcmd, ffmpegpath, configpath):
-    Debug.print("Starting download...\n\n")
-    errors = 0
-    total_songs = 0
-    for playlist in songs:
-        playlist_songpaths = []
-        playlistdir = generate_playlistdir(playlist)
-        full_playlistdir = os.path.join(outdir, playlistdir)
-        for song in songs[playlist]:
-            if song.link != None and song.link != "":
-                total_songs += 1
-                file_name = parse_outputformat(outputformat, song)
-
-                returncode, output_filename = run_ytdlp_on_song(song, full_playlistdir, file_name, ytdlpcmd, ffmpegpath, configpath)
-                if returncode != 0:
-                    errors += 1
-                    Debug.print(f'An error (code {returncode}) occurred downloading song: {song.title} | {song.artists} | {song.album} | {song.link}', 1)
-                elif output_filename != None:
-                    playlist_songpaths.append(output_filename)
+def manifest_config_key(configpath, backend):
+    # songs downloaded with another yt-dlp config (e.g. a different audio format) are not the same file
+    key = hashlib.sha1()
+    try:
+        with open(configpath, 'rb') as reader:
+            key.update(reader.read())
+    except IOError as err:
+        Debug.print(f"yt-dlp config could not be read for the download manifest: {err}", 2)
+    # placeholder files from the fake backend should never count as downloaded songs
+    if backend == 'fake':
+        key.update(b'\0fake')
+    return key.hexdigest()
+
+
+# Sqlite database in the output directory that records every downloaded song, keyed by playlist folder, link,
+# file name from the output format and yt-dlp config. Songs whose file is still on disk with the same size and
+# modification time are skipped on the next run. Only used from the thread that schedules the downloads.
+class DownloadManifest:
+    FILENAME = '.song_downloader.sqlite3'
+
+    def __init__(self, outdir, config_key=''):
+        os.makedirs(outdir, exist_ok=True)
+        self.outdir = outdir
+        self.config_key = config_key
+        self.db = sqlite3.connect(os.path.join(outdir, self.FILENAME))
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS songs (
+            playlistdir TEXT NOT NULL,
+            link TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            config TEXT NOT NULL,
+            playlist TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            title TEXT,
+            artists TEXT,
+            album TEXT,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            PRIMARY KEY (playlistdir, link, filename, config)
+        )''')
+        # the songs of a playlist are looked up by --sync and the playlist files, which would otherwise scan the whole table for every song
+        self.db.execute('CREATE INDEX IF NOT EXISTS songs_playlist ON songs (playlist, link, config)')
+        # metadata of links fetched with --prefetch, and how long they took to download
+        self.db.execute('''CREATE TABLE IF NOT EXISTS metadata (
+            link TEXT PRIMARY KEY,
+            duration REAL,
+            filesize INTEGER,
+            fetched REAL NOT NULL,
+            download_seconds REAL
+        )''')
+        # the catalogue of the last --sync, to find the songs that were added, removed or moved since
+        self.db.execute('''CREATE TABLE IF NOT EXISTS snapshot (
+            playlist TEXT NOT NULL,
+            link TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (playlist, link)
+        )''')
+        # the songs of the current run with their position, to find the songs that were removed from the catalogue since the last run
+        self.db.execute('''CREATE TEMP TABLE seen (
+            playlist TEXT NOT NULL,
+            link TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (playlist, link)
+        )''')
+        self.db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def playlistdir(self, playlist):
+        row = self.db.execute('SELECT playlistdir FROM songs WHERE playlist = ? LIMIT 1', (playlist,)).fetchone()
+        return row[0] if row != None else None
+
+    def lookup(self, playlist, playlistdir, position, song, filename):
+        row = self.db.execute('SELECT path, size, mtime_ns, position FROM songs WHERE playlistdir = ? AND link = ? AND filename = ? AND config = ?',
+                              (playlistdir, song.link, filename, self.config_key)).fetchone()
+        if row == None:
+            return None
+        path, size, mtime_ns, old_position = row
+        try:
+            stat = os.stat(os.path.join(self.outdir, playlistdir, path))
+        except OSError:
+            return None
+        if stat.st_size != size or stat.st_mtime_ns != mtime_ns:
+            return None
+        if old_position != position:
+            self.db.execute('UPDATE songs SET position = ? WHERE playlistdir = ? AND link = ? AND filename = ? AND config = ?',
+                            (position, playlistdir, song.link, filename, self.config_key))
+            self.db.commit()
+        return path
+
+    def record(self, playlist, playlistdir, position, song, filename, path):
+        try:
+            stat = os.stat(os.path.join(self.outdir, playlistdir, path))
+        except OSError as err:
+            Debug.print(f"Downloaded file could not be found to add to the download manifest: {err}", 1)
+            return
+        self.db.execute('INSERT OR REPLACE INTO songs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (playlistdir, song.link, filename, self.config_key, playlist, position,
+                         song.title, song.artists, song.album, path, stat.st_size, stat.st_mtime_ns))
+        self.db.commit()
+
+    def metadata(self, links):
+        # link -> (duration, filesize) for the links that were fetched before
+        metadata = {}
+        for i in range(0, len(links), 500):
+            batch = links[i:i + 500]
+            query = f"SELECT link, duration, filesize FROM metadata WHERE link IN ({', '.join('?' * len(batch))})"
+            for link, duration, filesize in self.db.execute(query, batch):
+                metadata[link] = (duration, filesize)
+        return metadata
+
+    def record_metadata(self, metadata):
+        now = time.time()
+        self.db.executemany('INSERT INTO metadata (link, duration, filesize, fetched) VALUES (?, ?, ?, ?) ' +
+                            'ON CONFLICT (link) DO UPDATE SET duration = excluded.duration, filesize = excluded.filesize, fetched = excluded.fetched',
+                            [(link, duration, filesize, now) for link, (duration, filesize) in metadata.items()])
+        self.db.commit()
+
+    def record_download_time(self, link, seconds):
+        self.db.execute('UPDATE metadata SET download_seconds = ? WHERE link = ?', (seconds, link))
+        self.db.commit()
+
+    def download_rate(self):
+        # seconds it took to download one second of audio, over all earlier downloads with a known duration
+        row = self.db.execute('SELECT SUM(download_seconds), SUM(duration) FROM metadata WHERE download_seconds IS NOT NULL AND duration > 0').fetchone()
+        if row == None or row[1] == None:
+            return None
+        return row[0] / row[1]
+
+    def files(self, playlist, link):
+        # (playlistdir, filename, path) of every file of the link in the playlist, downloaded with this config
+        return self.db.execute('SELECT playlistdir, filename, path FROM songs WHERE playlist = ? AND link = ? AND config = ?',
+                               (playlist, link, self.config_key)).fetchall()
+
+    def remove(self, playlist, link):
+        self.db.execute('DELETE FROM songs WHERE playlist = ? AND link = ? AND config = ?', (playlist, link, self.config_key))
+        self.db.commit()
+
+    def entries(self):
+        # every downloaded song as (playlistdir, link, filename, config, playlist, position, title, artists, album, path)
+        return self.db.execute('SELECT playlistdir, link, filename, config, playlist, position, title, artists, album, path FROM songs').fetchall()
+
+    def record_entries(self, entries):
+        # entries of another manifest (see entries()) whose files are now in this output directory. Returns the number of songs that were found.
+        rows = []
+        for entry in entries:
+            try:
+                stat = os.stat(os.path.join(self.outdir, entry[0], entry[9]))
+            except OSError as err:
+                Debug.print(f"File of the song could not be found to add to the download manifest: {err}", 1)
+                continue
+            rows.append(tuple(entry) + (stat.st_size, stat.st_mtime_ns))
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO songs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def set_positions(self, positions):
+        # positions: (playlist, link, position). Songs that are no longer in the catalogue get position -1, and are left out of the playlist files.
+        self.db.executemany('UPDATE songs SET position = ? WHERE playlist = ? AND link = ? AND config = ?',
+                            [(position, playlist, link, self.config_key) for playlist, link, position in positions])
+        self.db.commit()
+
+    def see(self, playlist, link, position):
+        self.db.execute('INSERT OR REPLACE INTO seen VALUES (?, ?, ?)', (playlist, link, position))
+
+    def mark_removed(self):
+        # after a run over the whole catalogue: songs of this config that were not in it get position -1 and are left out of the playlist files,
+        # the others get their position in this run (a song that failed keeps its row from an earlier run)
+        with self.db:
+            self.db.execute('UPDATE songs SET position = COALESCE((SELECT seen.position FROM seen WHERE seen.playlist = songs.playlist AND seen.link = songs.link), -1) ' +
+                            'WHERE config = ? AND playlist != ?', (self.config_key, ContentStore.DIRNAME))
+
+    def removed(self):
+        # (playlist, link) of the songs that were left in the manifest after they were removed from the catalogue
+        return self.db.execute('SELECT DISTINCT playlist, link FROM songs WHERE position < 0 AND config = ?', (self.config_key,)).fetchall()
+
+    def snapshot(self):
+        # (playlist, link) -> position
+        return {(playlist, link): position for playlist, link, position in self.db.execute('SELECT playlist, link, position FROM snapshot')}
+
+    def downloaded_positions(self):
+        # (playlist, link) -> position of the songs of this config that are in the catalogue and still on disk
+        positions = {}
+        for playlist, link, playlistdir, path, position in self.db.execute('SELECT playlist, link, playlistdir, path, position FROM songs ' +
+                                                                           'WHERE position >= 0 AND config = ? AND playlist != ?',
+                                                                           (self.config_key, ContentStore.DIRNAME)):
+            if os.path.lexists(os.path.join(self.outdir, playlistdir, path)):
+                positions[(playlist, link)] = position
+        return positions
+
+    def save_snapshot(self, snapshot):
+        with self.db:
+            self.db.execute('DELETE FROM snapshot')
+            self.db.executemany('INSERT INTO snapshot VALUES (?, ?, ?)', [(playlist, link, position) for (playlist, link), position in snapshot.items()])
+
+    def playlists(self, selected=None):
+        # (playlist, playlistdir, [paths]) in the order of the songs in the playlist, only for files of this config that are still on disk
+        # and songs still in the catalogue (see mark_removed and --sync). selected: only these playlists, or all if None
+        playlists = {}
+        for playlist, playlistdir, path in self.db.execute('SELECT playlist, playlistdir, path FROM songs WHERE playlistdir != ? AND position >= 0 AND config = ? ' +
+                                                           'ORDER BY playlist, position', (ContentStore.DIRNAME, self.config_key)):
+            if selected != None and playlist not in selected:
+                continue
+            if playlist not in playlists:
+                playlists[playlist] = (playlistdir, [], set())
+            paths, listed = playlists[playlist][1:]
+            if path not in listed and os.path.exists(os.path.join(self.outdir, playlistdir, path)):
+                paths.append(path)
+                listed.add(path)
+        return [(playlist, playlistdir, paths) for playlist, (playlistdir, paths, listed) in playlists.items()]
+
+    def close(self):
+        self.db.close()
+
+
+# Folder in the output directory where every link is downloaded only once, named by a hash of the link and yt-dlp config.
+# Playlist folders get a hardlink or symlink to the stored file, or only reference it in the playlist file (mode 'm3u').
+class ContentStore:
+    DIRNAME = '.store'
+
+    def __init__(self, outdir, mode, config_key):
+        self.dir = os.path.join(outdir, self.DIRNAME)
+        self.mode = mode
+        self.config_key = config_key
+
+    def name(self, song):
+        return hashlib.sha1(f'{self.config_key}\0{song.link}'.encode('utf-8')).hexdigest()[:20]
+
+    def link(self, stored_file, full_playlistdir, file_name):
+        # returns the path of the song relative to the playlist folder
+        stored_path = os.path.join(self.dir, stored_file)
+        # the playlist folder also has to exist for a relative path through it to resolve
+        os.makedirs(full_playlistdir, exist_ok=True)
+        if self.mode == 'm3u':
+            return os.path.relpath(stored_path, full_playlistdir)
+        link_name = file_name + os.path.splitext(stored_file)[1]
+        link_path = os.path.join(full_playlistdir, link_name)
+        if os.path.lexists(link_path):
+            os.remove(link_path)
+        try:
+            if self.mode == 'hardlink':
+                os.link(stored_path, link_path)
             else:
-                Debug.print(f'Skipping song with no download link: {song.title} | {song.artists} | {song.album}', 2)
-        if createplaylistfile:
-            create_playlistfile(playlist, playlist_songpaths, full_playlistdir, playlistdir)
-    Debug.print(f'\n{total_songs - errors}/{total_songs} songs were downloaded correctly.\n', 0)
-
+                os.symlink(os.path.relpath(stored_path, full_playlistdir), link_path)
+        except OSError as err:
+            # e.g. the store is on another drive, or symlinks are not allowed on Windows
+            Debug.print(f"Could not create {self.mode} for {link_path}, copying the file instead: {err}", 1)
+            shutil.copy2(stored_path, link_path)
+        return link_name
+
+
+def rebuild_playlistfiles(manifest, outdir, selected=None):
+    playlists = manifest.playlists(selected)
+    if len(playlists) == 0 and selected == None:
+        Debug.print(f"No downloaded songs found in the download manifest in {outdir}.", 0)
+    for playlist, playlistdir, paths in playlists:
+        create_playlistfile(playlist, paths, os.path.join(outdir, playlistdir), playlistdir)
+    if selected != None:
+        # a playlist without any songs left keeps no playlist file
+        remaining = set(playlist for playlist, playlistdir, paths in playlists)
+        for playlist in selected:
+            playlistdir = find_playlistdir(manifest, playlist)
+            m3u_path = os.path.join(outdir, playlistdir, f"{playlistdir if playlistdir != '' else 'unlisted'}.m3u8")
+            if playlist not in remaining and os.path.exists(m3u_path):
+                Debug.print(f"Removing playlist file without songs: {m3u_path}", 0)
+                os.remove(m3u_path)
+
+
+# Moves the songs of the output directories of --shard into `outdir'. The positions in the manifests are those in the whole catalogue,
+# so the playlist files are written from the combined manifest in the right order.
+def merge_shards(shard_dirs, outdir, config_key):
+    failed = FailedQueue(os.path.join(outdir, FailedQueue.FILENAME))
+    with DownloadManifest(outdir, config_key) as manifest:
+        # playlist -> folder in outdir, which can differ between the shards for a random folder name (see generate_playlistdir)
+        playlistdirs = {}
+        for shard_dir in shard_dirs:
+            if not os.path.exists(os.path.join(shard_dir, DownloadManifest.FILENAME)):
+                Debug.write(f'No download manifest found in {shard_dir}. Only output directories of -d with --shard can be merged.')
+                exit(1)
+            with DownloadManifest(shard_dir) as shard_manifest:
+                entries = shard_manifest.entries()
+            same_dir = os.path.realpath(shard_dir) == os.path.realpath(outdir)
+            merged = []
+            for entry in entries:
+                playlistdir, playlist, path = entry[0], entry[4], entry[9]
+                if playlistdir != ContentStore.DIRNAME:
+                    if playlist not in playlistdirs:
+                        playlistdirs[playlist] = manifest.playlistdir(playlist) or playlistdir
+                    playlistdir = playlistdirs[playlist]
+                old_path = os.path.join(shard_dir, entry[0], path)
+                new_path = os.path.join(outdir, playlistdir, path)
+                if not same_dir and os.path.lexists(old_path):
+                    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                    if os.path.lexists(new_path):
+                        os.remove(new_path)
+                    # symlinks of --store-mode are moved as they are, their relative target is the same in outdir
+                    shutil.move(old_path, new_path)
+                merged.append((playlistdir,) + tuple(entry[1:]))
+            count = manifest.record_entries(merged)
+            Debug.print(f'{count}/{len(entries)} songs merged from {shard_dir}', 0)
+
+            if not same_dir:
+                shard_failed = FailedQueue(os.path.join(shard_dir, FailedQueue.FILENAME))
+                failed.entries.update(shard_failed.entries)
+            # songs that failed in an earlier merge, but were downloaded since
+            for entry in merged:
+                failed.entries.pop((entry[4], entry[1]), None)
+        rebuild_playlistfiles(manifest, outdir)
+    failed.save()
+
+
+def move_songfile(old_path, new_path):
+    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+    if os.path.lexists(new_path):
+        os.remove(new_path)
+    if os.path.islink(old_path):
+        # a relative symlink has to point to the same file from its new folder
+        target = os.path.join(os.path.dirname(old_path), os.readlink(old_path))
+        os.symlink(os.path.relpath(target, os.path.dirname(new_path)), new_path)
+        os.remove(old_path)
+    else:
+        os.replace(old_path, new_path)
+
+# Compares the catalogue to the snapshot of the previous --sync, and applies the changes that need no download.
+# Songs that moved to another playlist are moved to its folder, removed songs are deleted with `prune', or otherwise left out of the playlist files.
+# Returns the songs that still have to be downloaded with their positions, the new snapshot and the playlists whose playlist file changed.
+def sync_catalogue(songs, manifest, outdir, outputformat, prune):
+    template = parse_outputformat(outputformat)
+    old_snapshot = manifest.snapshot()
+    if len(old_snapshot) == 0:
+        # the first --sync of a folder downloaded without it: compare with the songs the earlier runs downloaded,
+        # otherwise nothing could be found as removed
+        old_snapshot = manifest.downloaded_positions()
+    snapshot = {}
+    catalogue = []
+    counts = {}
+    for song in songs:
+        if song.link == None or song.link == "":
+            continue
+        # the same positions as download_songs, which only counts songs with a link
+        playlist = song_playlist(song)
+        position = counts.get(playlist, 0)
+        counts[playlist] = position + 1
+        catalogue.append((playlist, position, song))
+        if (playlist, song.link) not in snapshot:
+            snapshot[(playlist, song.link)] = position
+
+    affected = set()
+    removed = {}
+    for (playlist, link), position in old_snapshot.items():
+        if (playlist, link) not in snapshot:
+            removed.setdefault(link, []).append(playlist)
+            affected.add(playlist)
+        elif snapshot[(playlist, link)] != position:
+            affected.add(playlist)
+
+    added = []
+    moved = 0
+    for playlist, position, song in catalogue:
+        if (playlist, song.link) in old_snapshot:
+            continue
+        affected.add(playlist)
+        old_playlists = removed.get(song.link)
+        if old_playlists and sync_move(manifest, outdir, template, old_playlists[-1], playlist, position, song):
+            old_playlists.pop()
+            moved += 1
+            continue
+        added.append((playlist, position, song))
+
+    pruned = 0
+    removed_songs = [(playlist, link) for link in removed for playlist in removed[link]]
+    if prune:
+        # including the songs that were removed in an earlier --sync without --prune
+        for playlist, link in set(removed_songs) | set(manifest.removed()):
+            for playlistdir, filename, path in manifest.files(playlist, link):
+                full_path = os.path.join(outdir, playlistdir, path)
+                # files in the content store can still be used by other playlists, only the link in the playlist folder is removed
+                if os.path.dirname(path) == '' and os.path.lexists(full_path):
+                    Debug.print(f"Removing song that is no longer in the catalogue: {full_path}", 1)
+                    os.remove(full_path)
+            manifest.remove(playlist, link)
+            pruned += 1
+    else:
+        manifest.set_positions([(playlist, link, -1) for playlist, link in removed_songs])
+    manifest.set_positions([(playlist, song.link, position) for playlist, position, song in catalogue])
+
+    Debug.print(f"Sync: {len(added)} songs added, {moved} moved to another playlist, {len(removed_songs)} removed" +
+                (f" ({pruned} deleted)." if prune else " (kept on disk, use --prune to delete them)."), 0)
+    positions = [position for playlist, position, song in added]
+    return ([song for playlist, position, song in added], positions, snapshot, affected)
+
+def sync_move(manifest, outdir, template, old_playlist, playlist, position, song):
+    # moves the downloaded file of the song from the folder of the old playlist, returns False if there is no file to move
+    files = manifest.files(old_playlist, song.link)
+    if len(files) == 0:
+        return False
+    old_playlistdir, old_filename, old_path = files[0]
+    full_old_path = os.path.join(outdir, old_playlistdir, old_path)
+    if not os.path.lexists(full_old_path):
+        return False
+    playlistdir = find_playlistdir(manifest, playlist)
+    file_name = format_songfilename(template, song)
+    if os.path.dirname(old_path) == '':
+        path = file_name + os.path.splitext(old_path)[1]
+        move_songfile(full_old_path, os.path.join(outdir, playlistdir, path))
+    else:
+        # a path into the content store (--store-mode m3u), which stays where it is
+        path = os.path.relpath(os.path.join(outdir, old_playlistdir, old_path), os.path.join(outdir, playlistdir))
+    Debug.print(f"Moved song from {old_playlist} to {playlist}: {song.title} | {song.artists} | {song.album}", 1)
+    manifest.remove(old_playlist, song.link)
+    manifest.record(playlist, playlistdir, position, song, file_name, path)
+    return True
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return f'{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+def percentile(values, fraction):
+    # nearest-rank percentile of a sorted list
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))]
+
+# Writes one JSON line per song with the time each phase took, and keeps the timings for a summary at the end.
+# Phases: startup (of yt-dlp), extract (information about the link), download, postprocess (ffmpeg in yt-dlp),
+# transcode (the separate ffmpeg stage with --split-transcode), tag (the tagging pass of --batch-playlists), total (of yt-dlp).
+# With --batch-playlists, every song of a batch gets an equal share of the time of the batch.
+class MetricsWriter:
+    PHASES = ['startup', 'extract', 'download', 'postprocess', 'transcode', 'tag', 'total']
+
+    def __init__(self, metricsfile):
+        try:
+            self.writer = open(metricsfile, 'w', encoding='utf-8')
+        except IOError as err:
+            Debug.write(f"Metrics file could not be opened to write to.\n{err}")
+            exit(4)
+        self.timings = {phase: [] for phase in self.PHASES}
+
+    def write_song(self, playlist, position, song, status, returncode=None, outdir=None, file_name=None, phases=None, retries=0, transcode=None):
+        size = None
+        if file_name != None:
+            try:
+                size = os.path.getsize(os.path.join(outdir, file_name))
+            except OSError:
+                pass
+        record = {
+            'time': time.time(),
+            'playlist': playlist,
+            'position': position,
+            'title': song.title,
+            'artists': song.artists,
+            'album': song.album,
+            'link': song.link,
+            'status': status,
+            'returncode': returncode,
+            'file': file_name,
+            'bytes': size,
+            'retries': retries,
+            'transcode': transcode,
+            'phases': phases if phases != None else {}
+        }
+        self.writer.write(json.dumps(record, ensure_ascii=False) + '\n')
+        for phase in record['phases']:
+            if phase in self.timings:
+                self.timings[phase].append(record['phases'][phase])
+
+    def print_summary(self):
+        verbosity = 0
+        Debug.print('\nMETRICS (seconds):\n-----------------', verbosity)
+        Debug.print(f"{'phase':<12}{'count':>8}{'p50':>10}{'p95':>10}{'max':>10}", verbosity)
+        for phase in self.PHASES:
+            values = sorted(self.timings[phase])
+            if len(values) == 0:
+                continue
+            Debug.print(f"{phase:<12}{len(values):>8}{percentile(values, 0.5):>10.2f}{percentile(values, 0.95):>10.2f}{values[-1]:>10.2f}", verbosity)
+        Debug.print('-----------------\n', verbosity)
+
+    def close(self):
+        self.writer.close()
+
+
+# yt-dlp errors that do not go away by trying again. Anything else (throttling, timeouts, connection and extractor errors) is transient.
+# HTTP Error 403 is left out, YouTube returns it for throttling and expired download URLs, which yt-dlp also retries.
+PERMANENT_ERROR_RE = re.compile(r'Video unavailable|Private video|video is private|has been removed|not available in your country|' +
+                                r'Unsupported URL|is not a valid URL|HTTP Error 40[014]\b|Sign in to confirm your age|account .* has been terminated|' +
+                                r'due to a copyright claim|blocked it on copyright grounds|Requested format is not available', re.IGNORECASE)
+# longest wait before a song is tried again, in seconds
+RETRY_MAX_DELAY = 300.0
+
+# When songs are tried again after a transient error, and how often downloads start per host.
+# The delay doubles with every retry up to RETRY_MAX_DELAY, with random jitter so failed songs do not all retry at once.
+class RetryPolicy:
+
+    def __init__(self, retries=0, delay=5.0, host_interval=0.0):
+        self.retries = retries
+        self.delay = delay
+        self.host_interval = host_interval
+        # host -> earliest time the next download of that host can start
+        self.hosts = {}
+
+    def is_transient(self, error):
+        # without an error message there is nothing to tell a transient error from
+        return error != None and PERMANENT_ERROR_RE.search(error) == None
+
+    def backoff(self, retries):
+        return min(RETRY_MAX_DELAY, self.delay * 2 ** retries) * random.uniform(0.5, 1.0)
+
+    def host(self, link):
+        try:
+            return urllib.parse.urlsplit(link).hostname or ''
+        except ValueError:
+            return ''
+
+    def host_ready(self, link):
+        return self.hosts.get(self.host(link), 0.0)
+
+    def started(self, link):
+        if self.host_interval > 0:
+            host = self.host(link)
+            self.hosts[host] = max(self.hosts.get(host, 0.0), time.monotonic() + self.host_interval)
+
+    def pause(self, link, seconds):
+        host = self.host(link)
+        self.hosts[host] = max(self.hosts.get(host, 0.0), time.monotonic() + seconds)
+
+
+# Songs that could not be downloaded, as one JSON object per line, so --retry-failed can try only those songs again.
+# Songs that are downloaded later are removed from it again. The file is rewritten at the end of every download.
+class FailedQueue:
+    FILENAME = 'failed.jsonl'
+
+    def __init__(self, path):
+        self.path = path
+        # (playlist, link) -> record
+        self.entries = {}
+        try:
+            with open(path, 'r', encoding='utf-8') as reader:
+                for line in reader:
+                    if line.strip() == '':
+                        continue
+                    record = json.loads(line)
+                    self.entries[(record['playlist'], record['link'])] = record
+        except FileNotFoundError:
+            pass
+        except (IOError, ValueError, KeyError) as err:
+            Debug.write(f"Failed songs file could not be read: {path}\n{err}")
+            exit(4)
+
+    def add(self, playlist, position, song, returncode, error, kind, retries):
+        self.entries[(playlist, song.link)] = {
+            'time': time.time(),
+            'playlist': playlist,
+            'position': position,
+            'title': song.title,
+            'artists': song.artists,
+            'album': song.album,
+            'link': song.link,
+            'returncode': returncode,
+            'error': error,
+            'kind': kind,
+            'retries': retries
+        }
 
-def parse_outputformat(outputformat, song):
+    def remove(self, playlist, song):
+        self.entries.pop((playlist, song.link), None)
+
+    def songs(self):
+        # the songs and their positions in the playlists, in playlist order
+        records = sorted(self.entries.values(), key=lambda record: (record['playlist'], record['position']))
+        songs = [Song(record['title'], record['artists'], record['album'], record['playlist'], record['link']) for record in records]
+        return (songs, [record['position'] for record in records])
+
+    def save(self):
+        if len(self.entries) == 0:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as writer:
+            for record in self.entries.values():
+                writer.write(json.dumps(record, ensure_ascii=False) + '\n')
+        os.replace(temp_path, self.path)
+        Debug.print(f'{len(self.entries)} songs that could not be downloaded are stored in {self.path}. Use --retry-failed to try them again.', 0)
+
+
+# Local folder (--scratch-dir) where the songs are downloaded and converted, before they are published into the output directory.
+# Every download gets its own folder in it, which is removed with whatever yt-dlp left behind when the song is finished.
+# A song only starts if the estimated sizes of the songs in the folder stay below `limit' bytes. Only used from the thread that schedules the downloads.
+class ScratchSpace:
+    # estimated size of a song before any song was published, about 5 minutes at 256 kbit/s
+    DEFAULT_SIZE = 10 * 1024 * 1024
+
+    def __init__(self, path, limit=0):
+        os.makedirs(path, exist_ok=True)
+        # a folder for this run, so several runs can use the same scratch directory
+        self.dir = tempfile.mkdtemp(prefix='song_downloader_', dir=path)
+        self.limit = limit
+        self.reserved = 0
+        # folder of a download -> number of songs that still use it (more than one with --batch-playlists)
+        self.users = {}
+        self.published = 0
+        self.published_bytes = 0
+
+    def estimate(self, filesize):
+        if filesize != None:
+            return filesize
+        if self.published > 0:
+            return self.published_bytes // self.published
+        return self.DEFAULT_SIZE
+
+    def fits(self, size):
+        return self.limit <= 0 or self.reserved + size <= self.limit
+
+    def admits(self, size):
+        # a song always starts if the folder is empty, otherwise a song larger than the limit would never start
+        return self.reserved == 0 or self.fits(size)
+
+    def create(self, jobs, sizes):
+        work_dir = tempfile.mkdtemp(dir=self.dir)
+        self.users[work_dir] = len(jobs)
+        for job, size in zip(jobs, sizes):
+            job['work_dir'] = work_dir
+            job['scratch_size'] = size
+            self.reserved += size
+
+    def release(self, job):
+        self.reserved -= job['scratch_size']
+        work_dir = job['work_dir']
+        job['work_dir'] = job['target_dir']
+        self.users[work_dir] -= 1
+        if self.users[work_dir] == 0:
+            del self.users[work_dir]
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def publish(self, path, target_path):
+        # a single rename if the scratch folder is on the same drive. Otherwise the file is copied next to the target first,
+        # and renamed when the copy is complete.
+        size = os.path.getsize(path)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        try:
+            os.replace(path, target_path)
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+            part_path = target_path + '.part'
+            try:
+                shutil.copy2(path, part_path)
+                os.replace(part_path, target_path)
+            except OSError:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                raise
+            os.remove(path)
+        self.published += 1
+        self.published_bytes += size
+        Debug.print(f"File published at: {target_path}", 1)
+
+    def close(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def format_bytes(size):
+    if size == None:
+        return '?'
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return f'{size:.1f}{unit}'
+        size /= 1024
+    return f'{size:.1f}GiB'
+
+# Live view of the downloads with --progress: the song and speed of every worker, the number of songs done, failed and remaining,
+# the total speed and an ETA from the songs finished in the last WINDOW seconds.
+# The workers only update numbers, a separate thread draws the view every REFRESH seconds. On a terminal the view is redrawn in place
+# below the other output, otherwise one status line is printed every LOG_INTERVAL seconds.
+class ProgressDashboard:
+    REFRESH = 0.5
+    LOG_INTERVAL = 10.0
+    WINDOW = 60.0
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.lock = threading.Lock()
+        # thread id -> worker number, and worker number -> [song, downloaded bytes, total bytes, speed] or None if idle
+        self.numbers = {}
+        self.workers = {}
+        self.counts = (0, 0, 0, 0, False)
+        # (time, finished songs), to measure the recent throughput
+        self.samples = deque()
+        self.buffer = ''
+        # number of lines of the view that are on the screen
+        self.lines = 0
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.previous = Debug.stream
+        self.stream = Debug.out()
+        self.tty = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.last_log = time.monotonic()
+        # everything that is printed while downloading goes through write(), so it ends up above the view
+        Debug.stream = self
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        with self.lock:
+            self.clear()
+            if self.buffer != '':
+                self.stream.write(self.buffer + '\n')
+                self.buffer = ''
+            self.stream.write(self.status() + '\n')
+        Debug.stream = self.previous
+
+    def write(self, text):
+        with self.lock:
+            self.buffer += text
+            if '\n' in self.buffer:
+                lines, self.buffer = self.buffer.rsplit('\n', 1)
+                self.clear()
+                self.stream.write(lines + '\n')
+                self.draw()
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def song_started(self, song):
+        with self.lock:
+            number = self.numbers.setdefault(threading.get_ident(), len(self.numbers) + 1)
+            self.workers[number] = [song, None, None, None]
+
+    def song_progress(self, downloaded, total, speed):
+        number = self.numbers.get(threading.get_ident())
+        worker = self.workers.get(number)
+        if worker != None:
+            worker[1:] = [downloaded, total, speed]
+
+    def song_stopped(self):
+        with self.lock:
+            number = self.numbers.get(threading.get_ident())
+            if number != None:
+                self.workers[number] = None
+
+    def update_counts(self, done, failed, skipped, remaining, exhausted):
+        # called by the scheduler, which is the only one that knows when a song is finished
+        self.counts = (done, failed, skipped, remaining, exhausted)
+        now = time.monotonic()
+        finished = done + failed
+        if len(self.samples) == 0 or self.samples[-1][1] != finished:
+            self.samples.append((now, finished))
+        while len(self.samples) > 1 and self.samples[1][0] < now - self.WINDOW:
+            self.samples.popleft()
+
+    def status(self):
+        done, failed, skipped, remaining, exhausted = self.counts
+        speed = sum(worker[3] for worker in self.workers.values() if worker != None and worker[3] != None)
+        eta = '?'
+        now = time.monotonic()
+        if len(self.samples) > 0 and now - self.samples[0][0] > 0:
+            rate = (done + failed - self.samples[0][1]) / (now - self.samples[0][0])
+            if rate > 0:
+                eta = format_duration(remaining / rate) + ('' if exhausted else '+')
+        more = '' if exhausted else '+'
+        return f'done {done} | failed {failed} | already downloaded {skipped} | remaining {remaining}{more} | {format_bytes(speed)}/s | ETA {eta}'
+
+    def clear(self):
+        if self.lines > 0:
+            # back to the first line of the view, and clear everything below it
+            self.stream.write(f'\x1b[{self.lines}F\x1b[J')
+            self.lines = 0
+
+    def draw(self):
+        if not self.tty:
+            return
+        width = shutil.get_terminal_size().columns - 1
+        lines = []
+        for number in sorted(self.workers):
+            worker = self.workers[number]
+            if worker == None:
+                lines.append(f'worker {number}: idle')
+                continue
+            song, downloaded, total, speed = worker
+            lines.append(f'worker {number}: {format_bytes(downloaded)}/{format_bytes(total)} {format_bytes(speed)}/s | {song.artists} - {song.title}')
+        lines.append(self.status())
+        self.stream.write(''.join(line[:width] + '\n' for line in lines))
+        self.lines = len(lines)
+
+    def run(self):
+        while not self.stopped.wait(self.REFRESH):
+            with self.lock:
+                if self.tty:
+                    self.clear()
+                    self.draw()
+                elif time.monotonic() - self.last_log >= self.LOG_INTERVAL:
+                    self.last_log = time.monotonic()
+                    self.stream.write(f'Progress: {self.status()}\n')
+                self.stream.flush()
+
+
+# Downloads the songs with a pool of `jobs' workers, with at most `playlist_jobs' songs of the same playlist at once.
+# Songs are read from the parser while downloading, only a bounded number ahead of the downloads.
+# With a content store, every link is downloaded once into the store, and linked into all playlists it is in.
+# With a transcoder, the workers only download the audio, and a separate pool transcodes and tags the files.
+class DownloadScheduler:
+
+    def __init__(self, outdir, outputformat, createplaylistfile, backend, jobs=1, playlist_jobs=0, manifest=None, store=None, metrics=None,
+                 transcoder=None, transcode_jobs=1, prefetch=False, retry=None, failed=None, executor=None, progress=None, shard=None,
+                 batch=False, scratch=None):
+        self.outdir = outdir
+        self.template = parse_outputformat(outputformat)
+        self.createplaylistfile = createplaylistfile
+        self.backend = backend
+        self.jobs = jobs
+        self.playlist_jobs = playlist_jobs
+        self.manifest = manifest
+        self.store = store
+        self.metrics = metrics
+        self.transcoder = transcoder
+        self.transcode_jobs = transcode_jobs
+        self.prefetch = prefetch
+        self.retry = retry if retry != None else RetryPolicy()
+        self.failed = failed
+        # a pool of download workers that is kept after the run (--serve), otherwise a new one is made
+        self.executor = executor
+        self.progress = progress
+        # (index, count) of --shard, or None to download every song
+        self.shard = shard
+        # download the songs of a playlist in batches with one yt-dlp process (--batch-playlists)
+        self.batch = batch
+        # ScratchSpace the songs are downloaded in before they are moved to their folder, or None to download into the folder directly
+        self.scratch = scratch
+        self.queue_size = max(64, jobs * 16)
+
+        self.errors = 0
+        self.total_songs = 0
+        self.already_downloaded = 0
+        self.other_shards = 0
+        # state per playlist. The position of each song is kept so the playlist file is in source order,
+        # even if the songs finish in a different order.
+        self.playlists = {}
+        # playlists that have songs waiting, visited round-robin so one big playlist does not starve the others
+        self.order = deque()
+        self.queued = 0
+        self.downloading = 0
+        # future -> (stage, job), or ('batch', [jobs]) for a batch of songs
+        self.running = {}
+        # links in the batches that are running. A batch names its files by the id of the link, so a link is only in one batch at a time.
+        self.batch_links = set()
+        # store file name -> songs waiting on the download of that file
+        self.store_waiting = {}
+        # with prefetch: songs waiting for their metadata, then a heap of (-duration, number, job) to download the longest songs first
+        self.pending = []
+        self.longest = []
+        # link -> (duration, filesize), None if unknown
+        self.metadata = {}
+        # heap of (time, number, job) of songs that are tried again after a transient error
+        self.retrying = []
+        self.retry_number = 0
+        # earliest time a song that is waiting for its host can start
+        self.host_wakeup = None
+
+    def run(self, songs, positions=None):
+        # positions: the position of every song in its playlist, if they are not in order (--retry-failed)
+        Debug.print("Starting download...\n\n")
+        songs = iter(songs)
+        positions = iter(positions) if positions != None else None
+        exhausted = False
+        own_executor = self.executor == None
+        if own_executor:
+            self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+        self.transcode_executor = None
+        if self.transcoder != None:
+            # every transcode runs in its own ffmpeg process, so a thread per process is enough to use all cores
+            self.transcode_executor = ThreadPoolExecutor(max_workers=self.transcode_jobs)
+        try:
+            if self.prefetch or self.batch:
+                # the whole catalogue is read first, so the songs can be ordered by duration before any download starts,
+                # or every playlist is complete before its batch starts
+                for song in songs:
+                    self.add_song(song, next(positions) if positions != None else None)
+                exhausted = True
+                if self.prefetch:
+                    self.prefetch_metadata()
+                    self.print_eta()
+
+            while True:
+                # read songs until enough are waiting to keep all workers busy
+                while not exhausted and self.queued < self.queue_size:
+                    song = next(songs, None)
+                    if song == None:
+                        exhausted = True
+                        break
+                    self.add_song(song, next(positions) if positions != None else None)
+
+                self.release_retries()
+                self.dispatch()
+                if self.progress != None:
+                    self.progress.update_counts(self.total_songs - self.errors - self.already_downloaded - self.unfinished(), self.errors,
+                                                self.already_downloaded, self.unfinished(), exhausted)
+
+                timeout = self.wakeup_timeout()
+                if len(self.running) == 0:
+                    if exhausted and self.queued == 0 and len(self.retrying) == 0:
+                        break
+                    if timeout != None and (exhausted or self.queued >= self.queue_size):
+                        # everything left is waiting for a retry or a host
+                        time.sleep(timeout)
+                    continue
+
+                done, _ = wait(self.running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, job = self.running.pop(future)
+                    if stage == 'download':
+                        self.downloading -= 1
+                        self.playlists[job['playlist']]['running'] -= 1
+                        self.downloaded(job, *future.result())
+                    elif stage == 'batch':
+                        self.downloading -= 1
+                        self.playlists[job[0]['playlist']]['running'] -= 1
+                        self.batch_links.difference_update(batch_job['song'].link for batch_job in job)
+                        self.batch_downloaded(job, *future.result())
+                    else:
+                        returncode, output_filename, phases, decision = future.result()
+                        job['phases'].update(phases)
+                        job['transcode'] = decision
+                        if returncode != 0:
+                            job['error'] = f'ffmpeg exited with code {returncode}'
+                        self.transcoder.record(decision, phases['transcode'])
+                        Debug.print(f"Transcode: {decision} | {job['song'].title} | {job['song'].artists} | {job['song'].album}", 1)
+                        self.finish_job(job, returncode, output_filename)
+        finally:
+            if own_executor:
+                self.executor.shutdown()
+            if self.transcode_executor != None:
+                self.transcode_executor.shutdown()
+
+        # a playlist can get more songs until the whole file is read, so the playlist files are written at the end
+        if self.createplaylistfile:
+            for playlist in self.playlists:
+                state = self.playlists[playlist]
+                create_playlistfile(playlist, [path for path in state['paths'] if path != None], state['full_dir'], state['dir'])
+        if self.other_shards > 0:
+            Debug.print(f'\n{self.other_shards} songs are in other shards and were skipped.', 0)
+        if self.already_downloaded > 0:
+            Debug.print(f'\n{self.already_downloaded}/{self.total_songs} songs were already downloaded and skipped.', 0)
+        # songs that were already downloaded are neither downloaded nor failed in this run
+        to_download = self.total_songs - self.already_downloaded
+        Debug.print(f'\n{to_download - self.errors}/{to_download} songs were downloaded correctly.\n', 0)
+
+    def playlist_state(self, playlist):
+        state = self.playlists.get(playlist)
+        if state == None:
+            playlistdir = find_playlistdir(self.manifest, playlist)
+            state = {
+                'dir': playlistdir,
+                'full_dir': os.path.join(self.outdir, playlistdir),
+                'queue': deque(),
+                'running': 0,
+                'count': 0,
+                'paths': []
+            }
+            self.playlists[playlist] = state
+        return state
+
+    def add_song(self, song, position=None):
+        if song.link == None or song.link == "":
+            Debug.print(f'Skipping song with no download link: {song.title} | {song.artists} | {song.album}', 2)
+            return
+        playlist = song_playlist(song)
+        state = self.playlist_state(playlist)
+
+        if position == None:
+            position = state['count']
+            state['count'] += 1
+        # songs of other shards still take up their position, so the positions are the same in every shard
+        if self.shard != None and not in_shard(song.link, self.shard):
+            self.other_shards += 1
+            return
+        self.total_songs += 1
+        if self.manifest != None:
+            self.manifest.see(playlist, song.link, position)
+        file_name = format_songfilename(self.template, song)
+        path = None
+        if self.manifest != None:
+            path = self.manifest.lookup(playlist, state['dir'], position, song, file_name)
+        # the paths are only kept if they are needed for the playlist file
+        if self.createplaylistfile:
+            while len(state['paths']) <= position:
+                state['paths'].append(None)
+            state['paths'][position] = path
+        if path != None:
+            self.already_downloaded += 1
+            Debug.print(f'Song was already downloaded: {song.title} | {song.artists} | {song.album} | {song.link}', 2)
+            if self.failed != None:
+                self.failed.remove(playlist, song)
+            if self.metrics != None:
+                self.metrics.write_song(playlist, position, song, 'already_downloaded')
+            return
+
+        job = {
+            'playlist': playlist,
+            'position': position,
+            'song': song,
+            'file_name': file_name,
+            'target_dir': state['full_dir'],
+            # folder the song is downloaded and transcoded in, a folder in the scratch space while it runs with --scratch-dir
+            'work_dir': state['full_dir'],
+            'target_name': file_name,
+            'store_name': None,
+            'phases': {},
+            'transcode': None,
+            'retries': 0
+        }
+        if self.store != None:
+            store_name = self.store.name(song)
+            if store_name in self.store_waiting:
+                self.store_waiting[store_name].append(job)
+                return
+            stored_file = None
+            if self.manifest != None:
+                stored_file = self.manifest.lookup(ContentStore.DIRNAME, ContentStore.DIRNAME, 0, song, store_name)
+            if stored_file != None:
+                self.already_downloaded += 1
+                Debug.print(f'Song was already downloaded to the store: {song.title} | {song.artists} | {song.album} | {song.link}', 2)
+                if self.metrics != None:
+                    self.metrics.write_song(playlist, position, song, 'already_downloaded')
+                self.finish_song(job, self.store.link(stored_file, state['full_dir'], file_name))
+                return
+            self.store_waiting[store_name] = [job]
+            job['store_name'] = store_name
+            job['target_dir'] = self.store.dir
+            job['work_dir'] = self.store.dir
+            job['target_name'] = store_name
+
+        self.enqueue(job)
+
+    def enqueue(self, job):
+        self.queued += 1
+        if self.prefetch:
+            if 'duration' in job:
+                heapq.heappush(self.longest, (-job['duration'], job['number'], job))
+            else:
+                self.pending.append(job)
+            return
+        state = self.playlists[job['playlist']]
+        if len(state['queue']) == 0:
+            self.order.append(job['playlist'])
+        state['queue'].append(job)
+
+    def unfinished(self):
+        # songs that are queued, downloading, transcoding, waiting for a retry or for the download of the same file in the store
+        waiting = sum(len(jobs) - 1 for jobs in self.store_waiting.values())
+        running = sum(len(job) if stage == 'batch' else 1 for stage, job in self.running.values())
+        return self.queued + running + len(self.retrying) + waiting
+
+    def release_retries(self):
+        now = time.monotonic()
+        while len(self.retrying) > 0 and self.retrying[0][0] <= now:
+            self.enqueue(heapq.heappop(self.retrying)[2])
+
+    def wakeup_timeout(self):
+        # seconds until a song waiting for a retry or its host can start, or None if there is no such song
+        wakeups = [wakeup for wakeup in (self.host_wakeup, self.retrying[0][0] if len(self.retrying) > 0 else None) if wakeup != None]
+        if len(wakeups) == 0:
+            return None
+        return max(0.0, min(wakeups) - time.monotonic())
+
+    def prefetch_metadata(self):
+        links = list(dict.fromkeys(job['song'].link for job in self.pending))
+        if self.manifest != None:
+            self.metadata = self.manifest.metadata(links)
+        missing = [link for link in links if link not in self.metadata]
+        Debug.print(f'Fetching metadata of {len(missing)} links ({len(links) - len(missing)} cached)...', 0)
+        start = time.perf_counter()
+        # every batch is fetched by one yt-dlp process, the batches run on the download workers
+        batches = [missing[i:i + PREFETCH_BATCH_SIZE] for i in range(0, len(missing), PREFETCH_BATCH_SIZE)]
+        futures = [self.executor.submit(self.backend.prefetch, batch) for batch in batches]
+        fetched = {}
+        for future in futures:
+            fetched.update(future.result())
+        if self.manifest != None:
+            self.manifest.record_metadata(fetched)
+        self.metadata.update(fetched)
+        Debug.print(f'Fetched metadata of {len(fetched)}/{len(missing)} links in {time.perf_counter() - start:.2f} seconds.', 0)
+
+        # songs without a known duration are ordered as an average song
+        durations = [self.metadata[link][0] for link in links if self.metadata.get(link) != None and self.metadata[link][0] != None]
+        average = sum(durations) / len(durations) if len(durations) > 0 else 0.0
+        for number, job in enumerate(self.pending):
+            job['duration'] = average
+            job['number'] = number
+            metadata = self.metadata.get(job['song'].link)
+            if metadata != None and metadata[0] != None:
+                job['duration'] = metadata[0]
+            heapq.heappush(self.longest, (-job['duration'], number, job))
+        self.pending = []
+
+    def print_eta(self):
+        durations = sorted((-item[0] for item in self.longest), reverse=True)
+        total = sum(durations)
+        Debug.print(f'\n{len(durations)} songs to download, {format_duration(total)} of audio.', 0)
+        if len(durations) == 0:
+            return
+        # longest-processing-time-first: every song goes to the worker that is done first
+        workers = [0.0] * min(self.jobs, len(durations))
+        for duration in durations:
+            heapq.heapreplace(workers, workers[0] + duration)
+        makespan = max(workers)
+        rate = self.manifest.download_rate() if self.manifest != None else None
+        if rate == None:
+            Debug.print(f'The longest worker has {format_duration(makespan)} of audio. No earlier downloads are known to estimate the time from.\n', 0)
+            return
+        Debug.print(f'Estimated time: {format_duration(makespan * rate)} with {self.jobs} jobs ({rate:.3f} seconds per second of audio in earlier downloads).\n', 0)
+
+    def can_start(self, job, now):
+        if self.playlist_jobs > 0 and self.playlists[job['playlist']]['running'] >= self.playlist_jobs:
+            return False
+        if self.batch and job['song'].link in self.batch_links:
+            # waits for the batch with the link, which also wakes up the scheduler
+            return False
+        if self.scratch != None and not self.scratch.admits(self.scratch_size(job)):
+            # waits for a song to be published, which also wakes up the scheduler
+            return False
+        ready = self.retry.host_ready(job['song'].link)
+        if ready > now:
+            self.host_wakeup = ready if self.host_wakeup == None else min(self.host_wakeup, ready)
+            return False
+        return True
+
+    def dispatch(self):
+        self.host_wakeup = None
+        if self.prefetch:
+            self.dispatch_longest()
+            return
+        now = time.monotonic()
+        blocked = 0
+        while self.downloading < self.jobs and blocked < len(self.order):
+            playlist = self.order[0]
+            state = self.playlists[playlist]
+            if not self.can_start(state['queue'][0], now):
+                self.order.rotate(-1)
+                blocked += 1
+                continue
+            blocked = 0
+            job = state['queue'].popleft()
+            self.queued -= 1
+            jobs = self.take_batch(job, state['queue']) if self.batch else None
+            if len(state['queue']) == 0:
+                self.order.popleft()
+            else:
+                self.order.rotate(-1)
+            if jobs != None:
+                self.submit_batch(jobs)
+            else:
+                self.submit(job)
+
+    def dispatch_longest(self):
+        now = time.monotonic()
+        blocked = []
+        while self.downloading < self.jobs and len(self.longest) > 0:
+            item = heapq.heappop(self.longest)
+            job = item[2]
+            if not self.can_start(job, now):
+                blocked.append(item)
+                continue
+            self.queued -= 1
+            self.submit(job)
+        for item in blocked:
+            heapq.heappush(self.longest, item)
+
+    def submit(self, job):
+        self.playlists[job['playlist']]['running'] += 1
+        self.downloading += 1
+        self.retry.started(job['song'].link)
+        if self.scratch != None:
+            self.scratch.create([job], [self.scratch_size(job)])
+        future = self.executor.submit(run_ytdlp_on_song, job['song'], job['work_dir'], job['target_name'], self.backend)
+        self.running[future] = ('download', job)
+
+    def take_batch(self, job, queue):
+        # the next songs of the playlist, up to BATCH_SIZE. Every link is only once in all running batches, another copy would get
+        # the same file, so it waits for a later batch.
+        jobs = [job]
+        links = {job['song'].link}
+        later = []
+        size = self.scratch_size(job) if self.scratch != None else 0
+        while len(queue) > 0 and len(jobs) < BATCH_SIZE:
+            next_job = queue.popleft()
+            if next_job['song'].link in links or next_job['song'].link in self.batch_links:
+                later.append(next_job)
+                continue
+            if self.scratch != None:
+                if not self.scratch.fits(size + self.scratch_size(next_job)):
+                    later.append(next_job)
+                    break
+                size += self.scratch_size(next_job)
+            links.add(next_job['song'].link)
+            jobs.append(next_job)
+            self.queued -= 1
+        queue.extendleft(reversed(later))
+        return jobs
+
+    def submit_batch(self, jobs):
+        self.playlists[jobs[0]['playlist']]['running'] += 1
+        self.batch_links.update(job['song'].link for job in jobs)
+        self.downloading += 1
+        self.retry.started(jobs[0]['song'].link)
+        if self.scratch != None:
+            self.scratch.create(jobs, [self.scratch_size(job) for job in jobs])
+        # the songs of a playlist all have the same folder, the playlist folder or the store
+        future = self.executor.submit(run_ytdlp_on_batch, [job['song'] for job in jobs], jobs[0]['work_dir'],
+                                      [job['target_name'] for job in jobs], self.backend)
+        self.running[future] = ('batch', jobs)
+
+    def scratch_size(self, job):
+        metadata = self.metadata.get(job['song'].link)
+        size = self.scratch.estimate(metadata[1] if metadata != None else None)
+        # the downloaded and the transcoded file are both in the scratch space until the transcode is done
+        return size * 2 if self.transcoder != None else size
+
+    def batch_downloaded(self, jobs, results, phases):
+        # every song of the batch is retried, transcoded or finished on its own
+        for job, (returncode, output_filename, error) in zip(jobs, results):
+            self.downloaded(job, returncode, output_filename, dict(phases), error)
+
+    def downloaded(self, job, returncode, output_filename, phases, error):
+        job['phases'].update(phases)
+        job['error'] = error
+        if returncode != 0 and self.retry.is_transient(error) and job['retries'] < self.retry.retries:
+            delay = self.retry.backoff(job['retries'])
+            job['retries'] += 1
+            if self.scratch != None:
+                self.scratch.release(job)
+            # the whole host waits, in case the error was throttling
+            self.retry.pause(job['song'].link, delay)
+            Debug.print(f"Transient error (code {returncode}), trying again in {delay:.1f} seconds ({job['retries']}/{self.retry.retries}): " +
+                        f"{job['song'].title} | {job['song'].artists} | {job['song'].album} | {job['song'].link}", 1)
+            self.retry_number += 1
+            heapq.heappush(self.retrying, (time.monotonic() + delay, self.retry_number, job))
+            return
+        if returncode == 0 and output_filename != None and self.transcoder != None:
+            source_path = os.path.join(job['work_dir'], output_filename)
+            future = self.transcode_executor.submit(self.transcoder.transcode, job['song'], source_path, job['work_dir'], job['target_name'])
+            self.running[future] = ('transcode', job)
+            return
+        self.finish_job(job, returncode, output_filename)
+
+    def finish_job(self, job, returncode, output_filename):
+        song = job['song']
+        if self.scratch != None:
+            # the song is only added to the manifest and playlist file once it is complete in its folder
+            if returncode == 0 and output_filename != None:
+                try:
+                    self.scratch.publish(os.path.join(job['work_dir'], output_filename), os.path.join(job['target_dir'], output_filename))
+                except OSError as err:
+                    Debug.write(f"Downloaded file could not be moved from the scratch directory to {job['target_dir']}.\n{err}")
+                    returncode = 1
+                    job['error'] = str(err)
+            self.scratch.release(job)
+        if self.metrics != None:
+            status = 'downloaded' if returncode == 0 else 'failed'
+            self.metrics.write_song(job['playlist'], job['position'], song, status, returncode, job['target_dir'], output_filename, job['phases'],
+                                    job['retries'], job['transcode'])
+        waiting = [job]
+        if job['store_name'] != None:
+            waiting = self.store_waiting.pop(job['store_name'])
+        if returncode != 0:
+            self.errors += len(waiting)
+            Debug.print(f'An error (code {returncode}) occurred downloading song: {song.title} | {song.artists} | {song.album} | {song.link}', 1)
+            if self.failed != None:
+                error = job.get('error')
+                kind = 'transient' if self.retry.is_transient(error) else 'permanent'
+                for waiting_job in waiting:
+                    self.failed.add(waiting_job['playlist'], waiting_job['position'], waiting_job['song'], returncode, error, kind, job['retries'])
+        elif output_filename != None:
+            if self.prefetch and self.manifest != None and 'total' in job['phases']:
+                self.manifest.record_download_time(song.link, job['phases']['total'])
+            if job['store_name'] != None and self.manifest != None:
+                self.manifest.record(ContentStore.DIRNAME, ContentStore.DIRNAME, 0, song, job['store_name'], output_filename)
+            for waiting_job in waiting:
+                path = output_filename
+                if job['store_name'] != None:
+                    path = self.store.link(output_filename, self.playlists[waiting_job['playlist']]['full_dir'], waiting_job['file_name'])
+                self.finish_song(waiting_job, path)
+
+    def finish_song(self, job, path):
+        state = self.playlists[job['playlist']]
+        if self.failed != None:
+            self.failed.remove(job['playlist'], job['song'])
+        if self.createplaylistfile:
+            state['paths'][job['position']] = path
+        if self.manifest != None:
+            self.manifest.record(job['playlist'], state['dir'], job['position'], job['song'], job['file_name'], path)
+
+
+def download_songs(songs, outdir, outputformat, createplaylistfile, backend, jobs=1, playlist_jobs=0, manifest=None, store=None, metrics=None,
+                   transcoder=None, transcode_jobs=1, prefetch=False, retry=None, failed=None, positions=None, executor=None, progress=None, shard=None,
+                   batch=False, scratch=None):
+    scheduler = DownloadScheduler(outdir, outputformat, createplaylistfile, backend, jobs, playlist_jobs, manifest, store, metrics, transcoder, transcode_jobs,
+                                  prefetch, retry, failed, executor, progress, shard, batch, scratch)
+    scheduler.run(songs, positions)
+
+
+OUTPUTFORMAT_FIELD_RE = re.compile('%%\\((\\w+)\\)')
+OUTPUTFORMAT_FIELDS = {
+    'title': 'title',
+    'artists': 'artists',
+    'artist': 'artists',
+    'album': 'album',
+    'link': 'link',
+    'playlist': 'playlist'
+}
+
+def parse_outputformat(outputformat):
+    # split the format once into (literal text, song field) parts, so formatting a song is a single join
     if outputformat == None or outputformat == "":
-        return f'{song.artists} -- {song.title}'
-    output = outputformat\
-        .replace('%%(title)', song.title)\
-        .replace('%%(artists)', song.artists)\
-        .replace('%%(artist)', song.artists)\
-        .replace('%%(album)', song.album)\
-        .replace('%%(link)', song.link)\
-        .replace('%%(playlist)', song.playlist)
-    return filter_file_str(output)
+        outputformat = '%%(artists) -- %%(title)'
+    template = []
+    start = 0
+    for match in OUTPUTFORMAT_FIELD_RE.finditer(outputformat):
+        field = OUTPUTFORMAT_FIELDS.get(match.group(1))
+        if field == None:
+            # unknown fields are kept as literal text
+            continue
+        template.append((outputformat[start:match.start()], field))
+        start = match.end()
+    template.append((outputformat[start:], None))
+    return template
 
-def sanitise(metadata):
-    return metadata.replace('\\', "\\\\").replace("'", "\\'").replace('"', '\\"')
+def format_songfilename(template, song):
+    output = ''.join(literal + (getattr(song, field) if field != None else '') for literal, field in template)
+    return filter_file_str(output)
 
-def run_ytdlp_on_song(song, outdir, outputformat, ytdlpcmd, ffmpegpath, configpath):
-    Debug.print(f'Downloading song... {song.playlist} | {song.title} | {song.artists} | {song.album} | {song.link}', 1)
-    verbose_opt = ""
+# added to the name of files downloaded for the transcode stage
+SOURCE_SUFFIX = '.source'
+# prefix of the line yt-dlp prints after moving the file to its final location
+FILEPATH_MARKER = '@@song_downloader:filepath '
+# prefix of the lines yt-dlp prints when it starts the next phase of downloading a song
+PHASE_MARKER = '@@song_downloader:phase '
+# prefix and fields of the lines yt-dlp prints while downloading with --progress: downloaded bytes, total bytes, estimated total bytes and speed
+PROGRESS_MARKER = '@@song_downloader:progress '
+PROGRESS_TEMPLATE = '%(progress.downloaded_bytes)s %(progress.total_bytes)s %(progress.total_bytes_estimate)s %(progress.speed)s'
+
+def parse_progress_line(line):
+    # returns the downloaded bytes, total bytes and speed, None for the fields yt-dlp does not know (`NA')
+    values = []
+    for field in (line.split() + ['NA'] * 4)[:4]:
+        try:
+            values.append(float(field))
+        except ValueError:
+            values.append(None)
+    downloaded, total, estimate, speed = values
+    return (downloaded, total if total != None else estimate, speed)
+
+# prefix of the lines yt-dlp prints with --batch-playlists, when it starts a song (followed by the link) and after moving its file (followed by JSON)
+SONG_MARKER = '@@song_downloader:song '
+BATCH_MARKER = '@@song_downloader:batch '
+# maximum number of songs downloaded by one yt-dlp process with --batch-playlists
+BATCH_SIZE = 200
+# error of yt-dlp for one link of a batch, e.g. `ERROR: [youtube] dQw4w9WgXcQ: Video unavailable'
+BATCH_ERROR_RE = re.compile(r'ERROR: \[[^\]]+\] ([^:\s]+):')
+
+def link_id(link):
+    # the id yt-dlp reports for a link: the `v' parameter of a YouTube watch link, otherwise the last part of the path (youtu.be, shorts, ...)
+    parts = urllib.parse.urlsplit(link)
+    video = urllib.parse.parse_qs(parts.query).get('v')
+    if video != None:
+        return video[0]
+    path = parts.path.rstrip('/')
+    return path.rsplit('/', 1)[-1] if path != '' else None
+
+# prefix of the lines yt-dlp prints with the metadata of a link for --prefetch
+METADATA_MARKER = '@@song_downloader:metadata '
+# number of links whose metadata is fetched by one yt-dlp process
+PREFETCH_BATCH_SIZE = 50
+
+def parse_metadata_line(line, metadata):
+    # adds the duration and file size of one entry to `metadata'. A playlist link prints a line for every entry, which are summed.
+    try:
+        info = json.loads(line)
+    except ValueError:
+        return
+    link = info.get('original_url')
+    if link == None:
+        return
+    duration = info.get('duration')
+    filesize = info.get('filesize') or info.get('filesize_approx')
+    if link in metadata:
+        old_duration, old_filesize = metadata[link]
+        duration = old_duration + duration if old_duration != None and duration != None else (old_duration or duration)
+        filesize = old_filesize + filesize if old_filesize != None and filesize != None else (old_filesize or filesize)
+    metadata[link] = (duration, filesize)
+
+def ytdlp_verbosity_args():
     if Debug.quiet or Debug.verbosity <= 1:
-        verbose_opt = "--quiet "
-    elif Debug.verbosity > 1:
-        verbose_opt = "-" + 'v' * (Debug.verbosity - 1) + " "
-    
-    # add space add the end for single-word strings, to force it to interpret it as literals
-    title = sanitise(song.title if ' ' in song.title else f'{song.title} ')
-    artists = sanitise(song.artists if ' ' in song.artists else f'{song.artists} ')
-    album = sanitise(song.album if ' ' in song.album else f'{song.album} ')
-
-    escaped_outdir = sanitise(outdir)
-
-    command_download = f'{shlex.quote(ytdlpcmd)} --ffmpeg-location {shlex.quote(ffmpegpath)} \
---embed-metadata --parse-metadata "{title}:%(meta_title)s" --parse-metadata "{artists}:%(meta_artist)s" --parse-metadata "{album}:%(meta_album)s" \
---config-locations {shlex.quote(configpath)} -P {shlex.quote(escaped_outdir)} -o {shlex.quote(outputformat)} {verbose_opt}-- {shlex.quote(song.link)}'
-    
-    Debug.print(f'command: {command_download}\n\n', 2)
-    command_args = shlex.split(command_download)
-    proc = subprocess.run(command_args)
-    Debug.print(f"\nYT-DLP exited with code {proc.returncode}", 2)
-
-    # run in simulate mode and print filepath to stdin
-    Debug.print('Simulating download and printing filepath...', 2)
-    command_filename = f'{shlex.quote(ytdlpcmd)} --print after_move:filepath --quiet \
---config-locations {shlex.quote(configpath)} -P {shlex.quote(escaped_outdir)} -o {shlex.quote(outputformat)} -- {shlex.quote(song.link)}'
-    
-    Debug.print(f'command: {command_filename}\n\n', 2)
-    command_args_print = shlex.split(command_filename)
-    proc_print = subprocess.run(command_args_print, shell=True, stdout=subprocess.PIPE)
-    Debug.print(f"YT-DLP exited with code {proc_print.returncode}", 2)
+        return ['--quiet']
+    return ['-' + 'v' * (Debug.verbosity - 1)]
+
+def ytdlp_common_args(ffmpegpath, configpath, source_only=False):
+    if source_only:
+        # only the best audio stream is downloaded as is, it is transcoded and tagged afterwards
+        return ['--ffmpeg-location', ffmpegpath, '--config-locations', configpath, '--encoding', 'utf-8', '-f', 'bestaudio/best']
+    return ['--ffmpeg-location', ffmpegpath, '--embed-metadata', '--config-locations', configpath, '--encoding', 'utf-8']
+
+def ytdlp_outputformat(outputformat, source_only=False):
+    # '%' in the file name would otherwise be read as the start of a yt-dlp output template field
+    outputformat = outputformat.replace('%', '%%')
+    if source_only:
+        return f'{outputformat}{SOURCE_SUFFIX}.%(ext)s'
+    return outputformat
+
+def metadata_literal(metadata):
+    # add space add the end for single-word strings, to force yt-dlp to interpret it as literals
+    return metadata if ' ' in metadata else f'{metadata} '
+
+def run_ffmpeg(command_args):
+    # the output of ffmpeg (only errors with -loglevel error) is shown with the other output, which is not the terminal with --serve
+    proc = subprocess.run(command_args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf-8', errors='replace')
+    if proc.stdout != '':
+        Debug.write(proc.stdout.rstrip('\n'))
+    return proc
+
+def tag_songfiles(files, ffmpegpath):
+    # files: (path, song). Writes the title, artists and album of the catalogue into the files of a batch, with mutagen if it is installed.
+    # Otherwise ffmpeg copies the streams of every file into a new file with the tags, without converting them.
     try:
-        file_name = proc_print.stdout.split(b'\\')[-1].decode(encoding='mbcs', errors='strict').strip() # if this throws an error, i should probably just clean up all file names in the first place
+        import mutagen
+    except ImportError:
+        mutagen = None
+    for path, song in files:
+        tags = [(key, value) for key, value in (('title', song.title), ('artist', song.artists), ('album', song.album)) if value != None and value != '']
+        if mutagen != None:
+            try:
+                audio = mutagen.File(path, easy=True)
+                if audio != None:
+                    if audio.tags == None:
+                        audio.add_tags()
+                    for key, value in tags:
+                        audio[key] = value
+                    audio.save()
+                    continue
+            except mutagen.MutagenError as err:
+                Debug.print(f"mutagen could not write the tags of {path}, trying ffmpeg: {err}", 2)
+        root, ext = os.path.splitext(path)
+        temp_path = f'{root}.tagging{ext}'
+        command_args = [ffmpegpath, '-y', '-hide_banner', '-loglevel', 'error', '-i', path, '-map', '0', '-c', 'copy']
+        for key, value in tags:
+            command_args += ['-metadata', f'{key}={value}']
+        command_args.append(temp_path)
+        Debug.print(f'command: {shlex.join(command_args)}\n', 2)
+        try:
+            proc = run_ffmpeg(command_args)
+        except OSError as err:
+            Debug.write(f"ffmpeg could not be started to tag the downloaded songs. Check --ffmpeg-location, or install mutagen.\n{err}")
+            return
+        if proc.returncode != 0:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            Debug.print(f"Could not write the tags of {path} (ffmpeg exited with code {proc.returncode}).", 1)
+            continue
+        os.replace(temp_path, path)
+
+def download_batch_sequentially(backend, songs, outdir, names, phases):
+    # for the backends that keep yt-dlp loaded in every worker, a batch only downloads its songs one after another
+    results = []
+    for song, name in zip(songs, names):
+        if backend.progress != None:
+            backend.progress.song_started(song)
+        song_phases = {}
+        results.append(backend.download(song, outdir, name, song_phases))
+        for phase, seconds in song_phases.items():
+            phases[phase] = phases.get(phase, 0.0) + seconds
+    return results
+
+
+# Runs the yt-dlp executable (--ytdlp-cmd) once for every song, or once for every batch with --batch-playlists.
+class SubprocessBackend:
+
+    def __init__(self, ytdlpcmd, ffmpegpath, configpath, source_only=False):
+        self.ytdlpcmd = ytdlpcmd
+        self.ffmpegpath = ffmpegpath
+        self.source_only = source_only
+        self.common_args = ytdlp_common_args(ffmpegpath, configpath, source_only)
+        self.startup = None
+        # ProgressDashboard that gets the download progress of every song, if set
+        self.progress = None
+
+    def measure_startup(self):
+        # yt-dlp does not report when it is done starting, so the startup time is estimated once with `--version'
+        start = time.perf_counter()
+        try:
+            subprocess.run([self.ytdlpcmd, '--version'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as err:
+            Debug.print(f"Could not run yt-dlp to measure its startup time: {err}", 1)
+            return
+        self.startup = time.perf_counter() - start
+
+    def download(self, song, outdir, outputformat, phases):
+        # --print implies --quiet, so it has to be turned off again explicitly to see the yt-dlp output
+        verbose_args = ytdlp_verbosity_args()
+        if verbose_args != ['--quiet']:
+            verbose_args = ['--no-quiet'] + verbose_args
+
+        metadata_args = []
+        if not self.source_only:
+            metadata_args = [
+                '--parse-metadata', f'{metadata_literal(song.title)}:%(meta_title)s',
+                '--parse-metadata', f'{metadata_literal(song.artists)}:%(meta_artist)s',
+                '--parse-metadata', f'{metadata_literal(song.album)}:%(meta_album)s'
+            ]
+        progress_args = []
+        if self.progress != None:
+            # one machine-readable line per progress update, instead of the progress bar
+            progress_args = ['--progress', '--newline', '--progress-template', f'download:{PROGRESS_MARKER}{PROGRESS_TEMPLATE}']
+        # the final file path is printed on stdout by the same run, so yt-dlp only has to start and extract once.
+        command_args = [self.ytdlpcmd] + self.common_args + metadata_args + progress_args + [
+            '-P', outdir, '-o', ytdlp_outputformat(outputformat, self.source_only),
+            '--no-simulate', '--print', f'after_move:{FILEPATH_MARKER}%(filepath)s',
+            '--print', f'before_dl:{PHASE_MARKER}download', '--print', f'post_process:{PHASE_MARKER}postprocess'
+        ] + verbose_args + ['--', song.link]
+
+        Debug.print(f'command: {shlex.join(command_args)}\n\n', 2)
+        phase = 'extract'
+        phase_start = time.perf_counter()
+        # stderr is read along with stdout, to keep the error message of a failed download
+        proc = subprocess.Popen(command_args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        file_path = None
+        errors = []
+        for raw_line in proc.stdout:
+            try:
+                line = raw_line.decode(encoding='utf-8', errors='strict').rstrip('\r\n')
+            except UnicodeDecodeError as err:
+                Debug.print(f"Failed to decode yt-dlp output for {outputformat}.", 1)
+                continue
+            if line.startswith(FILEPATH_MARKER):
+                file_path = line[len(FILEPATH_MARKER):]
+            elif line.startswith(PROGRESS_MARKER):
+                if self.progress != None:
+                    self.progress.song_progress(*parse_progress_line(line[len(PROGRESS_MARKER):]))
+            elif line.startswith(PHASE_MARKER):
+                now = time.perf_counter()
+                phases[phase] = now - phase_start
+                phase = line[len(PHASE_MARKER):]
+                phase_start = now
+            else:
+                # any other output is from yt-dlp itself, which is already silenced with --quiet if needed
+                if line.startswith('ERROR:'):
+                    errors.append(line)
+                Debug.write(line)
+        proc.wait()
+        phases[phase] = time.perf_counter() - phase_start
+        if self.startup != None:
+            phases['startup'] = min(self.startup, phases['extract'])
+            phases['extract'] -= phases['startup']
+        Debug.print(f"\nYT-DLP exited with code {proc.returncode}", 2)
+        error = '\n'.join(errors) if len(errors) > 0 else None
+
+        if file_path == None or file_path == "":
+            if proc.returncode == 0:
+                Debug.write(f"Failed to read file name from yt-dlp output for {outputformat}. Not adding this song to m3u8 file.")
+            return (proc.returncode, None, error)
+        return (proc.returncode, os.path.basename(file_path), error)
+
+    def download_batch(self, songs, outdir, names, phases):
+        # returns (return code, file name, error) of every song. The songs are downloaded by one yt-dlp process from a batch file,
+        # named by the id of their link and renamed to `names' afterwards. Instead of --parse-metadata for every song, they are tagged in a separate pass.
+        verbose_args = ytdlp_verbosity_args()
+        if verbose_args != ['--quiet']:
+            verbose_args = ['--no-quiet'] + verbose_args
+        progress_args = []
+        if self.progress != None:
+            progress_args = ['--progress', '--newline', '--progress-template', f'download:{PROGRESS_MARKER}{PROGRESS_TEMPLATE}']
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', suffix='.txt', delete=False) as writer:
+            writer.writelines(f'{song.link}\n' for song in songs)
+            batchfile = writer.name
+        command_args = [self.ytdlpcmd] + self.common_args + progress_args + [
+            '-P', outdir, '-o', '%(id)s.batch.%(ext)s', '--no-simulate', '--ignore-errors',
+            '--print', f'before_dl:{SONG_MARKER}%(original_url)s',
+            '--print', f'after_move:{BATCH_MARKER}%(.{{original_url,webpage_url,id,filepath}})j'
+        ] + verbose_args + ['--batch-file', batchfile]
+
+        Debug.print(f'command: {shlex.join(command_args)}\n\n', 2)
+        indices = {song.link: i for i, song in enumerate(songs)}
+        # id -> songs, for the output of yt-dlp that has no link. Two links of the same video have the same id.
+        ids = {}
+        for i, song in enumerate(songs):
+            ids.setdefault(link_id(song.link), []).append(i)
+        file_paths = [None] * len(songs)
+        song_errors = [[] for song in songs]
+        errors = []
+        start = time.perf_counter()
+        try:
+            proc = subprocess.Popen(command_args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            for raw_line in proc.stdout:
+                try:
+                    line = raw_line.decode(encoding='utf-8', errors='strict').rstrip('\r\n')
+                except UnicodeDecodeError as err:
+                    Debug.print(f"Failed to decode yt-dlp output for the batch of {songs[0].playlist}.", 1)
+                    continue
+                if line.startswith(BATCH_MARKER):
+                    try:
+                        info = json.loads(line[len(BATCH_MARKER):])
+                    except ValueError:
+                        continue
+                    i = indices.get(info.get('original_url'), indices.get(info.get('webpage_url')))
+                    if i == None and info.get('id') != None:
+                        # e.g. a link that redirects, the id is still the id of the link
+                        i = next((j for j in ids.get(info['id'], []) if file_paths[j] == None), None)
+                    if i != None:
+                        file_paths[i] = info.get('filepath')
+                elif line.startswith(SONG_MARKER):
+                    i = indices.get(line[len(SONG_MARKER):])
+                    if self.progress != None and i != None:
+                        self.progress.song_started(songs[i])
+                elif line.startswith(PROGRESS_MARKER):
+                    if self.progress != None:
+                        self.progress.song_progress(*parse_progress_line(line[len(PROGRESS_MARKER):]))
+                else:
+                    if line.startswith('ERROR:'):
+                        match = BATCH_ERROR_RE.match(line)
+                        failed = ids.get(match[1], []) if match != None else []
+                        for i in failed:
+                            song_errors[i].append(line)
+                        if len(failed) == 0:
+                            errors.append(line)
+                    Debug.write(line)
+            proc.wait()
+        finally:
+            os.remove(batchfile)
+        phases['download'] = time.perf_counter() - start
+        Debug.print(f"\nYT-DLP exited with code {proc.returncode}", 2)
+
+        results = []
+        tagged = []
+        # temporary path -> new path, for two links of the same video
+        renamed = {}
+        for i, song in enumerate(songs):
+            file_path = file_paths[i]
+            if file_path == None or not (os.path.exists(file_path) or file_path in renamed):
+                error = '\n'.join(song_errors[i] if len(song_errors[i]) > 0 else errors)
+                if error == '':
+                    error = 'yt-dlp did not report a file for this song.'
+                results.append((proc.returncode if proc.returncode != 0 else 1, None, error))
+                continue
+            file_name = names[i] + (SOURCE_SUFFIX if self.source_only else '') + os.path.splitext(file_path)[1]
+            new_path = os.path.join(outdir, file_name)
+            if file_path in renamed:
+                shutil.copy2(renamed[file_path], new_path)
+            else:
+                os.replace(file_path, new_path)
+                renamed[file_path] = new_path
+            tagged.append((new_path, song))
+            results.append((0, file_name, None))
+        # the transcode stage of --split-transcode writes the tags itself
+        if not self.source_only:
+            start = time.perf_counter()
+            tag_songfiles(tagged, self.ffmpegpath)
+            phases['tag'] = time.perf_counter() - start
+        return results
+
+    def prefetch(self, links):
+        # returns link -> (duration, filesize) for the links yt-dlp could extract, fetched by a single yt-dlp process
+        command_args = [self.ytdlpcmd] + self.common_args + [
+            '--ignore-errors', '--no-warnings',
+            '--print', f'{METADATA_MARKER}%(.{{original_url,duration,filesize,filesize_approx}})j'
+        ] + ytdlp_verbosity_args() + ['--'] + links
+        Debug.print(f'command: {shlex.join(command_args)}\n\n', 2)
+        metadata = {}
+        try:
+            proc = subprocess.run(command_args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf-8', errors='replace')
+        except OSError as err:
+            Debug.write(f"yt-dlp could not be started to fetch metadata. Check --ytdlp-cmd.\n{err}")
+            return metadata
+        for line in proc.stdout.splitlines():
+            if line.startswith(METADATA_MARKER):
+                parse_metadata_line(line[len(METADATA_MARKER):], metadata)
+            else:
+                Debug.write(line)
+        return metadata
+
+    def close(self):
+        pass
+
+
+# Sends the messages of yt-dlp to the same output as the rest of the script instead of the terminal
+class YtdlpLogger:
+
+    def debug(self, msg):
+        # yt-dlp also sends its normal [download] lines as debug messages
+        if not Debug.quiet and Debug.verbosity > 1:
+            Debug.write(msg)
+
+    def info(self, msg):
+        Debug.write(msg)
+
+    def warning(self, msg):
+        Debug.write(msg)
+
+    def error(self, msg):
+        Debug.write(msg)
+
+
+# Runs yt-dlp as a python library. Every worker thread keeps one YoutubeDL instance for the whole run,
+# so the interpreter, extractors and connections are only set up once.
+class LibraryBackend:
+
+    def __init__(self, ffmpegpath, configpath, source_only=False):
+        try:
+            import yt_dlp
+        except ImportError:
+            Debug.write("The yt-dlp python package is not installed, which is required for --backend library. Install it with `pip install yt-dlp', or use --backend subprocess.")
+            exit(5)
+        self.yt_dlp = yt_dlp
+        # same options as the command line, so the config file is read the same way as the subprocess backend
+        self.source_only = source_only
+        self.ydl_opts = yt_dlp.parse_options(ytdlp_common_args(ffmpegpath, configpath, source_only) + ytdlp_verbosity_args()).ydl_opts
+        self.ydl_opts['logger'] = YtdlpLogger()
+        self.local = threading.local()
+        self.instances = []
+        self.lock = threading.Lock()
+        self.progress = None
+
+    def measure_startup(self):
+        # the startup time is measured for the first song of every worker
+        pass
+
+    def get_ydl(self, phases):
+        ydl = getattr(self.local, 'ydl', None)
+        if ydl == None:
+            start = time.perf_counter()
+            ydl = self.yt_dlp.YoutubeDL(dict(self.ydl_opts))
+            ydl.add_progress_hook(self.progress_hook)
+            ydl.add_postprocessor_hook(self.postprocessor_hook)
+            phases['startup'] = time.perf_counter() - start
+            self.local.ydl = ydl
+            with self.lock:
+                self.instances.append(ydl)
+        return ydl
+
+    def progress_hook(self, d):
+        if d['status'] == 'finished':
+            self.local.download_end = time.perf_counter()
+        elif d['status'] == 'downloading' and self.progress != None:
+            self.progress.song_progress(d.get('downloaded_bytes'), d.get('total_bytes') or d.get('total_bytes_estimate'), d.get('speed'))
+
+    def postprocessor_hook(self, d):
+        # MoveFiles is the last step, after which the file is at its final location
+        if d['status'] == 'finished' and d['postprocessor'] == 'MoveFiles':
+            self.local.file_path = d['info_dict'].get('filepath')
+
+    def download(self, song, outdir, outputformat, phases):
+        ydl = self.get_ydl(phases)
+        ydl.params['paths'] = {**ydl.params.get('paths', {}), 'home': outdir}
+        ydl.params['outtmpl'] = {**ydl.params.get('outtmpl', {}), 'default': ytdlp_outputformat(outputformat, self.source_only)}
+        self.local.file_path = None
+        self.local.download_end = None
+        start = time.perf_counter()
+        try:
+            info = ydl.extract_info(song.link, download=False, process=False)
+            download_start = time.perf_counter()
+            phases['extract'] = download_start - start
+            # the same fields --parse-metadata sets, which are embedded by --embed-metadata
+            info['meta_title'] = song.title
+            info['meta_artist'] = song.artists
+            info['meta_album'] = song.album
+            ydl.process_ie_result(info, download=True)
+        except Exception as err:
+            Debug.print(f"yt-dlp failed: {err}", 2)
+            return (1, None, str(err))
+        end = time.perf_counter()
+        download_end = self.local.download_end if self.local.download_end != None else end
+        phases['download'] = download_end - download_start
+        phases['postprocess'] = end - download_end
+
+        file_path = self.local.file_path
+        if file_path == None or file_path == "":
+            Debug.write(f"Failed to read file name from yt-dlp for {outputformat}. Not adding this song to m3u8 file.")
+            return (0, None, None)
+        return (0, os.path.basename(file_path), None)
+
+    def download_batch(self, songs, outdir, names, phases):
+        return download_batch_sequentially(self, songs, outdir, names, phases)
+
+    def prefetch(self, links):
+        # returns link -> (duration, filesize) for the links yt-dlp could extract, with the YoutubeDL instance of this worker
+        ydl = self.get_ydl({})
+        metadata = {}
+        for link in links:
+            try:
+                info = ydl.extract_info(link, download=False)
+            except Exception as err:
+                Debug.print(f"yt-dlp failed to fetch metadata of {link}: {err}", 2)
+                continue
+            for entry in info.get('entries') or [info]:
+                if entry != None:
+                    parse_metadata_line(json.dumps({**entry, 'original_url': link}, default=str), metadata)
+        return metadata
+
+    def close(self):
+        for ydl in self.instances:
+            ydl.close()
+
+
+# Does not access the network. Writes a small placeholder file for every song, after waiting `delay` seconds.
+# Links starting with `fail' return a permanent error, links starting with `flaky' a transient error the first time they are downloaded.
+# Used to test and benchmark the download path offline. Every link has a fake duration between 1 and 10 minutes from a hash of the link, which scales the delay.
+class FakeBackend:
+    AVERAGE_DURATION = 330.0
+
+    def __init__(self, delay=0.0, source_only=False):
+        self.delay = delay
+        self.source_only = source_only
+        self.attempted = set()
+        self.lock = threading.Lock()
+        self.progress = None
+
+    def measure_startup(self):
+        pass
+
+    def duration(self, link):
+        return 60 + int(hashlib.sha1(link.encode('utf-8')).hexdigest()[:8], 16) % 541
+
+    def download(self, song, outdir, outputformat, phases):
+        start = time.perf_counter()
+        if self.delay > 0:
+            delay = self.delay * self.duration(song.link) / self.AVERAGE_DURATION
+            # the size of a 128 kbit/s file, reported in steps like a real download
+            size = self.duration(song.link) * 16000
+            for step in range(1, 11):
+                time.sleep(delay / 10)
+                if self.progress != None:
+                    self.progress.song_progress(size * step / 10, size, size / delay)
+        phases['download'] = time.perf_counter() - start
+        if song.link.startswith('fail'):
+            return (1, None, 'ERROR: [fake] Video unavailable')
+        if song.link.startswith('flaky'):
+            with self.lock:
+                first = song.link not in self.attempted
+                self.attempted.add(song.link)
+            if first:
+                return (1, None, 'ERROR: [fake] Unable to download webpage: HTTP Error 429: Too Many Requests')
+        file_name = f'{outputformat}{SOURCE_SUFFIX}.webm' if self.source_only else f'{outputformat}.mp3'
+        os.makedirs(outdir, exist_ok=True)
+        with open(os.path.join(outdir, file_name), 'w', encoding='utf-8') as writer:
+            writer.write(f'{song.title}\n{song.artists}\n{song.album}\n{song.link}\n')
+        return (0, file_name, None)
+
+    def download_batch(self, songs, outdir, names, phases):
+        return download_batch_sequentially(self, songs, outdir, names, phases)
+
+    def prefetch(self, links):
+        return {link: (self.duration(link), self.duration(link) * 16000) for link in links if not link.startswith('fail')}
+
+    def close(self):
+        pass
+
+
+def create_backend(name, ytdlpcmd, ffmpegpath, configpath, fake_delay=0.0, source_only=False):
+    if name == 'library':
+        return LibraryBackend(ffmpegpath, configpath, source_only)
+    elif name == 'fake':
+        return FakeBackend(fake_delay, source_only)
+    return SubprocessBackend(ytdlpcmd, ffmpegpath, configpath, source_only)
+
+
+# prefix of the lines yt-dlp prints for every search result with --resolve-links
+RESOLVE_MARKER = '@@song_downloader:resolved '
+# number of songs that are searched by one yt-dlp process
+RESOLVE_BATCH_SIZE = 20
+
+def resolve_query(song):
+    return f'{song.artists} - {song.title}'
+
+# Finds the link of a song by searching YouTube with yt-dlp (ytsearch). One yt-dlp process searches a whole batch of songs.
+class YtSearchResolver:
+    NAME = 'ytsearch'
+
+    def __init__(self, ytdlpcmd):
+        self.ytdlpcmd = ytdlpcmd
+
+    def resolve(self, queries):
+        # returns query -> link, or '' if nothing was found. Queries that could not be searched (e.g. no network) are left out.
+        command_args = [self.ytdlpcmd, '--flat-playlist', '--ignore-errors', '--no-warnings', '--encoding', 'utf-8',
+                        '--print', f'{RESOLVE_MARKER}%(.{{playlist_id,url,webpage_url}})j', '--'] + [f'ytsearch1:{query}' for query in queries]
+        Debug.print(f'command: {shlex.join(command_args)}\n\n', 2)
+        try:
+            proc = subprocess.run(command_args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf-8', errors='replace')
+        except OSError as err:
+            Debug.write(f"yt-dlp could not be started to search for links. Check --ytdlp-cmd.\n{err}")
+            return {}
+        links = {}
+        for line in proc.stdout.splitlines():
+            if not line.startswith(RESOLVE_MARKER):
+                Debug.write(line)
+                continue
+            try:
+                info = json.loads(line[len(RESOLVE_MARKER):])
+            except ValueError:
+                continue
+            # the id of a search result playlist is the query
+            link = info.get('webpage_url') or info.get('url')
+            if info.get('playlist_id') in queries and link != None:
+                links[info['playlist_id']] = link
+        if proc.returncode == 0:
+            # only a search that ran without errors can tell that nothing was found
+            for query in queries:
+                links.setdefault(query, '')
+        return links
+
+# Does not access the network. Finds a fixed fake link for every song, except for songs with `missing' in the title or artists.
+# Used to test the resolver stage offline.
+class FakeResolver:
+    NAME = 'fake'
+
+    def resolve(self, queries):
+        links = {}
+        for query in queries:
+            if 'missing' in query.casefold():
+                links[query] = ''
+            else:
+                links[query] = f"https://fake.invalid/watch?v={hashlib.sha1(query.encode('utf-8')).hexdigest()[:11]}"
+        return links
+
+def create_resolver(name, ytdlpcmd):
+    if name == 'fake':
+        return FakeResolver()
+    return YtSearchResolver(ytdlpcmd)
+
+
+# Links found by the resolvers, by resolver and search query, so the same song is only searched once.
+# Songs for which nothing was found are stored too, with an empty link. Entries older than `ttl' seconds are searched again.
+class LinkCache:
+
+    def __init__(self, path, ttl):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.db = sqlite3.connect(path)
+        except (OSError, sqlite3.Error) as err:
+            Debug.write(f"Link cache could not be opened: {path}\n{err}")
+            exit(4)
+        self.ttl = ttl
+        self.db.execute('''CREATE TABLE IF NOT EXISTS links (
+            key TEXT PRIMARY KEY,
+            link TEXT NOT NULL,
+            time REAL NOT NULL
+        )''')
+        self.db.commit()
+
+    def lookup(self, keys):
+        links = {}
+        oldest = time.time() - self.ttl
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            query = f"SELECT key, link FROM links WHERE time >= ? AND key IN ({', '.join('?' * len(batch))})"
+            for key, link in self.db.execute(query, [oldest] + batch):
+                links[key] = link
+        return links
+
+    def record(self, links):
+        now = time.time()
+        self.db.executemany('INSERT OR REPLACE INTO links VALUES (?, ?, ?)', [(key, link, now) for key, link in links.items()])
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def resolve_batch(songs, resolver, cache, executor):
+    # finds links for the songs without one, returns the number of songs that got a link
+    queries = {}
+    for song in songs:
+        if song.link == None or song.link == "":
+            query = resolve_query(song)
+            queries[f'{resolver.NAME}\0{normalise_str(query)}'] = query
+    if len(queries) == 0:
+        return 0
+    keys = list(queries)
+    links = cache.lookup(keys) if cache != None else {}
+    missing = [key for key in keys if key not in links]
+    # every batch is searched by one resolver call, the batches run at the same time
+    batches = [missing[i:i + RESOLVE_BATCH_SIZE] for i in range(0, len(missing), RESOLVE_BATCH_SIZE)]
+    futures = [(batch, executor.submit(resolver.resolve, [queries[key] for key in batch])) for batch in batches]
+    found = {}
+    for batch, future in futures:
+        results = future.result()
+        for key in batch:
+            if queries[key] in results:
+                found[key] = results[queries[key]]
+    if cache != None:
+        cache.record(found)
+    links.update(found)
+
+    resolved = 0
+    for song in songs:
+        if song.link == None or song.link == "":
+            link = links.get(f'{resolver.NAME}\0{normalise_str(resolve_query(song))}')
+            if link:
+                song.link = link
+                resolved += 1
+                Debug.print(f'Resolved link: {song.title} | {song.artists} | {song.album} | {link}', 1)
+            else:
+                Debug.print(f'No link found: {song.title} | {song.artists} | {song.album}', 1)
+    return resolved
+
+def resolve_links(songs, stats, resolver, cache=None, workers=1):
+    # generator that finds links for the songs without one, in batches while the songs are read, and yields all songs in order
+    stats['resolve_links'] = True
+    window = RESOLVE_BATCH_SIZE * workers
+    executor = ThreadPoolExecutor(max_workers=workers)
+    resolved = 0
+    buffer = []
+    unresolved = 0
+    try:
+        for song in songs:
+            buffer.append(song)
+            if song.link == None or song.link == "":
+                unresolved += 1
+            # the buffer is also limited when most songs already have a link, to keep the songs streaming
+            if unresolved >= window or len(buffer) >= 4 * window:
+                resolved += resolve_batch(buffer, resolver, cache, executor)
+                yield from buffer
+                buffer = []
+                unresolved = 0
+        resolved += resolve_batch(buffer, resolver, cache, executor)
+        yield from buffer
+    finally:
+        executor.shutdown()
+        stats['resolved'] += resolved
+        stats['skipped_total_dl'] -= resolved
+
+
+# yt-dlp options that make yt-dlp convert or tag the file itself, which the transcode stage does instead
+EXTRACTION_OPTIONS = ['-x', '--extract-audio', '--embed-metadata', '--add-metadata']
+EXTRACTION_VALUE_OPTIONS = ['--audio-format', '--audio-quality']
+
+def load_ytdlp_config(configpath):
+    # returns the config arguments without the extraction options, and the audio format and quality from the config
+    try:
+        with open(configpath, 'r', encoding='utf-8') as reader:
+            tokens = shlex.split(reader.read(), comments=True)
+    except (IOError, ValueError) as err:
+        Debug.write(f"yt-dlp config could not be read.\n{err}")
+        exit(4)
+    args = []
+    values = {}
+    i = 0
+    while i < len(tokens):
+        option, _, value = tokens[i].partition('=')
+        if tokens[i] in EXTRACTION_OPTIONS:
+            pass
+        elif option in EXTRACTION_VALUE_OPTIONS:
+            if value == '' and i + 1 < len(tokens):
+                i += 1
+                value = tokens[i]
+            values[option] = value
+        else:
+            args.append(tokens[i])
+        i += 1
+    return (args, values.get('--audio-format'), values.get('--audio-quality'))
+
+def write_source_config(configpath):
+    # yt-dlp config for the download stage, which leaves the extraction to the transcode stage
+    args, audio_format, audio_quality = load_ytdlp_config(configpath)
+    writer = tempfile.NamedTemporaryFile('w', encoding='utf-8', suffix='.conf', prefix='song_downloader_', delete=False)
+    with writer:
+        writer.write('# generated from %s without the extraction options\n' % configpath)
+        writer.writelines(shlex.quote(arg) + '\n' for arg in args)
+    return (writer.name, audio_format, audio_quality)
+
+
+# --audio-format -> (file extension, ffmpeg muxer, ffmpeg encoder, codec name), the same formats yt-dlp supports.
+# A source stream with the same codec name is copied instead of encoded again with --codec-aware.
+AUDIO_FORMATS = {
+    'mp3': ('mp3', 'mp3', 'libmp3lame', 'mp3'),
+    'aac': ('m4a', 'ipod', 'aac', 'aac'),
+    'm4a': ('m4a', 'ipod', 'aac', 'aac'),
+    'alac': ('m4a', 'ipod', 'alac', 'alac'),
+    'opus': ('opus', 'opus', 'libopus', 'opus'),
+    'vorbis': ('ogg', 'ogg', 'libvorbis', 'vorbis'),
+    'flac': ('flac', 'flac', 'flac', 'flac'),
+    'wav': ('wav', 'wav', 'pcm_s16le', 'pcm_s16le')
+}
+# file extension of a downloaded source file -> ffmpeg muxer, to keep the container when the format is `best'
+SOURCE_MUXERS = {
+    'webm': 'webm',
+    'm4a': 'ipod',
+    'mp4': 'ipod',
+    'mp3': 'mp3',
+    'ogg': 'ogg',
+    'opus': 'opus',
+    'flac': 'flac',
+    'wav': 'wav'
+}
+# encoder -> (value for --audio-quality 10, value for --audio-quality 0) of the VBR quality option of the encoder.
+# The same table as FFmpegExtractAudioPP._quality_args of yt-dlp, so the transcode stage encodes the same way as yt-dlp itself.
+# Encoders that are not in it are left at their default quality.
+AUDIO_QUALITY_LIMITS = {
+    'libmp3lame': (10, 0),
+    'libvorbis': (0, 10),
+    # the aac encoder of ffmpeg has no upper limit, but above 4 the bitrate hardly changes
+    'aac': (0.1, 4),
+    'libfdk_aac': (1, 5)
+}
+# codec of the first audio stream in the output of `ffmpeg -i', e.g. `Stream #0:0(eng): Audio: opus, 48000 Hz, stereo'
+FFMPEG_AUDIO_RE = re.compile(r'Stream #\d+:\d+.*?: Audio: (\w+)')
+
+# How a source file is turned into the output file:
+# copy: the codec and container already match, only the tags are written.
+# remux: the codec matches, the stream is copied into the container of the format.
+# reencode: the stream is decoded and encoded again.
+TRANSCODE_DECISIONS = ['copy', 'remux', 'reencode']
+
+# Converts a downloaded source file to the --audio-format of the yt-dlp config and writes the title/artists/album tags,
+# with ffmpeg. Runs separately from the downloads, so the network is used while the CPU is encoding.
+# With codec_aware, the codec of the source is probed first, and the stream is copied when it already has the codec of the format.
+class Transcoder:
+
+    def __init__(self, ffmpegpath, audio_format=None, audio_quality=None, codec_aware=False):
+        self.ffmpegpath = ffmpegpath
+        self.audio_format = audio_format if audio_format in AUDIO_FORMATS else None
+        if audio_format != None and audio_format != 'best' and self.audio_format == None:
+            Debug.write(f"Warning: --audio-format {audio_format} is not supported by the transcode stage. The downloaded audio is kept as is.")
+        # the same default quality as yt-dlp, which also ignores a trailing `K'
+        audio_quality = audio_quality if audio_quality != None else '5'
+        try:
+            self.audio_quality = float(audio_quality.strip('k').strip('K'))
+        except ValueError:
+            Debug.write(f"Warning: --audio-quality {audio_quality} is not a number. The default quality of the encoder is used.")
+            self.audio_quality = None
+        self.codec_aware = codec_aware
+        # decision -> [number of songs, seconds spent], only updated from the thread of the scheduler
+        self.decisions = {decision: [0, 0.0] for decision in TRANSCODE_DECISIONS}
+
+    def codec_args(self, encoder):
+        if encoder in ('flac', 'alac', 'pcm_s16le'):
+            return ['-c:a', encoder]
+        return ['-c:a', encoder] + self.quality_args(encoder)
+
+    def quality_args(self, encoder):
+        # the same as yt-dlp: above 10 is a bitrate in kbit/s, otherwise from 0 (best) to 10 (worst) on the scale of the encoder
+        if self.audio_quality == None:
+            return []
+        if self.audio_quality > 10:
+            return ['-b:a', f'{self.audio_quality}k']
+        limits = AUDIO_QUALITY_LIMITS.get(encoder)
+        if limits == None:
+            return []
+        quality = limits[1] + (limits[0] - limits[1]) * (self.audio_quality / 10)
+        if encoder == 'libfdk_aac':
+            return ['-vbr', f'{int(quality)}']
+        return ['-q:a', f'{quality}']
+
+    def probe_codec(self, source_path):
+        # ffmpeg without an output file prints the streams of the input and exits with an error, which is expected here
+        try:
+            proc = subprocess.run([self.ffmpegpath, '-hide_banner', '-i', source_path], stdin=subprocess.DEVNULL,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, encoding='utf-8', errors='replace')
+        except OSError:
+            return None
+        match = FFMPEG_AUDIO_RE.search(proc.stderr)
+        if match == None:
+            return None
+        return match.group(1)
+
+    def decide(self, source_path):
+        # returns the decision, the file extension, the ffmpeg muxer and the codec arguments
+        source_ext = os.path.splitext(source_path)[1][1:].lower()
+        if self.audio_format == None:
+            return ('copy', source_ext, SOURCE_MUXERS.get(source_ext, source_ext), ['-c:a', 'copy'])
+        ext, muxer, encoder, codec = AUDIO_FORMATS[self.audio_format]
+        if self.codec_aware:
+            source_codec = self.probe_codec(source_path)
+            Debug.print(f'Source codec: {source_codec} ({source_path})', 2)
+            if source_codec == codec:
+                decision = 'copy' if source_ext == ext else 'remux'
+                return (decision, ext, muxer, ['-c:a', 'copy'])
+        return ('reencode', ext, muxer, self.codec_args(encoder))
+
+    def transcode(self, song, source_path, outdir, file_name):
+        # returns the return code, the name of the new file, the time the transcode took and the decision
+        start = time.perf_counter()
+        decision, ext, muxer, codec_args = self.decide(source_path)
+        output_name = f'{file_name}.{ext}'
+        output_path = os.path.join(outdir, output_name)
+        part_path = output_path + '.part'
+        command_args = [self.ffmpegpath, '-y', '-hide_banner', '-loglevel', 'error', '-i', source_path,
+                        '-vn', '-map_metadata', '-1',
+                        '-metadata', f'title={song.title}', '-metadata', f'artist={song.artists}', '-metadata', f'album={song.album}'
+                       ] + codec_args + ['-f', muxer, part_path]
+        Debug.print(f'command: {shlex.join(command_args)}\n', 2)
+        try:
+            proc = run_ffmpeg(command_args)
+        except OSError as err:
+            Debug.write(f"ffmpeg could not be started. Check --ffmpeg-location.\n{err}")
+            return (1, None, {'transcode': time.perf_counter() - start}, decision)
+        phases = {'transcode': time.perf_counter() - start}
+        if proc.returncode != 0:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            return (proc.returncode, None, phases, decision)
+        os.replace(part_path, output_path)
+        os.remove(source_path)
+        Debug.print(f"File stored at: {output_path} ({decision})", 0)
+        return (0, output_name, phases, decision)
+
+    def record(self, decision, seconds):
+        self.decisions[decision][0] += 1
+        self.decisions[decision][1] += seconds
+
+    def print_summary(self):
+        verbosity = 0
+        counts = {decision: self.decisions[decision][0] for decision in TRANSCODE_DECISIONS}
+        if sum(counts.values()) == 0:
+            return
+        Debug.print('\nTRANSCODE:\n-----------------', verbosity)
+        Debug.print(f"{'decision':<12}{'count':>8}{'seconds':>10}", verbosity)
+        for decision in TRANSCODE_DECISIONS:
+            Debug.print(f"{decision:<12}{counts[decision]:>8}{self.decisions[decision][1]:>10.2f}", verbosity)
+        copied = counts['copy'] + counts['remux']
+        if copied > 0 and counts['reencode'] > 0:
+            # estimated with the average time of the songs that were encoded
+            average = self.decisions['reencode'][1] / counts['reencode']
+            saved = average * copied - self.decisions['copy'][1] - self.decisions['remux'][1]
+            Debug.print(f'\n{copied} songs were not encoded again, which saved about {max(0.0, saved):.2f} seconds of ffmpeg time.', verbosity)
+        elif copied > 0:
+            Debug.print(f'\n{copied} songs were not encoded again.', verbosity)
+        Debug.print('-----------------\n', verbosity)
+
+
+def run_ytdlp_on_song(song, outdir, outputformat, backend):
+    # returns the return code, the file name if it is known, the time in seconds each phase took and the error message of yt-dlp
+    Debug.print(f'Downloading song... {song.playlist} | {song.title} | {song.artists} | {song.album} | {song.link}', 1)
+    phases = {}
+    start = time.perf_counter()
+    if backend.progress != None:
+        backend.progress.song_started(song)
+    try:
+        returncode, file_name, error = backend.download(song, outdir, outputformat, phases)
+    finally:
+        if backend.progress != None:
+            backend.progress.song_stopped()
+    phases['total'] = time.perf_counter() - start
+    if file_name != None:
         Debug.print(f"File stored at: {os.path.join(outdir, file_name)}", 0)
-    except UnicodeDecodeError as err:
-        print(f"Failed to decode file name from stdout for {outputformat}. Not adding this song to m3u8 file.")
-        return (proc.returncode, None)
-
-
-    return (proc.returncode, file_name)
+    return (returncode, file_name, phases, error)
+
+def run_ytdlp_on_batch(songs, outdir, names, backend):
+    # returns (return code, file name, error) of every song, and the time each phase took as a share of the batch per song
+    Debug.print(f'Downloading batch of {len(songs)} songs... {songs[0].playlist}', 1)
+    phases = {}
+    start = time.perf_counter()
+    if backend.progress != None:
+        backend.progress.song_started(songs[0])
+    try:
+        results = backend.download_batch(songs, outdir, names, phases)
+    finally:
+        if backend.progress != None:
+            backend.progress.song_stopped()
+    phases['total'] = time.perf_counter() - start
+    for returncode, file_name, error in results:
+        if file_name != None:
+            Debug.print(f"File stored at: {os.path.join(outdir, file_name)}", 0)
+    return (results, {phase: seconds / len(songs) for phase, seconds in phases.items()})
+
+def default_socketpath():
+    # the same path as dlclient.py
+    return os.path.join(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(), 'song_downloader.sock')
+
+
+# Keeps what can be reused between the jobs of --serve: parsed catalogues, backends (with their warm yt-dlp instances) and download workers.
+class WarmState:
+    MAX_CATALOGUES = 4
+
+    def __init__(self):
+        # key -> (rows, stats), the least recently used catalogue is dropped first
+        self.catalogues = OrderedDict()
+        self.backends = {}
+        self.executors = {}
+
+    def read_catalogue(self, txtfile, csvfile, allowed_playlists=None, use_indices=False, ignore_noplaylist=False, skip_dupes=False, duplicate_scope='playlist'):
+        # a catalogue is parsed again when its file changed
+        path = os.path.abspath(txtfile if txtfile != None else csvfile)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # the reader reports the missing file
+            return read_catalogue(txtfile, csvfile, allowed_playlists, use_indices, ignore_noplaylist, skip_dupes, duplicate_scope)
+        key = (path, stat.st_mtime_ns, stat.st_size, txtfile != None,
+               tuple(allowed_playlists) if allowed_playlists != None else None, use_indices, ignore_noplaylist, skip_dupes, duplicate_scope)
+        if key in self.catalogues:
+            self.catalogues.move_to_end(key)
+            Debug.print(f'Using the catalogue that was already read: {path}', 1)
+        else:
+            songs, stats = read_catalogue(txtfile, csvfile, allowed_playlists, use_indices, ignore_noplaylist, skip_dupes, duplicate_scope)
+            rows = [(song.title, song.artists, song.album, song.playlist, song.link) for song in songs]
+            self.catalogues[key] = (rows, stats)
+            if len(self.catalogues) > self.MAX_CATALOGUES:
+                self.catalogues.popitem(last=False)
+        rows, stats = self.catalogues[key]
+        # every job gets its own songs and stats, which it changes, e.g. the links found with --resolve-links
+        return ((Song(*row) for row in rows), dict(stats))
+
+    def backend(self, name, ytdlpcmd, ffmpegpath, configpath, fake_delay=0.0):
+        key = (name, ytdlpcmd, ffmpegpath, os.path.abspath(configpath), fake_delay)
+        if key not in self.backends:
+            self.backends[key] = create_backend(name, ytdlpcmd, ffmpegpath, configpath, fake_delay)
+        return self.backends[key]
+
+    def executor(self, jobs):
+        # the library backend keeps a yt-dlp instance per worker thread, so the same threads are reused
+        if jobs not in self.executors:
+            self.executors[jobs] = ThreadPoolExecutor(max_workers=jobs)
+        return self.executors[jobs]
+
+    def close(self):
+        for backend in self.backends.values():
+            backend.close()
+        for executor in self.executors.values():
+            executor.shutdown()
+
+
+# Jobs of --serve waiting to run. Every client has its own queue, and the clients take turns, so one client with many jobs does not block the others.
+class JobQueue:
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.clients = {}
+        self.order = deque()
+
+    def put(self, client, job):
+        # returns the number of other jobs that are waiting
+        with self.condition:
+            if client not in self.clients:
+                self.clients[client] = deque()
+                self.order.append(client)
+            self.clients[client].append(job)
+            self.condition.notify()
+            return sum(len(jobs) for jobs in self.clients.values()) - 1
+
+    def get(self):
+        with self.condition:
+            while len(self.order) == 0:
+                self.condition.wait()
+            client = self.order.popleft()
+            job = self.clients[client].popleft()
+            if len(self.clients[client]) > 0:
+                self.order.append(client)
+            else:
+                del self.clients[client]
+            return job
+
+
+# Sends everything a job prints to its client, as one JSON message per line. A client that disconnected only misses the output.
+class JobStream:
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.buffer = ''
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        try:
+            self.conn.sendall((json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8'))
+        except OSError:
+            pass
+
+    def write(self, text):
+        with self.lock:
+            self.buffer += text
+            while '\n' in self.buffer:
+                line, self.buffer = self.buffer.split('\n', 1)
+                self.send({'type': 'output', 'line': line})
+        return len(text)
+
+    def flush(self):
+        with self.lock:
+            if self.buffer != '':
+                self.send({'type': 'output', 'line': self.buffer})
+                self.buffer = ''
+
+
+def run_job(job, warm):
+    stream = JobStream(job['conn'])
+    stream.send({'type': 'started'})
+    code = 0
+    try:
+        # the working directory and output of the server are not changed, the paths and output of the job are passed to main
+        main(job['args'], warm, job['cwd'], stream)
+    except SystemExit as err:
+        if isinstance(err.code, str):
+            stream.write(err.code + '\n')
+            code = 1
+        else:
+            code = err.code if err.code != None else 0
+    except Exception:
+        traceback.print_exc(file=stream)
+        code = 1
+    finally:
+        Debug.stream = None
+        stream.flush()
+        stream.send({'type': 'exit', 'code': code})
+        job['conn'].close()
+
+def accept_job(conn, queue):
+    # reads the job from a client: one JSON object with the client name, working directory and download.py arguments
+    try:
+        with conn.makefile('r', encoding='utf-8') as reader:
+            request = json.loads(reader.readline())
+        job = {'conn': conn, 'client': str(request['client']), 'cwd': str(request['cwd']), 'args': [str(arg) for arg in request['args']]}
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        JobStream(conn).send({'type': 'exit', 'code': 1, 'error': f'Invalid job: {err}'})
+        conn.close()
+        return
+    waiting = queue.put(job['client'], job)
+    JobStream(conn).send({'type': 'queued', 'waiting': waiting})
 
-main()
+def serve(socketpath):
+    if not hasattr(socket, 'AF_UNIX'):
+        print('--serve needs Unix sockets, which are not supported on this system.')
+        exit(1)
+    socketpath = socketpath if socketpath != None else default_socketpath()
+    if os.path.exists(socketpath):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socketpath)
+        except OSError:
+            # left behind by a server that did not stop cleanly
+            os.remove(socketpath)
+        else:
+            print(f'A server is already running on {socketpath}.')
+            exit(1)
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # jobs can run any --ytdlp-cmd as the user of the server, so only that user may connect.
+    # The socket is created without access for others, a chmod afterwards would leave a window in which anyone can connect.
+    umask = os.umask(0o077)
+    try:
+        server.bind(socketpath)
+    finally:
+        os.umask(umask)
+    server.listen()
+
+    queue = JobQueue()
+    warm = WarmState()
+    def work():
+        while True:
+            run_job(queue.get(), warm)
+    threading.Thread(target=work, daemon=True).start()
+
+    # stop the same way on a termination signal, e.g. from a service manager
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f'Waiting for jobs on {socketpath}. Press Ctrl+C to stop.', flush=True)
+    try:
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=accept_job, args=(conn, queue), daemon=True).start()
+    except KeyboardInterrupt:
+        print('\nStopping server...')
+    finally:
+        server.close()
+        os.remove(socketpath)
+        warm.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import os
+
+import download
+
+
+ROCK = [
+    ('Back in Black', 'AC/DC', 'Back in Black', 'https://x/bib'),
+    ('Highway to Hell', 'AC/DC', 'Highway to Hell', 'https://x/hth'),
+    ('TNT', 'AC/DC', 'TNT', 'https://x/tnt'),
+    ('Thunderstruck', 'AC/DC', 'The Razors Edge', 'https://x/thu'),
+    ('Hells Bells', 'AC/DC', 'Back in Black', 'https://x/hb'),
+]
+
+def write_txt(path, playlists):
+    # playlists: playlist -> list of (title, artists, album, link)
+    lines = ['INDEX PLAYLISTS'] + [f'- {playlist}' for playlist in playlists] + ['END INDEX', '', 'END HEADER', '']
+    for playlist, songs in playlists.items():
+        lines.append(f'PLAYLIST {playlist}')
+        lines += ['   '.join(field for field in song if field != '') for song in songs]
+        lines.append('')
+    with open(path, 'w', encoding='utf-8') as writer:
+        writer.write('\n'.join(lines))
+    return str(path)
+
+def catalogue(playlists, songs):
+    return {f'List {p}': [(f'Song {p}-{s}', f'Artist {s % 7}', f'Album {s % 3}', f'https://x/{p}/{s}') for s in range(songs)] for p in range(playlists)}
+
+def run(*args):
+    # runs download.py with the fake backend, and returns the exit code
+    try:
+        download.main([str(arg) for arg in args] + ['--backend', 'fake', '--config-location', os.devnull, '--quiet'])
+    except SystemExit as err:
+        return err.code if err.code != None else 0
+    return 0
+
+def playlist_songs(outdir, playlist):
+    with open(os.path.join(outdir, playlist, f'{playlist}.m3u8'), 'r', encoding='utf-8') as reader:
+        return [line.strip() for line in reader if line.strip() != '' and not line.startswith('#')]
+
+def song_files(outdir, playlist):
+    return sorted(name for name in os.listdir(os.path.join(outdir, playlist)) if name.endswith('.mp3'))
+
+def song_names(songs):
+    return [f'AC - DC -- {song[0]}' for song in songs]
@@ -0,0 +1,16 @@
+import os
+
+import download
+from helpers import ROCK, write_txt, run, playlist_songs, song_files, song_names
+
+
+def test_fake_backend_writes_songs_and_playlist(tmp_path):
+    txt = write_txt(tmp_path / 'songs.txt', {'Rock': ROCK})
+    outdir = tmp_path / 'out'
+    assert run('-d', '--txt', txt, '--dir', outdir, '-p') == 0
+    assert len(song_files(outdir, 'Rock')) == 5
+    assert [os.path.splitext(path)[0] for path in playlist_songs(outdir, 'Rock')] == song_names(ROCK)
+
+def test_create_backend():
+    assert isinstance(download.create_backend('fake', 'yt-dlp', 'ffmpeg', os.devnull), download.FakeBackend)
+    assert isinstance(download.create_backend('subprocess', 'yt-dlp', 'ffmpeg', os.devnull), download.SubprocessBackend)
@@ -0,0 +1,110 @@
+import os
+import sys
+import threading
+import time
+
+import download
+from helpers import ROCK, write_txt, run, playlist_songs, song_files, song_names
+
+
+# stub for --ytdlp-cmd that downloads a --batch-file. Links with `fail' are unavailable,
+# links with `redirect' report another original_url, so they can only be found by their id.
+STUB_YTDLP = '''\
+import os
+import sys
+import json
+
+args = sys.argv[1:]
+outdir = args[args.index('-P') + 1]
+with open(args[args.index('--batch-file') + 1], 'r', encoding='utf-8') as reader:
+    links = [line.strip() for line in reader if line.strip() != '']
+os.makedirs(outdir, exist_ok=True)
+failed = False
+for link in links:
+    id = link.split('?')[0].rstrip('/').rsplit('/', 1)[-1]
+    if 'fail' in link:
+        print(f'ERROR: [youtube] {id}: Video unavailable', flush=True)
+        failed = True
+        continue
+    path = os.path.join(outdir, f'{id}.batch.mp3')
+    with open(path, 'w', encoding='utf-8') as writer:
+        writer.write(link)
+    original_url = f'https://redirected.invalid/{id}' if 'redirect' in link else link
+    print('%s' + json.dumps({'original_url': original_url, 'webpage_url': original_url, 'id': id, 'filepath': path}), flush=True)
+sys.exit(1 if failed else 0)
+''' % download.BATCH_MARKER
+
+def write_stub(tmp_path):
+    stub = tmp_path / 'fake-yt-dlp'
+    stub.write_text(f'#!{sys.executable}\n{STUB_YTDLP}', encoding='utf-8')
+    os.chmod(stub, 0o755)
+    return str(stub)
+
+
+def test_batch_maps_files_and_errors_to_their_songs(tmp_path):
+    backend = download.SubprocessBackend(write_stub(tmp_path), str(tmp_path / 'no-ffmpeg'), os.devnull)
+    songs = [
+        download.Song('A', 'X', 'Y', 'Rock', 'https://youtu.be/abcdef?fail'),
+        # the id of this link is part of the link above, but it is another video
+        download.Song('B', 'X', 'Y', 'Rock', 'https://youtu.be/abc?redirect'),
+        download.Song('C', 'X', 'Y', 'Rock', 'https://youtu.be/ghi'),
+    ]
+    outdir = tmp_path / 'out'
+    outdir.mkdir()
+    results = backend.download_batch(songs, str(outdir), ['a', 'b', 'c'], {})
+    assert results[0][0] != 0 and results[0][1] == None
+    assert results[0][2] == 'ERROR: [youtube] abcdef: Video unavailable'
+    assert results[1:] == [(0, 'b.mp3', None), (0, 'c.mp3', None)]
+    assert (outdir / 'b.mp3').read_text(encoding='utf-8') == 'https://youtu.be/abc?redirect'
+    assert sorted(os.listdir(outdir)) == ['b.mp3', 'c.mp3']
+
+def test_link_id():
+    assert download.link_id('https://www.youtube.com/watch?v=dQw4w9WgXcQ&list=PL1') == 'dQw4w9WgXcQ'
+    assert download.link_id('https://youtu.be/dQw4w9WgXcQ') == 'dQw4w9WgXcQ'
+    assert download.link_id('https://www.youtube.com/shorts/dQw4w9WgXcQ/') == 'dQw4w9WgXcQ'
+
+def test_batch_playlists_with_the_subprocess_backend(tmp_path):
+    songs = [(title, artists, album, f'https://youtu.be/{i}') for i, (title, artists, album, link) in enumerate(ROCK)]
+    txt = write_txt(tmp_path / 'songs.txt', {'Rock': songs})
+    outdir = tmp_path / 'out'
+    download.main(['-d', '--txt', txt, '--dir', str(outdir), '-p', '--batch-playlists', '--ytdlp-cmd', write_stub(tmp_path),
+                   '--ffmpeg-location', str(tmp_path / 'no-ffmpeg'), '--config-location', os.devnull, '--quiet'])
+    assert [os.path.splitext(path)[0] for path in playlist_songs(outdir, 'Rock')] == song_names(ROCK)
+
+def test_batch_playlists_with_the_fake_backend(tmp_path):
+    txt = write_txt(tmp_path / 'songs.txt', {'Rock': ROCK, 'Best': ROCK[::-1]})
+    outdir = tmp_path / 'out'
+    assert run('-d', '--txt', txt, '--dir', outdir, '-p', '--batch-playlists', '-j', 2) == 0
+    assert [os.path.splitext(path)[0] for path in playlist_songs(outdir, 'Best')] == song_names(ROCK[::-1])
+    assert len(song_files(outdir, 'Rock')) == 5
+
+# records the links of the batches that run at the same time
+class RecordingBackend(download.FakeBackend):
+
+    def __init__(self):
+        super().__init__()
+        self.running = []
+        self.overlap = []
+
+    def download_batch(self, songs, outdir, names, phases):
+        links = [song.link for song in songs]
+        with self.lock:
+            self.overlap += [link for link in links if link in self.running]
+            self.running += links
+        time.sleep(0.02)
+        try:
+            return super().download_batch(songs, outdir, names, phases)
+        finally:
+            with self.lock:
+                for link in links:
+                    self.running.remove(link)
+
+def test_a_link_is_only_in_one_running_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(download, 'BATCH_SIZE', 3)
+    rows = ROCK + ROCK[:2] + ROCK + ROCK[3:]
+    songs = [download.Song(title, artists, album, 'Rock', link) for title, artists, album, link in rows]
+    backend = RecordingBackend()
+    outdir = tmp_path / 'out'
+    download.download_songs(iter(songs), str(outdir), None, True, backend, 4, batch=True)
+    assert backend.overlap == []
+    assert len(playlist_songs(outdir, 'Rock')) == len(rows)
@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+import download
+from helpers import catalogue, write_txt, run
+
+
+def test_parallel_conversion_matches_sequential(tmp_path):
+    txt = write_txt(tmp_path / 'songs.txt', catalogue(6, 40))
+    assert run('-c', '--txt', txt, '--csv', tmp_path / 'sequential.csv', '--workers', 1) == 0
+    assert run('-c', '--txt', txt, '--csv', tmp_path / 'parallel.csv', '--workers', 3) == 0
+    assert (tmp_path / 'parallel.csv').read_bytes() == (tmp_path / 'sequential.csv').read_bytes()
+    # no index file is left next to the txt file without a filter
+    assert sorted(os.listdir(tmp_path)) == ['parallel.csv', 'sequential.csv', 'songs.txt']
+
+def test_parallel_conversion_matches_sequential_with_indices(tmp_path):
+    txt = write_txt(tmp_path / 'songs.txt', catalogue(6, 40))
+    assert run('-c', '--txt', txt, '--csv', tmp_path / 'sequential.csv', '--workers', 1, '--filter-playlists', '1,4', '-i') == 0
+    assert run('-c', '--txt', txt, '--csv', tmp_path / 'parallel.csv', '--workers', 3, '--filter-playlists', '1,4', '-i') == 0
+    sequential = (tmp_path / 'sequential.csv').read_text(encoding='utf-8')
+    assert (tmp_path / 'parallel.csv').read_text(encoding='utf-8') == sequential
+    assert 'List 1' in sequential and 'List 4' in sequential and 'List 0' not in sequential
+
+def test_parallel_conversion_stats(tmp_path):
+    txt = write_txt(tmp_path / 'songs.txt', {'Rock': [('A', 'X', 'Y', ''), ('B', 'X', 'Y', 'https://x/b')], 'Pop': [('C', 'X', 'Y', '')]})
+    stats = download.convert_txtfile(txt, str(tmp_path / 'songs.csv'), 2)
+    assert (stats['total'], stats['nolink']) == (3, 2)
+    stats = download.convert_txtfile(txt, str(tmp_path / 'songs.csv'), 2, ['Pop'])
+    assert (stats['total'], stats['nolink'], stats['skipped_notallowed']) == (3, 2, 2)
+
+def test_offsets_only_index_has_the_same_sections(tmp_path):
+    txt = write_txt(tmp_path / 'songs.txt', catalogue(4, 10))
+    full = download.build_txtindex(txt)
+    offsets = download.build_txtindex(txt, False)
+    assert offsets['header_end'] == full['header_end']
+    assert [(section['name'], section['offset'], section['length']) for section in offsets['sections']] == \
+        [(section['name'], section['offset'], section['length']) for section in full['sections']]
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_invalid_index_is_an_error(tmp_path, workers):
+    txt = write_txt(tmp_path / 'songs.txt', catalogue(2, 5))
+    assert run('-c', '--txt', txt, '--csv', tmp_path / 'songs.csv', '--workers', workers, '--filter-playlists', '0,x', '-i') == 1
+
+def test_csv_to_txt_round_trip(tmp_path):
+    txt = write_txt(tmp_path / 'songs.txt', catalogue(3, 5))
+    assert run('-c', '--txt', txt, '--csv', tmp_path / 'songs.csv', '--workers', 1) == 0
+    assert run('-c', '--to-txt', '--txt', tmp_path / 'back.txt', '--csv', tmp_path / 'songs.csv') == 0
+    assert run('-c', '--txt', tmp_path / 'back.txt', '--csv', tmp_path / 'back.csv', '--workers', 1) == 0
+    assert (tmp_path / 'back.csv').read_bytes() == (tmp_path / 'songs.csv').read_bytes()
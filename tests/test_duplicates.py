@@ -0,0 +1,36 @@
+import pytest
+
+import download
+from helpers import ROCK, write_txt, run
+
+
+def test_skip_duplicates_by_key_and_by_link(tmp_path):
+    songs = ROCK[:2] + [('Back In  Black', 'ac/dc', 'Live', 'https://x/live'), ('TNT', 'AC/DC', 'Live', 'https://x/bib')]
+    txt = write_txt(tmp_path / 'songs.txt', {'Rock': songs})
+    assert run('-c', '--txt', txt, '--csv', tmp_path / 'songs.csv', '--workers', 1, '-s') == 0
+    lines = (tmp_path / 'songs.csv').read_text(encoding='utf-8').splitlines()
+    assert len(lines) == 3
+
+@pytest.mark.parametrize('scope, expected', [('playlist', 4), ('global', 3)])
+def test_duplicate_scope(tmp_path, scope, expected):
+    txt = write_txt(tmp_path / 'songs.txt', {'Rock': ROCK[:2], 'Best': [ROCK[0], ROCK[2]]})
+    assert run('-c', '--txt', txt, '--csv', tmp_path / 'songs.csv', '--workers', 1, '-s', '--duplicate-scope', scope) == 0
+    # one header line
+    assert len((tmp_path / 'songs.csv').read_text(encoding='utf-8').splitlines()) == expected + 1
+
+
+@pytest.mark.parametrize('first, second', [
+    (('Song (feat. B and C)', 'A'), ('Song', 'A & B, C')),
+    (('Song ft. B', 'A'), ('song', 'B; A')),
+    (('Song', 'A feat. B'), ('Song', 'A, B')),
+])
+def test_song_key_same_song(first, second):
+    assert download.song_key(*first) == download.song_key(*second)
+
+@pytest.mark.parametrize('title, artists, expected', [
+    ('Thunderstruck', 'AC/DC', {'ac/dc'}),
+    ('Dog Days', 'Florence and the Machine', {'florence and the machine'}),
+    ('Song (with Strings)', 'A', {'a'}),
+])
+def test_song_key_keeps_artist_names_whole(title, artists, expected):
+    assert download.song_key(title, artists)[1] == frozenset(expected)
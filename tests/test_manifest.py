@@ -0,0 +1,30 @@
+import os
+
+from helpers import ROCK, write_txt, run, playlist_songs, song_files
+
+
+def test_rerun_skips_downloaded_songs(tmp_path):
+    txt = write_txt(tmp_path / 'songs.txt', {'Rock': ROCK})
+    outdir = tmp_path / 'out'
+    assert run('-d', '--txt', txt, '--dir', outdir, '-p') == 0
+    path = outdir / 'Rock' / 'AC - DC -- TNT.mp3'
+    mtime = os.stat(path).st_mtime_ns
+    assert run('-d', '--txt', txt, '--dir', outdir, '-p') == 0
+    assert os.stat(path).st_mtime_ns == mtime
+    # a song whose file was deleted is downloaded again
+    os.remove(path)
+    assert run('-d', '--txt', txt, '--dir', outdir, '-p') == 0
+    assert os.path.exists(path)
+
+def test_rebuild_playlists_leaves_out_removed_songs(tmp_path):
+    outdir = tmp_path / 'out'
+    assert run('-d', '--txt', write_txt(tmp_path / 'songs.txt', {'Rock': ROCK}), '--dir', outdir, '-p') == 0
+    removed = [song for song in ROCK if song[0] != 'Thunderstruck']
+    assert run('-d', '--txt', write_txt(tmp_path / 'songs2.txt', {'Rock': removed}), '--dir', outdir, '-p') == 0
+    assert run('--rebuild-playlists', '--dir', outdir) == 0
+    songs = playlist_songs(outdir, 'Rock')
+    assert len(songs) == 4
+    assert not any('Thunderstruck' in path for path in songs)
+
+def test_rebuild_playlists_needs_dir(tmp_path):
+    assert run('--rebuild-playlists') == 1
@@ -0,0 +1,36 @@
+import json
+
+from helpers import ROCK, write_txt, run
+
+
+def read_metrics(path):
+    with open(path, 'r', encoding='utf-8') as reader:
+        return [json.loads(line) for line in reader]
+
+def test_metrics_file_has_a_record_per_song(tmp_path):
+    songs = ROCK[:3] + [('Gone', 'AC/DC', 'Live', 'fail://x/1')]
+    txt = write_txt(tmp_path / 'songs.txt', {'Rock': songs})
+    outdir = tmp_path / 'out'
+    metricsfile = tmp_path / 'metrics.jsonl'
+    assert run('-d', '--txt', txt, '--dir', outdir, '--metrics-file', metricsfile, '--retries', 0) == 0
+    records = sorted(read_metrics(metricsfile), key=lambda record: record['position'])
+    assert [(record['playlist'], record['position'], record['title'], record['link']) for record in records] == \
+        [('Rock', i, song[0], song[3]) for i, song in enumerate(songs)]
+    for record in records[:3]:
+        assert record['status'] == 'downloaded'
+        assert record['returncode'] == 0
+        assert record['file'] == f"AC - DC -- {record['title']}.mp3"
+        assert record['bytes'] > 0
+        assert record['retries'] == 0
+        assert set(record['phases']) >= {'download', 'total'}
+        assert all(seconds >= 0 for seconds in record['phases'].values())
+    assert records[3]['status'] == 'failed'
+    assert records[3]['returncode'] != 0
+    assert records[3]['file'] == None and records[3]['bytes'] == None
+
+def test_metrics_file_marks_skipped_songs(tmp_path):
+    txt = write_txt(tmp_path / 'songs.txt', {'Rock': ROCK})
+    outdir = tmp_path / 'out'
+    assert run('-d', '--txt', txt, '--dir', outdir) == 0
+    assert run('-d', '--txt', txt, '--dir', outdir, '--metrics-file', tmp_path / 'metrics.jsonl') == 0
+    assert [record['status'] for record in read_metrics(tmp_path / 'metrics.jsonl')] == ['already_downloaded'] * 5
@@ -0,0 +1,32 @@
+import json
+
+import download
+from helpers import catalogue, write_txt, run, playlist_songs
+
+
+def test_prefetch_downloads_the_longest_songs_first(tmp_path):
+    playlists = catalogue(2, 8)
+    txt = write_txt(tmp_path / 'songs.txt', playlists)
+    outdir = tmp_path / 'out'
+    metricsfile = tmp_path / 'metrics.jsonl'
+    # with one job the songs finish in the order they start
+    assert run('-d', '--txt', txt, '--dir', outdir, '-p', '--prefetch', '-j', 1, '--metrics-file', metricsfile) == 0
+    with open(metricsfile, 'r', encoding='utf-8') as reader:
+        links = [json.loads(line)['link'] for line in reader]
+    backend = download.FakeBackend()
+    durations = [backend.duration(link) for link in links]
+    assert len(links) == 16
+    assert durations == sorted(durations, reverse=True)
+    # the playlist files are still in source order
+    for playlist, songs in playlists.items():
+        assert [path.rsplit('.', 1)[0] for path in playlist_songs(outdir, playlist)] == [f'{song[1]} -- {song[0]}' for song in songs]
+
+def test_prefetched_metadata_is_stored_in_the_manifest(tmp_path):
+    playlists = catalogue(1, 4)
+    outdir = tmp_path / 'out'
+    assert run('-d', '--txt', write_txt(tmp_path / 'songs.txt', playlists), '--dir', outdir, '--prefetch') == 0
+    links = [song[3] for song in playlists['List 0']]
+    with download.DownloadManifest(str(outdir)) as manifest:
+        metadata = manifest.metadata(links)
+    backend = download.FakeBackend()
+    assert metadata == {link: (backend.duration(link), backend.duration(link) * 16000) for link in links}
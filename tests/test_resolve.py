@@ -0,0 +1,74 @@
+import csv
+
+import download
+from helpers import write_txt, run
+
+
+SONGS = [
+    ('Back in Black', 'AC/DC', 'Back in Black', 'https://x/bib'),
+    ('Highway to Hell', 'AC/DC', 'Highway to Hell', ''),
+    ('Missing Song', 'Nobody', 'Nothing', ''),
+    ('TNT', 'AC/DC', 'TNT', ''),
+]
+
+def fake_link(song):
+    query = download.resolve_query(download.Song(song[0], song[1], song[2], '', ''))
+    return download.FakeResolver().resolve([query])[query]
+
+# counts the searches, to see which songs were found in the cache
+class CountingResolver(download.FakeResolver):
+
+    def __init__(self):
+        self.queries = []
+
+    def resolve(self, queries):
+        self.queries += queries
+        return super().resolve(queries)
+
+def resolve(txtfile, resolver, cache):
+    songs, stats = download.read_txtfile(txtfile)
+    songs = [(song.title, song.link) for song in download.resolve_links(songs, stats, resolver, cache, 2)]
+    return (songs, stats)
+
+
+def test_convert_writes_the_resolved_links(tmp_path):
+    txt = write_txt(tmp_path / 'songs.txt', {'Rock': SONGS})
+    assert run('-c', '--txt', txt, '--csv', tmp_path / 'songs.csv', '--resolve-links', '--resolver', 'fake', '--resolve-cache', tmp_path / 'cache.sqlite3') == 0
+    with open(tmp_path / 'songs.csv', 'r', encoding='utf-8', newline='') as reader:
+        links = [row['link'] for row in csv.DictReader(reader)]
+    assert links == ['https://x/bib', fake_link(SONGS[1]), '', fake_link(SONGS[3])]
+
+def test_stats_count_the_resolved_songs(tmp_path):
+    txt = write_txt(tmp_path / 'songs.txt', {'Rock': SONGS})
+    songs, stats = resolve(txt, download.FakeResolver(), None)
+    assert stats['nolink'] == 3
+    assert stats['resolved'] == 2
+    # only the song that was not found is still skipped for downloading
+    assert stats['skipped_total_dl'] == 1
+
+def test_cache_stores_found_and_not_found_songs(tmp_path):
+    txt = write_txt(tmp_path / 'songs.txt', {'Rock': SONGS})
+    cache = download.LinkCache(str(tmp_path / 'cache.sqlite3'), 3600)
+    resolver = CountingResolver()
+    first = resolve(txt, resolver, cache)
+    assert len(resolver.queries) == 3
+
+    resolver = CountingResolver()
+    assert resolve(txt, resolver, cache) == first
+    assert resolver.queries == []
+
+    # expired entries are searched again
+    cache.db.execute('UPDATE links SET time = time - 7200')
+    cache.db.commit()
+    resolver = CountingResolver()
+    assert resolve(txt, resolver, cache) == first
+    assert len(resolver.queries) == 3
+    cache.close()
+
+def test_same_query_is_searched_once(tmp_path):
+    txt = write_txt(tmp_path / 'songs.txt', {'Rock': SONGS[1:2], 'Best': SONGS[1:2]})
+    resolver = CountingResolver()
+    songs, stats = resolve(txt, resolver, None)
+    assert len(resolver.queries) == 1
+    assert songs == [('Highway to Hell', fake_link(SONGS[1]))] * 2
+    assert stats['resolved'] == 2
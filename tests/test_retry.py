@@ -0,0 +1,52 @@
+import json
+import os
+
+import pytest
+
+import download
+from helpers import ROCK, write_txt, run, song_files
+
+
+def test_transient_errors_are_retried_and_failures_stored(tmp_path):
+    songs = ROCK[:2] + [('Flaky', 'AC/DC', 'Live', 'flaky://x/1'), ('Gone', 'AC/DC', 'Live', 'fail://x/2')]
+    outdir = tmp_path / 'out'
+    assert run('-d', '--txt', write_txt(tmp_path / 'songs.txt', {'Rock': songs}), '--dir', outdir, '--retries', 2, '--retry-delay', 0) == 0
+    assert song_files(outdir, 'Rock') == ['AC - DC -- Back in Black.mp3', 'AC - DC -- Flaky.mp3', 'AC - DC -- Highway to Hell.mp3']
+    with open(outdir / 'failed.jsonl', 'r', encoding='utf-8') as reader:
+        records = [json.loads(line) for line in reader]
+    assert [(record['title'], record['kind'], record['retries']) for record in records] == [('Gone', 'permanent', 0)]
+
+    # still failing, so it stays in the file
+    assert run('--retry-failed', '--dir', outdir, '--retry-delay', 0) == 0
+    assert os.path.exists(outdir / 'failed.jsonl')
+
+def test_retry_failed_removes_songs_that_succeed(tmp_path):
+    songs = ROCK[:2] + [('Flaky', 'AC/DC', 'Live', 'flaky://x/1')]
+    outdir = tmp_path / 'out'
+    # without retries the first attempt of the flaky song fails
+    assert run('-d', '--txt', write_txt(tmp_path / 'songs.txt', {'Rock': songs}), '--dir', outdir, '-p', '--retries', 0) == 0
+    with open(outdir / 'failed.jsonl', 'r', encoding='utf-8') as reader:
+        assert [json.loads(line)['kind'] for line in reader] == ['transient']
+    # a new process (and fake backend) fails the first attempt again, the retry succeeds
+    assert run('--retry-failed', '--dir', outdir, '-p', '--retries', 1, '--retry-delay', 0) == 0
+    assert not os.path.exists(outdir / 'failed.jsonl')
+    assert len(song_files(outdir, 'Rock')) == 3
+
+@pytest.mark.parametrize('error', [
+    'ERROR: [youtube] abc: Video unavailable',
+    'ERROR: [youtube] abc: Private video. Sign in if you\'ve been granted access to this video',
+    'ERROR: unable to download video data: HTTP Error 404: Not Found',
+    'ERROR: [youtube] abc: Video unavailable. This video is no longer available due to a copyright claim by Someone',
+    'ERROR: [youtube] abc: This video contains content from Someone, who has blocked it on copyright grounds',
+])
+def test_permanent_errors(error):
+    assert not download.RetryPolicy(3, 0, 0).is_transient(error)
+
+@pytest.mark.parametrize('error', [
+    'ERROR: unable to download video data: HTTP Error 403: Forbidden',
+    'ERROR: Unable to download webpage: HTTP Error 429: Too Many Requests',
+    'ERROR: [download] Got error: The read operation timed out',
+    'ERROR: [youtube] abc: Copyright Free Music - Unable to extract uploader id',
+])
+def test_transient_errors(error):
+    assert download.RetryPolicy(3, 0, 0).is_transient(error)
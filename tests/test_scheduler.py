@@ -0,0 +1,21 @@
+import os
+
+from helpers import catalogue, write_txt, run, playlist_songs, song_files
+
+
+def test_parallel_download_keeps_playlist_order(tmp_path):
+    # the fake delay depends on the link, so the songs finish in a different order than they start
+    playlists = catalogue(2, 12)
+    txt = write_txt(tmp_path / 'songs.txt', playlists)
+    outdir = tmp_path / 'out'
+    assert run('-d', '--txt', txt, '--dir', outdir, '-p', '-j', 4, '--fake-delay', 0.05) == 0
+    for playlist, songs in playlists.items():
+        assert len(song_files(outdir, playlist)) == len(songs)
+        assert [os.path.splitext(path)[0] for path in playlist_songs(outdir, playlist)] == [f'{song[1]} -- {song[0]}' for song in songs]
+
+def test_playlist_jobs_limits_songs_per_playlist(tmp_path):
+    playlists = catalogue(3, 6)
+    outdir = tmp_path / 'out'
+    assert run('-d', '--txt', write_txt(tmp_path / 'songs.txt', playlists), '--dir', outdir, '-p', '-j', 4, '--playlist-jobs', 1, '--fake-delay', 0.02) == 0
+    for playlist, songs in playlists.items():
+        assert [os.path.splitext(path)[0] for path in playlist_songs(outdir, playlist)] == [f'{song[1]} -- {song[0]}' for song in songs]
@@ -0,0 +1,56 @@
+import os
+import errno
+
+import download
+from helpers import ROCK, write_txt, run, playlist_songs, song_files
+
+
+def test_scratch_dir_publishes_songs_and_is_emptied(tmp_path):
+    outdir = tmp_path / 'out'
+    scratch = tmp_path / 'scratch'
+    scratch.mkdir()
+    txt = write_txt(tmp_path / 'songs.txt', {'Rock': ROCK})
+    assert run('-d', '--txt', txt, '--dir', outdir, '-p', '-j', 3, '--scratch-dir', scratch) == 0
+    assert len(song_files(outdir, 'Rock')) == 5
+    assert len(playlist_songs(outdir, 'Rock')) == 5
+    assert os.listdir(scratch) == []
+
+def test_scratch_dir_with_batches_and_a_limit(tmp_path):
+    outdir = tmp_path / 'out'
+    scratch = tmp_path / 'scratch'
+    txt = write_txt(tmp_path / 'songs.txt', {'Rock': ROCK, 'Best': ROCK[:2]})
+    assert run('-d', '--txt', txt, '--dir', outdir, '-p', '-j', 2, '--batch-playlists', '--scratch-dir', scratch, '--scratch-limit', 15) == 0
+    assert len(playlist_songs(outdir, 'Rock')) == 5
+    assert len(playlist_songs(outdir, 'Best')) == 2
+    assert os.listdir(scratch) == []
+
+def test_limit_admits_one_song_larger_than_the_limit(tmp_path):
+    scratch = download.ScratchSpace(str(tmp_path), 100)
+    assert scratch.admits(500)
+    job = {'target_dir': str(tmp_path / 'out')}
+    scratch.create([job], [500])
+    assert not scratch.admits(10)
+    scratch.release(job)
+    assert scratch.admits(10) and scratch.fits(100) and not scratch.fits(101)
+    assert job['work_dir'] == str(tmp_path / 'out')
+    scratch.close()
+    assert os.listdir(tmp_path) == []
+
+def test_publish_across_drives(tmp_path, monkeypatch):
+    scratch = download.ScratchSpace(str(tmp_path / 'scratch'))
+    source = os.path.join(scratch.dir, 'song.mp3')
+    with open(source, 'w', encoding='utf-8') as writer:
+        writer.write('song')
+    target = str(tmp_path / 'out' / 'song.mp3')
+    replace = os.replace
+    def cross_device_replace(src, dst):
+        # only the rename out of the scratch folder crosses drives
+        if src == source:
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        replace(src, dst)
+    monkeypatch.setattr(os, 'replace', cross_device_replace)
+    scratch.publish(source, target)
+    assert (tmp_path / 'out' / 'song.mp3').read_text(encoding='utf-8') == 'song'
+    assert not os.path.exists(source)
+    assert not os.path.exists(target + '.part')
+    assert scratch.estimate(None) == 4
@@ -0,0 +1,113 @@
+import os
+import sys
+import json
+import stat
+import socket
+import subprocess
+import time
+
+import pytest
+
+import download
+from helpers import ROCK, write_txt, song_files
+
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE = ['--backend', 'fake', '--config-location', os.devnull]
+
+def run_job(args, cwd, warm=None):
+    # runs a job the way the server does, returns the output lines and the exit code the client gets
+    server_end, client_end = socket.socketpair()
+    download.run_job({'conn': server_end, 'client': 'test', 'cwd': str(cwd), 'args': [str(arg) for arg in args]}, warm or download.WarmState())
+    with client_end, client_end.makefile('r', encoding='utf-8') as reader:
+        messages = [json.loads(line) for line in reader]
+    assert messages[0]['type'] == 'started' and messages[-1]['type'] == 'exit'
+    return ([message['line'] for message in messages if message['type'] == 'output'], messages[-1]['code'])
+
+
+def test_clients_take_turns():
+    queue = download.JobQueue()
+    assert queue.put('a', 'a1') == 0
+    assert queue.put('a', 'a2') == 1
+    assert queue.put('a', 'a3') == 2
+    assert queue.put('b', 'b1') == 3
+    assert queue.put('c', 'c1') == 4
+    assert [queue.get() for _ in range(5)] == ['a1', 'b1', 'c1', 'a2', 'a3']
+    # a client that comes back after its queue was empty waits for the others
+    queue.put('b', 'b2')
+    queue.put('a', 'a4')
+    queue.put('b', 'b3')
+    assert [queue.get() for _ in range(3)] == ['b2', 'a4', 'b3']
+
+def test_resolve_paths(tmp_path):
+    args = download.parser.parse_args(['--merge-shards', 'part1', '/part2', '--txt', 'songs.txt', '--dir', '/music', '--metrics-file', '~/metrics.jsonl',
+                                       '--ffmpeg-location', 'ffmpeg', '--ytdlp-cmd', 'bin/yt-dlp'])
+    download.resolve_paths(args, str(tmp_path))
+    assert args.txt == os.path.join(str(tmp_path), 'songs.txt')
+    assert args.dir == '/music'
+    assert args.metrics_file == os.path.expanduser('~/metrics.jsonl')
+    assert args.csv == None
+    # a program without a directory is looked up in PATH
+    assert args.ffmpeg_location == 'ffmpeg'
+    assert args.ytdlp_cmd == os.path.join(str(tmp_path), 'bin', 'yt-dlp')
+    assert args.merge_shards == [os.path.join(str(tmp_path), 'part1'), '/part2']
+
+def test_job_runs_in_the_directory_of_the_client(tmp_path):
+    write_txt(tmp_path / 'songs.txt', {'Rock': ROCK})
+    cwd = os.getcwd()
+    lines, code = run_job(['-d', '--txt', 'songs.txt', '--dir', 'out'] + FAKE, tmp_path)
+    assert code == 0
+    assert os.getcwd() == cwd
+    assert len(song_files(tmp_path / 'out', 'Rock')) == 5
+    assert '5/5 songs were downloaded correctly.' in lines
+
+@pytest.mark.parametrize('args, code, line', [
+    ([], 2, 'usage: download.py'),
+    (['-d', '--txt', 'songs.txt'], 1, 'No output directory specified'),
+    (['-d', '--txt', 'missing.txt', '--dir', 'out'], 3, 'Txt file could not be opened'),
+])
+def test_job_exit_codes(tmp_path, args, code, line):
+    write_txt(tmp_path / 'songs.txt', {'Rock': ROCK})
+    lines, exit_code = run_job(args + FAKE, tmp_path)
+    assert exit_code == code
+    assert any(output.startswith(line) for output in lines)
+
+def test_jobs_do_not_share_resolved_links(tmp_path):
+    songs = ROCK[:2] + [('No Link', 'AC/DC', 'Live', '')]
+    write_txt(tmp_path / 'songs.txt', {'Rock': songs})
+    warm = download.WarmState()
+    try:
+        lines, code = run_job(['-d', '--txt', 'songs.txt', '--dir', 'resolved', '--resolve-links', '--resolver', 'fake',
+                               '--resolve-cache', 'cache.sqlite3'] + FAKE, tmp_path, warm)
+        assert code == 0
+        assert len(song_files(tmp_path / 'resolved', 'Rock')) == 3
+        lines, code = run_job(['-d', '--txt', 'songs.txt', '--dir', 'plain'] + FAKE, tmp_path, warm)
+        assert code == 0
+        assert song_files(tmp_path / 'plain', 'Rock') == ['AC - DC -- Back in Black.mp3', 'AC - DC -- Highway to Hell.mp3']
+    finally:
+        warm.close()
+
+@pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason='needs Unix sockets')
+def test_server_and_client(tmp_path):
+    write_txt(tmp_path / 'songs.txt', {'Rock': ROCK})
+    socketpath = str(tmp_path / 'server.sock')
+    server = subprocess.Popen([sys.executable, os.path.join(REPO, 'download.py'), '--serve', '--socket', socketpath],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf-8')
+    try:
+        for _ in range(100):
+            if os.path.exists(socketpath):
+                break
+            time.sleep(0.05)
+        # only the user of the server can connect
+        assert stat.S_IMODE(os.stat(socketpath).st_mode) & 0o077 == 0
+        client = subprocess.run([sys.executable, os.path.join(REPO, 'dlclient.py'), '--socket', socketpath, '--',
+                                 '-d', '--txt', 'songs.txt', '--dir', 'out'] + FAKE, cwd=str(tmp_path),
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf-8', timeout=60)
+        assert client.returncode == 0
+        assert '5/5 songs were downloaded correctly.' in client.stdout
+        assert len(song_files(tmp_path / 'out', 'Rock')) == 5
+    finally:
+        server.terminate()
+        output = server.communicate(timeout=30)[0]
+    # the output of the job went to the client, not to the terminal of the server
+    assert 'songs were downloaded' not in output
@@ -0,0 +1,41 @@
+import os
+
+import download
+from helpers import ROCK, catalogue, write_txt, run, playlist_songs, song_files, song_names
+
+
+def test_shards_split_the_catalogue():
+    links = [f'https://x/{i}' for i in range(200)]
+    parts = [[link for link in links if download.in_shard(link, (k, 3))] for k in range(3)]
+    assert sorted(sum(parts, [])) == sorted(links)
+    assert all(len(part) > 30 for part in parts)
+
+def test_parse_shard():
+    assert download.parse_shard(None) == None
+    assert download.parse_shard('2/3') == (1, 3)
+
+def test_merge_shards_combines_all_songs_in_order(tmp_path):
+    txt = write_txt(tmp_path / 'songs.txt', {'Rock': ROCK})
+    shards = [tmp_path / 'shard1', tmp_path / 'shard2']
+    for i, shard_dir in enumerate(shards):
+        assert run('-d', '--txt', txt, '--dir', shard_dir, '-p', '--shard', f'{i + 1}/2') == 0
+    assert sum(len(song_files(shard_dir, 'Rock')) for shard_dir in shards) == 5
+    outdir = tmp_path / 'out'
+    assert run('--merge-shards', *shards, '--dir', outdir) == 0
+    assert len(song_files(outdir, 'Rock')) == 5
+    assert [os.path.splitext(path)[0] for path in playlist_songs(outdir, 'Rock')] == song_names(ROCK)
+
+def test_merge_shards_into_the_first_shard(tmp_path):
+    playlists = catalogue(3, 10)
+    txt = write_txt(tmp_path / 'songs.txt', playlists)
+    shards = [tmp_path / f'shard{k}' for k in range(1, 4)]
+    for k, shard_dir in enumerate(shards):
+        assert run('-d', '--txt', txt, '--dir', shard_dir, '-p', '--shard', f'{k + 1}/3') == 0
+    assert run('--merge-shards', *shards, '--dir', shards[0]) == 0
+    for playlist, songs in playlists.items():
+        assert len(song_files(shards[0], playlist)) == len(songs)
+        assert [os.path.splitext(path)[0] for path in playlist_songs(shards[0], playlist)] == [f'{song[1]} -- {song[0]}' for song in songs]
+
+def test_merge_shards_needs_a_manifest(tmp_path):
+    (tmp_path / 'empty').mkdir()
+    assert run('--merge-shards', tmp_path / 'empty', '--dir', tmp_path / 'out') == 1
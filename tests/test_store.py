@@ -0,0 +1,24 @@
+import os
+
+import pytest
+
+from helpers import ROCK, write_txt, run, playlist_songs
+
+
+@pytest.mark.parametrize('mode', ['hardlink', 'symlink', 'm3u'])
+def test_store_mode_downloads_shared_songs_once(tmp_path, mode):
+    outdir = tmp_path / 'out'
+    txt = write_txt(tmp_path / 'songs.txt', {'Rock': ROCK[:3], 'Best': [ROCK[0], ROCK[3]]})
+    assert run('-d', '--txt', txt, '--dir', outdir, '-p', '--store-mode', mode) == 0
+    # every link is stored once, Back in Black is in both playlists
+    assert len(os.listdir(outdir / '.store')) == 4
+    # every playlist file points to a song that exists
+    for playlist in ('Rock', 'Best'):
+        for path in playlist_songs(outdir, playlist):
+            assert os.path.isfile(os.path.join(outdir, playlist, path))
+    if mode == 'hardlink':
+        assert os.path.samefile(outdir / 'Best' / 'AC - DC -- Back in Black.mp3', outdir / 'Rock' / 'AC - DC -- Back in Black.mp3')
+    elif mode == 'symlink':
+        assert os.path.islink(outdir / 'Best' / 'AC - DC -- Back in Black.mp3')
+    else:
+        assert not os.path.exists(outdir / 'Best' / 'AC - DC -- Back in Black.mp3')
@@ -0,0 +1,52 @@
+import os
+
+import download
+from helpers import ROCK, write_txt, run, playlist_songs, song_files
+
+
+WITHOUT_THUNDERSTRUCK = [song for song in ROCK if song[0] != 'Thunderstruck']
+
+def test_first_sync_prunes_songs_removed_since_the_last_download(tmp_path):
+    outdir = tmp_path / 'out'
+    assert run('-d', '--txt', write_txt(tmp_path / 'songs.txt', {'Rock': ROCK}), '--dir', outdir, '-p') == 0
+    assert run('-d', '--txt', write_txt(tmp_path / 'songs2.txt', {'Rock': WITHOUT_THUNDERSTRUCK}), '--dir', outdir, '-p', '--sync', '--prune') == 0
+    assert not any('Thunderstruck' in name for name in song_files(outdir, 'Rock'))
+    assert len(song_files(outdir, 'Rock')) == 4
+    assert not any('Thunderstruck' in path for path in playlist_songs(outdir, 'Rock'))
+
+def test_sync_downloads_only_added_songs(tmp_path):
+    outdir = tmp_path / 'out'
+    assert run('-d', '--txt', write_txt(tmp_path / 'songs.txt', {'Rock': ROCK[:3]}), '--dir', outdir, '-p', '--sync') == 0
+    mtime = os.stat(outdir / 'Rock' / 'AC - DC -- TNT.mp3').st_mtime_ns
+    assert run('-d', '--txt', write_txt(tmp_path / 'songs2.txt', {'Rock': ROCK}), '--dir', outdir, '-p', '--sync') == 0
+    assert os.stat(outdir / 'Rock' / 'AC - DC -- TNT.mp3').st_mtime_ns == mtime
+    assert len(song_files(outdir, 'Rock')) == 5
+    assert len(playlist_songs(outdir, 'Rock')) == 5
+
+def test_sync_moves_songs_between_playlists(tmp_path):
+    outdir = tmp_path / 'out'
+    assert run('-d', '--txt', write_txt(tmp_path / 'songs.txt', {'Rock': ROCK, 'Best': []}), '--dir', outdir, '-p', '--sync') == 0
+    moved = {'Rock': WITHOUT_THUNDERSTRUCK, 'Best': [ROCK[3]]}
+    assert run('-d', '--txt', write_txt(tmp_path / 'songs2.txt', moved), '--dir', outdir, '-p', '--sync') == 0
+    assert song_files(outdir, 'Best') == ['AC - DC -- Thunderstruck.mp3']
+    assert len(song_files(outdir, 'Rock')) == 4
+    assert playlist_songs(outdir, 'Best') == ['AC - DC -- Thunderstruck.mp3']
+
+def test_sync_keeps_the_rows_of_other_configs(tmp_path):
+    outdir = tmp_path / 'out'
+    configs = [tmp_path / 'a.conf', tmp_path / 'b.conf']
+    configs[0].write_text('# a\n', encoding='utf-8')
+    configs[1].write_text('# b\n', encoding='utf-8')
+    txt = write_txt(tmp_path / 'songs.txt', {'Rock': ROCK})
+    download.main(['-d', '--txt', txt, '--dir', str(outdir), '--backend', 'fake', '--config-location', str(configs[0]), '--quiet'])
+    txt = write_txt(tmp_path / 'songs2.txt', {'Rock': WITHOUT_THUNDERSTRUCK})
+    download.main(['-d', '--txt', txt, '--dir', str(outdir), '--sync', '--backend', 'fake', '--config-location', str(configs[1]), '--quiet'])
+    key = download.manifest_config_key(str(configs[0]), 'fake')
+    with download.DownloadManifest(str(outdir), key) as manifest:
+        rows = [entry for entry in manifest.entries() if entry[3] == key]
+    assert sorted((entry[1], entry[5]) for entry in rows) == sorted((song[3], i) for i, song in enumerate(ROCK))
+
+def test_manifest_has_a_playlist_index(tmp_path):
+    with download.DownloadManifest(str(tmp_path)) as manifest:
+        plan = manifest.db.execute('EXPLAIN QUERY PLAN UPDATE songs SET position = 0 WHERE playlist = ? AND link = ? AND config = ?', ('a', 'b', '')).fetchall()
+    assert 'songs_playlist' in ' '.join(str(row) for row in plan)
@@ -0,0 +1,35 @@
+import pytest
+
+import download
+
+
+@pytest.mark.parametrize('audio_format, audio_quality, expected', [
+    # the default quality of yt-dlp is 5
+    ('mp3', None, ['-c:a', 'libmp3lame', '-q:a', '5.0']),
+    ('mp3', '0', ['-c:a', 'libmp3lame', '-q:a', '0.0']),
+    ('mp3', '10', ['-c:a', 'libmp3lame', '-q:a', '10.0']),
+    # libvorbis has the opposite direction, 10 is the best quality
+    ('vorbis', '0', ['-c:a', 'libvorbis', '-q:a', '10.0']),
+    ('vorbis', '10', ['-c:a', 'libvorbis', '-q:a', '0.0']),
+    ('aac', None, ['-c:a', 'aac', '-q:a', '2.05']),
+    ('m4a', '0', ['-c:a', 'aac', '-q:a', '4.0']),
+    # libopus keeps the default of the encoder
+    ('opus', None, ['-c:a', 'libopus']),
+    ('mp3', '192K', ['-c:a', 'libmp3lame', '-b:a', '192.0k']),
+    ('opus', '96k', ['-c:a', 'libopus', '-b:a', '96.0k']),
+    ('flac', '0', ['-c:a', 'flac']),
+    ('mp3', 'best', ['-c:a', 'libmp3lame']),
+])
+def test_quality_args_match_ytdlp(audio_format, audio_quality, expected):
+    transcoder = download.Transcoder('ffmpeg', audio_format, audio_quality)
+    encoder = download.AUDIO_FORMATS[audio_format][2]
+    assert transcoder.codec_args(encoder) == expected
+
+def test_unsupported_format_is_copied():
+    transcoder = download.Transcoder('ffmpeg', 'mka')
+    assert transcoder.decide('song.webm') == ('copy', 'webm', 'webm', ['-c:a', 'copy'])
+
+def test_source_config_leaves_out_the_extraction_options(tmp_path):
+    configpath = tmp_path / 'ytdlp.conf'
+    configpath.write_text('-x --audio-format mp3\n--audio-quality=0\n# a comment\n--embed-thumbnail\n', encoding='utf-8')
+    assert download.load_ytdlp_config(str(configpath)) == (['--embed-thumbnail'], 'mp3', '0')
@@ -0,0 +1,64 @@
+import os
+
+import download
+from helpers import catalogue, write_txt
+
+
+TXT = '''INDEX PLAYLISTS
+- Rock
+- Pop
+- Jazz
+END INDEX
+
+END HEADER
+
+Unlisted Song   Someone   Nowhere   https://x/unlisted
+
+PLAYLIST Rock
+Back in Black   AC/DC   Back in Black   https://x/bib
+# a comment
+Highway to Hell   AC/DC   Highway to Hell
+SKIP
+TNT   AC/DC   TNT   https://x/tnt
+END SKIP
+
+PLAYLIST Pop
+Song A   Artist A   Album A
+SKIP
+Song B   Artist B   Album B   https://x/b
+Song C   Artist C   Album C   https://x/c
+
+PLAYLIST Jazz
+So What   Miles Davis   Kind of Blue   https://x/sowhat
+'''
+
+def read(txtfile, allowed_playlists, use_index):
+    songs, stats = download.read_txtfile(txtfile, allowed_playlists, use_index=use_index)
+    songs = [(song.playlist, song.title, song.link) for song in songs]
+    return (songs, stats)
+
+def test_filtered_stats_match_a_full_parse(tmp_path):
+    txtfile = tmp_path / 'songs.txt'
+    txtfile.write_text(TXT, encoding='utf-8')
+    for allowed_playlists in (['Rock'], ['Jazz'], ['Rock', 'Jazz']):
+        indexed = read(str(txtfile), allowed_playlists, True)
+        assert os.path.exists(download.txtindex_path(str(txtfile)))
+        assert indexed == read(str(txtfile), allowed_playlists, False)
+
+def test_index_is_rebuilt_when_the_txt_file_changes(tmp_path):
+    txtfile = write_txt(tmp_path / 'songs.txt', catalogue(3, 4))
+    assert len(read(txtfile, ['List 1'], True)[0]) == 4
+    index = download.load_txtindex(txtfile)
+    assert [section['songs'] for section in index['sections']] == [0, 4, 4, 4]
+
+    write_txt(txtfile, catalogue(3, 6))
+    songs, stats = read(txtfile, ['List 1'], True)
+    assert songs == [('List 1', f'Song 1-{s}', f'https://x/1/{s}') for s in range(6)]
+    assert stats['total'] == 18
+    assert [section['songs'] for section in download.load_txtindex(txtfile)['sections']] == [0, 6, 6, 6]
+
+def test_invalid_index_file_is_rebuilt(tmp_path):
+    txtfile = write_txt(tmp_path / 'songs.txt', catalogue(2, 3))
+    with open(download.txtindex_path(txtfile), 'w', encoding='utf-8') as writer:
+        writer.write('not json')
+    assert len(read(txtfile, ['List 0'], True)[0]) == 3